@@ -0,0 +1,129 @@
+"""Compares the compiled struct codecs of `strider.io` with field by field packing on large index and database files.
+
+    python benchmarks/structcodec.py [--entries 100000] [--archives 2000] [--repeat 5]
+"""
+from array import array
+from io import BytesIO
+import argparse
+import dataclasses
+import struct
+import timeit
+
+from strider.io import StriderFileIO
+from strider.strider import CURRENT_REVISION
+from strider.datatypes import Database, DatabaseArchive, ArchiveKey, ArchiveIndex, ARCHIVE_INDEX_TYPES, ARCHIVE_KEY_TYPES, ARCHIVE_RANGE, ARCHIVE_LAYOUT
+
+
+class FieldFileIO(StriderFileIO):
+    """Reference reader/writer packing every field on its own"""
+
+    def readStruct(self, striderStruct):
+        data = []
+        revision = 0
+        for i, field in enumerate(dataclasses.fields(striderStruct)[:len(striderStruct.format)]):
+            if striderStruct.fieldRevision(i) > revision:
+                break
+            data.append(self.readFormat((striderStruct.format[i],))[0])
+            if field.name == "revision":
+                revision = data[-1]
+        return striderStruct(*data)
+
+    def writeStruct(self, striderStruct):
+        revision = getattr(striderStruct, "revision", 0)
+        for i, field in enumerate(dataclasses.fields(striderStruct)):
+            if i < len(striderStruct.format):
+                if striderStruct.fieldRevision(i) > revision:
+                    continue
+                value = getattr(striderStruct, field.name)
+                match field.type.__name__:
+                    case "str":
+                        self.writeString(value)
+                        continue
+                    case "Enum":
+                        value = value.value
+                self.file.write(struct.pack(striderStruct.format[i], value))
+            else:
+                for item in getattr(striderStruct, field.name):
+                    self.writeStruct(item)
+
+    def readStructSequence(self, striderStruct, count):
+        return [self.readStruct(striderStruct) for _ in range(count)]
+
+    def readIndexArrays(self, count):
+        timestamps = array("I")
+        offsets = array("I")
+        for index in self.readStructSequence(ArchiveIndex, count):
+            timestamps.append(index.timestamp)
+            offsets.append(index.offset)
+        return timestamps, offsets
+
+    def writeIndexArrays(self, timestamps, offsets):
+        for timestamp, offset in zip(timestamps, offsets):
+            self.writeStruct(ArchiveIndex(timestamp, offset, ARCHIVE_INDEX_TYPES.default))
+
+
+def makeDatabase(archives: int, keys: int = 16) -> Database:
+    database = Database("STRDR", CURRENT_REVISION, "benchmark", archives, keys, 60, ARCHIVE_RANGE.day, ARCHIVE_LAYOUT.row)
+    database.archives = [DatabaseArchive(i * 86400, (i + 1) * 86400, i + 1, 0) for i in range(archives)]
+    database.keys = [ArchiveKey(f"key{i}", 0, ARCHIVE_KEY_TYPES.f) for i in range(keys)]
+    return database
+
+
+def readDatabase(fileIO: StriderFileIO) -> Database:
+    database = fileIO.readStruct(Database)
+    database.archives = fileIO.readStructSequence(DatabaseArchive, database.archiveCount)
+    database.keys = fileIO.readStructSequence(ArchiveKey, database.keyCount)
+    return database
+
+
+def run(name: str, function, repeat: int) -> float:
+    seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+    print(f"{name:<32}{seconds * 1000:>10.2f} ms")
+    return seconds
+
+
+def compare(name: str, reference, compiled, repeat: int) -> None:
+    fieldSeconds = run(f"{name} (per field)", reference, repeat)
+    codecSeconds = run(f"{name} (codec)", compiled, repeat)
+    print(f"{'':<32}{fieldSeconds / codecSeconds:>10.1f}x\n")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000, help="index entries")
+    parser.add_argument("--archives", type=int, default=2000, help="database archives")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    timestamps = array("I", range(0, args.entries * 60, 60))
+    offsets = array("I", range(0, args.entries * 512, 512))
+    indexBytes = BytesIO()
+    StriderFileIO(indexBytes).writeIndexArrays(timestamps, offsets)
+    indexBytes = indexBytes.getvalue()
+    assert FieldFileIO(BytesIO(indexBytes)).readIndexArrays(args.entries) == StriderFileIO(BytesIO(indexBytes)).readIndexArrays(args.entries)
+
+    compare(f"write {args.entries} index",
+            lambda: FieldFileIO(BytesIO()).writeIndexArrays(timestamps, offsets),
+            lambda: StriderFileIO(BytesIO()).writeIndexArrays(timestamps, offsets), args.repeat)
+    compare(f"read {args.entries} index",
+            lambda: FieldFileIO(BytesIO(indexBytes)).readIndexArrays(args.entries),
+            lambda: StriderFileIO(BytesIO(indexBytes)).readIndexArrays(args.entries), args.repeat)
+
+    database = makeDatabase(args.archives)
+    databaseBytes = BytesIO()
+    StriderFileIO(databaseBytes).writeStruct(database)
+    databaseBytes = databaseBytes.getvalue()
+    fieldBytes = BytesIO()
+    FieldFileIO(fieldBytes).writeStruct(database)
+    assert fieldBytes.getvalue() == databaseBytes
+
+    compare(f"write {args.archives} archives",
+            lambda: FieldFileIO(BytesIO()).writeStruct(database),
+            lambda: StriderFileIO(BytesIO()).writeStruct(database), args.repeat)
+    compare(f"read {args.archives} archives",
+            lambda: readDatabase(FieldFileIO(BytesIO(databaseBytes))),
+            lambda: readDatabase(StriderFileIO(BytesIO(databaseBytes))), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""Throughput and latency benchmarks of the ingest, query and maintenance paths on synthetic data.
+
+    python benchmarks/suite.py run [--keys 8] [--sample-rate 10] [--days 7] [--range day] [--layout row] [--output results.json] [--baseline old.json]
+    python benchmarks/suite.py compare old.json new.json [--threshold 0.1]
+
+Results are written as JSON, `compare` and `run --baseline` report the change of each benchmark and exit with status 1 on a regression.
+"""
+from datetime import datetime, timedelta
+from typing import Callable, Union
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from strider import DatabaseManager
+from strider.io import numpy
+from strider.datatypes import ARCHIVE_RANGE, ARCHIVE_LAYOUT, ARCHIVE_RESIDENCY
+
+RESULTS_VERSION = 1
+# options that shape the generated data, results are only comparable if they match
+DATA_OPTIONS = ("keys", "sample_rate", "days", "range", "layout", "add_records", "seed")
+# a timed section, returns the number of records it handled
+Benchmark = Callable[[], int]
+
+
+def generateRecords(keyCount: int, sampleRate: float, days: float, seed: int = 0) -> list[tuple[datetime, dict]]:
+    """Records `sampleRate` seconds apart over the last `days` days, each key a random walk. Even keys are floats, odd keys ints.
+    The records end now so the last archive is the active one, which `addKey` and `setIndexInteval` work on"""
+    rng = random.Random(seed)
+    end = datetime.now().replace(microsecond=0)
+    start = end - timedelta(days=days)
+    values = [0.0] * keyCount
+    records = []
+    for i in range(int(days * 86400 / sampleRate)):
+        values = [value + rng.uniform(-1, 1) for value in values]
+        records.append((start + timedelta(seconds=i * sampleRate), {f"key{keyI}": value if keyI % 2 == 0 else int(value * 100) for keyI, value in enumerate(values)}))
+    return records
+
+
+def createDatabase(baseDir: str, name: str, args: argparse.Namespace, records: list) -> None:
+    database = DatabaseManager.new(baseDir, name, ARCHIVE_RANGE[args.range], ARCHIVE_LAYOUT[args.layout])
+    for keyI in range(args.keys):
+        database.addKey(f"key{keyI}", 5 if keyI % 2 == 0 else 3)
+    if records:
+        database.bulkAdd(records)
+    database.close()
+
+
+class Suite:
+    """Prepares a database from the generated records once, each benchmark then runs on a fresh database or a copy of it"""
+
+    def __init__(self, args: argparse.Namespace, baseDir: str) -> None:
+        self.args = args
+        self.baseDir = baseDir
+        self.records = generateRecords(args.keys, args.sample_rate, args.days, args.seed)
+        self.start, self.end = self.records[0][0], self.records[-1][0] + timedelta(seconds=1)
+        createDatabase(baseDir, "prepared", args, self.records)
+        self.runs = 0
+
+    def newName(self) -> str:
+        self.runs += 1
+        return f"run{self.runs}"
+
+    def empty(self) -> str:
+        name = self.newName()
+        createDatabase(self.baseDir, name, self.args, [])
+        return name
+
+    def copy(self) -> str:
+        name = self.newName()
+        shutil.copytree(os.path.join(self.baseDir, "prepared"), os.path.join(self.baseDir, name))
+        return name
+
+    def load(self, name: str = "prepared", **sessionOptions):
+        return DatabaseManager.load(self.baseDir, name, **sessionOptions)
+
+    def add(self) -> Benchmark:
+        database = self.load(self.empty())
+        records = self.records[:self.args.add_records]
+
+        def run() -> int:
+            for date, values in records:
+                database.add(date, values)
+            database.close()
+            return len(records)
+        return run
+
+    def bulkAdd(self) -> Benchmark:
+        database = self.load(self.empty())
+
+        def run() -> int:
+            database.bulkAdd(self.records)
+            database.close()
+            return len(self.records)
+        return run
+
+    def query(self, **options) -> Callable[[], Benchmark]:
+        def setup() -> Benchmark:
+            database = self.load()
+
+            def run() -> int:
+                count = len(database.query(self.start, self.end, **options))
+                database.close()
+                return count
+            return run
+        return setup
+
+    def queryArrays(self) -> Benchmark:
+        database = self.load()
+
+        def run() -> int:
+            count = len(database.query(self.start, self.end, asArrays=True)["time"])
+            database.close()
+            return count
+        return run
+
+    def addKey(self) -> Benchmark:
+        database = self.load(self.copy())
+
+        def run() -> int:
+            database.addKey("addedKey", 5)
+            database.close()
+            return len(self.records)
+        return run
+
+    def setIndexInteval(self) -> Benchmark:
+        database = self.load(self.copy())
+
+        def run() -> int:
+            database.setIndexInteval(60, True)
+            database.close()
+            return len(self.records)
+        return run
+
+    def startup(self, residency: ARCHIVE_RESIDENCY) -> Callable[[], Benchmark]:
+        def setup() -> Benchmark:
+            def run() -> int:
+                database = self.load(residency=residency)
+                database.close()
+                return len(database.databaseHandler.database.archives)
+            return run
+        return setup
+
+    def benchmarks(self) -> dict[str, Callable[[], Benchmark]]:
+        benchmarks = {
+            "ingest.add": self.add,
+            "ingest.bulkAdd": self.bulkAdd,
+            "query.records": self.query(),
+            "query.raw": self.query(raw=True),
+            "query.arrays": self.queryArrays,
+            "query.key": self.query(key="key0"),
+            "maintenance.addKey": self.addKey,
+            "maintenance.setIndexInteval": self.setIndexInteval,
+            "startup.current": self.startup(ARCHIVE_RESIDENCY.current),
+            "startup.all": self.startup(ARCHIVE_RESIDENCY.all),
+        }
+        if numpy is not None:
+            benchmarks["query.numpy"] = self.query(format="numpy")
+        return benchmarks
+
+
+def measure(setup: Callable[[], Benchmark], repeat: int) -> dict:
+    """Runs a benchmark `repeat` times, only the section returned by `setup` is timed"""
+    timings = []
+    for _ in range(repeat):
+        run = setup()
+        started = time.perf_counter()
+        count = run()
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    return {"seconds": best, "median": statistics.median(timings), "count": count, "perSecond": count / best if best else None}
+
+
+def getCommit() -> Union[None | str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    """Prints the change of every benchmark in both result sets, returns whether any got slower by more than `threshold`"""
+    if baseline["config"] != current["config"]:
+        print("warning: the baseline was run on different data", file=sys.stderr)
+    regressed = False
+    print(f"{'benchmark':<32}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before, after = baseline["results"][name]["seconds"], result["seconds"]
+        change = after / before - 1 if before else 0
+        flag = ""
+        if change > threshold:
+            regressed = True
+            flag = "  regression"
+        print(f"{name:<32}{before * 1000:>10.2f}ms{after * 1000:>10.2f}ms{change:>+10.1%}{flag}")
+    return regressed
+
+
+def run(args: argparse.Namespace) -> int:
+    with tempfile.TemporaryDirectory(prefix="strider-bench") as baseDir:
+        suite = Suite(args, baseDir)
+        results = {}
+        for name, setup in suite.benchmarks().items():
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = measure(setup, args.repeat)
+            print(f"{name:<32}{results[name]['seconds'] * 1000:>10.2f} ms{results[name]['count']:>10}")
+
+    output = {"version": RESULTS_VERSION, "commit": getCommit(), "python": platform.python_version(), "numpy": numpy is not None,
+              "config": {key: getattr(args, key) for key in DATA_OPTIONS}, "repeat": args.repeat,
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(output, outputFile, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        return 1 if compare(baseline, output, args.threshold) else 0
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runParser = commands.add_parser("run", help="run the benchmarks")
+    runParser.add_argument("--keys", type=int, default=8, help="keys per record")
+    runParser.add_argument("--sample-rate", type=float, default=10, help="seconds between records")
+    runParser.add_argument("--days", type=float, default=7, help="days of records")
+    runParser.add_argument("--range", choices=[archiveRange.name for archiveRange in ARCHIVE_RANGE], default="day", help="archive range")
+    runParser.add_argument("--layout", choices=[layout.name for layout in ARCHIVE_LAYOUT], default="row", help="archive layout")
+    runParser.add_argument("--add-records", type=int, default=10000, help="records written one by one by ingest.add")
+    runParser.add_argument("--repeat", type=int, default=3)
+    runParser.add_argument("--seed", type=int, default=0)
+    runParser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    runParser.add_argument("--output", help="JSON results file")
+    runParser.add_argument("--baseline", help="JSON results file to compare with")
+    runParser.add_argument("--threshold", type=float, default=0.1, help="slowdown reported as a regression")
+
+    compareParser = commands.add_parser("compare", help="compare two results files")
+    compareParser.add_argument("baseline")
+    compareParser.add_argument("current")
+    compareParser.add_argument("--threshold", type=float, default=0.1, help="slowdown reported as a regression")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        with open(args.baseline) as baselineFile, open(args.current) as currentFile:
+            return 1 if compare(json.load(baselineFile), json.load(currentFile), args.threshold) else 0
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
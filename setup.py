@@ -10,4 +10,5 @@ setup(name='strider',
       author='Emily Cavalcante',
       license='MIT',
       packages=find_packages(include=['strider', 'strider.*']),
+      extras_require={'numpy': ['numpy']},
       )
\ No newline at end of file
@@ -1,2 +1,3 @@
 from strider.strider import DatabaseSession, DatabaseManager, DatabaseMultiSession
+from strider.aio import AsyncDatabaseSession
 from strider.exceptions import *
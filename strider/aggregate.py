@@ -0,0 +1,150 @@
+from typing import Union
+from bisect import bisect_left
+
+from strider.datatypes import ArchiveKey, ARCHIVE_KEY_TYPES, DOWNSAMPLE_FUNCS
+
+
+class Accumulator:
+    """Running count, sum, min, max and last value of a column"""
+    __slots__ = ("count", "sum", "min", "max", "last")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, value) -> None:
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.last = value
+
+    def addValues(self, values) -> None:
+        if len(values):
+            self.count += len(values)
+            self.sum += sum(values)
+            low, high = min(values), max(values)
+            if self.min is None or low < self.min:
+                self.min = low
+            if self.max is None or high > self.max:
+                self.max = high
+            self.last = values[-1]
+
+    def merge(self, other: "Accumulator") -> None:
+        """Folds in the values of a later accumulator"""
+        if other.count:
+            self.count += other.count
+            self.sum += other.sum
+            if self.min is None or other.min < self.min:
+                self.min = other.min
+            if self.max is None or other.max > self.max:
+                self.max = other.max
+            self.last = other.last
+
+    def result(self, func: DOWNSAMPLE_FUNCS) -> Union[None | int | float]:
+        match func:
+            case DOWNSAMPLE_FUNCS.avg:
+                return self.sum / self.count if self.count else None
+            case DOWNSAMPLE_FUNCS.min:
+                return self.min
+            case DOWNSAMPLE_FUNCS.max:
+                return self.max
+            case DOWNSAMPLE_FUNCS.sum:
+                return self.sum
+            case DOWNSAMPLE_FUNCS.last:
+                return self.last
+            case DOWNSAMPLE_FUNCS.count:
+                return self.count
+
+
+def getRollupKey(archiveKey: ArchiveKey) -> ArchiveKey:
+    """Key as stored in rollup archives, its type is widened to hold the downsampled value.
+    Sums are stored as floats, an int sum overflows on a few large values"""
+    func = DOWNSAMPLE_FUNCS(archiveKey.downsampleFunc)
+    keyType = ARCHIVE_KEY_TYPES(archiveKey.type)
+    match func:
+        case DOWNSAMPLE_FUNCS.avg | DOWNSAMPLE_FUNCS.sum:
+            keyType = ARCHIVE_KEY_TYPES["f"]
+        case DOWNSAMPLE_FUNCS.count:
+            keyType = ARCHIVE_KEY_TYPES["I"]
+    return ArchiveKey(archiveKey.name, archiveKey.downsampleFunc, keyType)
+
+
+class Rollup:
+    """Downsamples raw records into `period` second buckets, each key is folded with its downsample function.
+    A bucket is only emitted once a record from a later bucket arrives"""
+    period: int
+    funcs: list[DOWNSAMPLE_FUNCS]
+    bucket: Union[None | int] = None
+    accumulators: list[Accumulator]
+
+    def __init__(self, period: int, keys: list[ArchiveKey]) -> None:
+        self.period = period
+        self.funcs = [DOWNSAMPLE_FUNCS(key.downsampleFunc) for key in keys]
+        self.accumulators = [Accumulator() for _ in keys]
+
+    def _emit(self) -> tuple:
+        record = (self.bucket, *[accumulator.result(func) if accumulator.count else 0 for accumulator, func in zip(self.accumulators, self.funcs)])
+        self.accumulators = [Accumulator() for _ in self.funcs]
+        return record
+
+    def add(self, records: list) -> list[tuple]:
+        """Folds `records` in, returns the completed buckets as rollup records"""
+        completed = []
+        for record in records:
+            bucket = record[0] - record[0] % self.period
+            if bucket != self.bucket:
+                if self.bucket is not None:
+                    completed.append(self._emit())
+                self.bucket = bucket
+            for accumulator, value in zip(self.accumulators, record[1:]):
+                accumulator.add(value)
+        return completed
+
+
+class BucketAggregator:
+    """Folds record chunks into `bucket` second buckets holding an accumulator per key.
+    Memory is bounded by the number of buckets, not the number of records"""
+    bucket: int
+    keyCount: int
+    buckets: dict[int, list[Accumulator]]
+
+    def __init__(self, bucket: int, keyCount: int) -> None:
+        self.bucket = bucket
+        self.keyCount = keyCount
+        self.buckets = {}
+
+    def addChunk(self, chunk: tuple, columns: list[tuple[int, int]]) -> None:
+        """Folds a chunk of time ordered records, `columns` pairs each accumulated key with its record field"""
+        if not chunk:
+            return
+        values = list(zip(*chunk))
+        timestamps = values[0]
+        i = 0
+        while i < len(timestamps):
+            bucket = timestamps[i] - timestamps[i] % self.bucket
+            j = bisect_left(timestamps, bucket + self.bucket, i)
+            accumulators = self.buckets.get(bucket)
+            if accumulators is None:
+                accumulators = self.buckets[bucket] = [Accumulator() for _ in range(self.keyCount)]
+            for keyI, column in columns:
+                accumulators[keyI].addValues(values[column][i:j])
+            i = j
+
+    def addSummary(self, summary: list[Accumulator], columns: list[tuple[int, int]]) -> None:
+        """Folds a record block summary, an accumulator per record field, whose records all fall in one bucket"""
+        bucket = summary[0].min - summary[0].min % self.bucket
+        accumulators = self.buckets.get(bucket)
+        if accumulators is None:
+            accumulators = self.buckets[bucket] = [Accumulator() for _ in range(self.keyCount)]
+        for keyI, column in columns:
+            accumulators[keyI].merge(summary[column])
+
+    def results(self, funcs: list[DOWNSAMPLE_FUNCS]) -> list[tuple]:
+        """`(bucket, *values)` per bucket in time order, with a value per key and function"""
+        return [(bucket, *[accumulator.result(func) for accumulator in accumulators for func in funcs]) for bucket, accumulators in sorted(self.buckets.items())]
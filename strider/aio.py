@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Union
+import asyncio
+
+from strider.strider import DatabaseSession
+
+
+class AsyncDatabaseSession:
+    """asyncio front-end of a `DatabaseSession`. Added records go on a bounded queue that a single writer task drains in batches into `bulkAdd`,
+    each batch is made durable before its records are acknowledged. Every session call runs on a one thread executor, so the event loop never blocks on file I/O and the session is only used from one thread"""
+    session: DatabaseSession
+    queue: asyncio.Queue
+    batchSize: int
+    writer: Union[None | asyncio.Task] = None
+
+    def __init__(self, session: DatabaseSession, queueSize: int = 10000, batchSize: int = 1000) -> None:
+        """`queueSize` bounds the records waiting to be written, `add` waits for room once it is reached.
+        The writer takes up to `batchSize` records per batch"""
+        self.session = session
+        self.queue = asyncio.Queue(queueSize)
+        self.batchSize = batchSize
+        self.executor = ThreadPoolExecutor(1, "strider-writer")
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def start(self) -> None:
+        """Starts the writer task on the running loop"""
+        if self.writer is None:
+            self.writer = asyncio.get_running_loop().create_task(self._write())
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+    async def add(self, time: datetime, data: dict) -> asyncio.Future:
+        """Queues a record, waiting while the queue is full. Returns a future resolved once the record is durable, see `_writeBatch`,
+        or failed with the error of its batch"""
+        self.start()
+        ack = asyncio.get_running_loop().create_future()
+        await self.queue.put((time, data, ack))
+        return ack
+
+    def _writeBatch(self, batch: list) -> None:
+        """Writes a batch and forces it to disk, to the write-ahead log if the session keeps one, otherwise the archives written to are synced"""
+        self.session.bulkAdd([(time, data) for time, data, ack in batch])
+        if self.session.wal is not None:
+            self.session.flush()
+        else:
+            self.session.checkpoint()
+
+    async def _write(self) -> None:
+        """Writer task, a failed batch fails the ack of each of its records. Records of the batch bound for earlier archives may still have been written"""
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batchSize and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            records = [item for item in batch if item is not None]
+            try:
+                if records:
+                    await self._run(self._writeBatch, records)
+            except Exception as error:
+                for time, data, ack in records:
+                    if not ack.done():
+                        ack.set_exception(error)
+            else:
+                for time, data, ack in records:
+                    if not ack.done():
+                        ack.set_result(None)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if None in batch:
+                return
+
+    async def flush(self) -> None:
+        """Waits until every queued record is durable"""
+        await self.queue.join()
+        await self._run(self.session.flush)
+
+    async def query(self, *args, **kwargs):
+        """Awaitable `DatabaseSession.query`, it runs after the batches already being written"""
+        return await self._run(self.session.query, *args, **kwargs)
+
+    async def close(self) -> None:
+        """Writes the queued records, stops the writer and closes the session"""
+        if self.writer is not None:
+            await self.queue.put(None)
+            await self.writer
+            self.writer = None
+        await self._run(self.session.close)
+        self.executor.shutdown()
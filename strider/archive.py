@@ -1,189 +1,824 @@
-from typing import Union, Self
-from collections import namedtuple
+from typing import Union, Self, Iterator, Callable
+from collections import namedtuple, deque
+from array import array
+from bisect import bisect_left, bisect_right
+import os
+import time
+import struct
 
-from strider.io import StriderFileIO, StriderFileUtil, StriderArchiveIO
+from strider.io import StriderFileIO, StriderFileUtil, StriderArchiveIO, numpy
+from strider.wal import WriteAheadLog
+from strider.aggregate import Accumulator
+from strider.predicate import bindWhere, filterRecords, maskArray, summaryMatches
+from strider.metrics import Metrics
 from strider.exceptions import *
 
 from strider.strider import CURRENT_REVISION
-from strider.datatypes import Database, DatabaseArchive, ArchiveFile, ArchiveKey, ArchiveIndex, ARCHIVE_KEY_TYPES
+from strider.datatypes import Database, DatabaseArchive, ArchiveFile, ArchiveKey, ArchiveIndex, ArchiveSchema, ARCHIVE_KEY_TYPES, ARCHIVE_LAYOUT
+
+INDEX_SIZE = StriderFileIO.structSize(ArchiveIndex)
+# records decoded at a time by streaming reads
+CHUNK_SIZE = 4096
+# summary file entry, the index entry timestamp, offset and record count followed by the min, max, sum and last value of each record field
+SUMMARY_HEADER = "=III"
+SUMMARY_FIELD = "dddd"
+
+
+def _accumulate(accumulator: Accumulator, values) -> None:
+    """Folds a sequence or NumPy array of values into `accumulator`"""
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        if len(values):
+            other = Accumulator()
+            other.count = len(values)
+            other.sum = values.sum(dtype="f8" if values.dtype.kind == "f" else "i8").item()
+            other.min, other.max, other.last = values.min().item(), values.max().item(), values[-1].item()
+            accumulator.merge(other)
+    else:
+        accumulator.addValues(values)
+
 
 class ArchiveHandler:
+    """Row archive, records are stored back to back in the data file.
+    Records written before a key was added keep their shorter layout and read back with the key's default value, see `ArchiveSchema`"""
+    layout: ARCHIVE_LAYOUT = ARCHIVE_LAYOUT.row
     archive: ArchiveFile
     archiveRecordFormat: str
+    recordStruct: struct.Struct
+    dataFormat: str
+    dataRecordSize: int
     lastEntryTimestamp: int = 0
     lastIndexTimestamp: int = 0
     fileUtil: StriderFileUtil
+    dataFile: Union[None | StriderArchiveIO] = None
+    dataSize: int = 0
+    writeBuffer: bytearray
+    bufferSize: int = 0
+    bufferAge: float = 0
+    bufferTime: float = 0
+    indexTimestamps: array
+    indexOffsets: array
+    indicesOffset: int = 0
+    savedIndexCount: int = 0
+    # index file stat when it was last read or written
+    indexStat: Union[None | tuple[int, int, int]] = None
+    # per index entry, an accumulator per record field over its records, up to the next entry
+    summaries: list[list[Accumulator]]
+    savedSummaryCount: int = 0
+    blockSize: int = 0
+    tail: Union[None | deque] = None
+    # log written records go to before they are buffered, set on raw archives being written to
+    wal: Union[None | WriteAheadLog] = None
+    tailStart: Union[None | int] = None
+    # bytes and records read and written, index entries visited and tail and summary hits, None while metrics are disabled
+    metrics: Union[None | Metrics] = None
 
     def __init__(self, fileUtil: StriderFileUtil) -> None:
         self.fileUtil = fileUtil
+        self.writeBuffer = bytearray()
+        self.indexTimestamps = array("I")
+        self.indexOffsets = array("I")
+        self.summaries = []
+
+    def setBuffer(self, bufferSize: int = 0, bufferAge: float = 0) -> None:
+        """Sets the write buffer thresholds. Records are flushed once `bufferSize` records are buffered
+        or the oldest buffered record is older than `bufferAge` seconds (checked on write). 
+        A `bufferSize` of 0 writes through on every call"""
+        self.bufferSize = bufferSize
+        self.bufferAge = bufferAge
+
+    def setTail(self, tailSize: int = 0) -> None:
+        """Keeps the last `tailSize` written records in memory, reads that start inside them are served without file I/O.
+        A `tailSize` of 0 disables the tail"""
+        if not tailSize:
+            self.tail = None
+        elif self.tail is None or self.tail.maxlen != tailSize:
+            self.tail = deque(maxlen=tailSize)
+            # records already in the archive are not in the tail
+            self.tailStart = None if self._hasRecords() else 0
+
+    def _resetTail(self) -> None:
+        if self.tail is not None:
+            self.tail = deque(maxlen=self.tail.maxlen)
+            self.tailStart = None
+
+    def _fillTail(self, recordBytes: bytes, recordCount: int, previousTimestamp: int) -> None:
+        """Appends written records to the tail, `tailStart` is the first timestamp from which the tail holds every record"""
+        dropped = len(self.tail) + recordCount > self.tail.maxlen
+        self.tail.extend(self.recordStruct.iter_unpack(recordBytes))
+        if dropped:
+            self.tailStart = self.tail[0][0] + 1
+        elif self.tailStart is None:
+            self.tailStart = previousTimestamp + 1
+
+    def _readTail(self, start: int, end: int) -> Union[None | list]:
+        """Records from `start` to `end` if the tail holds all of them, None otherwise"""
+        if self.tail is None or self.tailStart is None or start < self.tailStart:
+            return None
+        return [record for record in self.tail if start <= record[0] < end]
 
     def _buildDataFormat(self):
         _format = "I"
         for key in self.archive.keys:
             _format += ARCHIVE_KEY_TYPES(key.type).name
         self.archiveRecordFormat = _format
+        self.recordStruct = struct.Struct(_format)
+        # format of a single record in the data file, index offsets are data file offsets
+        self.dataFormat = _format
+        self.dataRecordSize = self.recordStruct.size
+        self._resetTail()
+
+    def _getSchemaFormat(self, keyCount: int) -> str:
+        """Data file record format of the records written with the first `keyCount` keys"""
+        return self.archiveRecordFormat[:keyCount + 1]
+
+    def _getSchemaKeyCount(self, offset: int) -> int:
+        """Key count of the record at data file `offset`"""
+        for schema in self.archive.schemas:
+            if offset < schema.offset:
+                return schema.keyCount
+        return self.archive.keyCount
+
+    def _getSchemaStart(self) -> int:
+        """Data file offset of the first record holding every key"""
+        return self.archive.schemas[-1].offset if self.archive.schemas else 0
+
+    def _iterSchemas(self, startOffset: int, endOffset: int) -> Iterator[tuple[int, int, int]]:
+        """Splits the data file range `[startOffset, endOffset)` by schema, yields the range and key count of each part"""
+        schemaStart = 0
+        for schemaEnd, keyCount in [*[(schema.offset, schema.keyCount) for schema in self.archive.schemas], (max(endOffset, 0), self.archive.keyCount)]:
+            if startOffset < schemaEnd and schemaStart < endOffset:
+                yield max(startOffset, schemaStart), min(endOffset, schemaEnd), keyCount
+            schemaStart = max(schemaStart, schemaEnd)
+
+    def _getDefaults(self, keyCount: int) -> tuple:
+        """Values of the keys past the first `keyCount`, for records written before they were added"""
+        defaultsFormat = "=" + self.archiveRecordFormat[keyCount + 1:]
+        return struct.unpack(defaultsFormat, bytes(struct.calcsize(defaultsFormat)))
 
     def load(self, archive: DatabaseArchive) -> Self:
         """"""
         try:
-            self.archive = self._readArchiveIndex(StriderFileIO(open(self.fileUtil.getArchiveFilePath(archive), "rb")))
+            with StriderFileIO(open(self.fileUtil.getArchiveFilePath(archive), "rb")) as archiveFile:
+                self.archive = self._readArchiveIndex(archiveFile)
+                if self.archive.layout != self.layout:
+                    raise DatabaseCorrupt(f"Archive {self.archive.index} has a {self.archive.layout.name} layout")
+                self.indicesOffset = archiveFile.file.tell()
+                self.indexTimestamps, self.indexOffsets = archiveFile.readIndexArrays(self.archive.indexCount)
+                self.savedIndexCount = self.archive.indexCount
+            self.indexStat = StriderFileUtil.statFile(self.fileUtil.getArchiveFilePath(archive))
             self._buildDataFormat()
-            self.lastIndexTimestamp = self.archive.indices[-1].timestamp if self.archive.indexCount != 0 else 0
+            self.dataSize = self._getDataFileSize()
+            self._readSummaries()
+            self._trimIndex()
+            self.lastIndexTimestamp = self.indexTimestamps[-1] if self.archive.indexCount != 0 else 0
         except FileNotFoundError:
             raise ArchiveNotFound()
 
         return self
 
+    def _trimIndex(self, count: Union[None | int] = None) -> None:
+        """Drops index entries past the end of the data file, left when data did not reach the disk but its index did.
+        `count` entries are kept if set"""
+        if count is None:
+            count = bisect_left(self.indexOffsets, self.dataSize)
+        if count < len(self.indexOffsets):
+            del self.indexTimestamps[count:]
+            del self.indexOffsets[count:]
+            self.archive.indexCount = count
+            self.savedIndexCount = min(self.savedIndexCount, count)
+            self.lastIndexTimestamp = self.indexTimestamps[-1] if count else 0
+            # the records of the new last entry may have been lost too
+            del self.summaries[max(count - 1, 0):]
+            self.savedSummaryCount = min(self.savedSummaryCount, len(self.summaries))
+
     def _readArchiveIndex(self, archiveFile: StriderFileIO) -> ArchiveFile:
-        """Read Archive file structs 
+        """Read Archive file header and keys, indices are left in the file to be read into arrays
         TODO error handling"""
         archive: ArchiveFile = archiveFile.readStruct(ArchiveFile)
         archive.keys = archiveFile.readStructSequence(ArchiveKey, archive.keyCount)
-        archive.indices = archiveFile.readStructSequence(ArchiveIndex, archive.indexCount)
+        archive.schemas = archiveFile.readStructSequence(ArchiveSchema, archive.schemaCount)
         return archive
 
-    def create(self, databaseArchive: DatabaseArchive, database: Database) -> Self:
+    def create(self, databaseArchive: DatabaseArchive, database: Database, keys: list[ArchiveKey]) -> Self:
         self.archive = ArchiveFile("strdridx", CURRENT_REVISION,
                                    databaseArchive.resolution,
                                    databaseArchive.minRange,
                                    databaseArchive.maxRange,
                                    databaseArchive.index,
-                                   database.keyCount,
+                                   len(keys),
                                    0,
                                    database.indexInterval,
-                                   database.keys,
+                                   self.layout,
+                                   self.blockSize,
+                                   0,
+                                   list(keys),
                                    [])
         self.saveArchiveIndex()
         self._buildDataFormat()
+        self.dataSize = 0
         return self
 
+    def _getDataFileSize(self) -> int:
+        try:
+            return os.path.getsize(self.fileUtil.getArchiveFilePath(self.archive, True))
+        except FileNotFoundError:
+            return 0
+
+    def _hasRecords(self) -> bool:
+        return self.dataSize > 0
+
+    def getStoredSize(self) -> tuple:
+        """Changes whenever records are written, sessions compare it to detect writes from other processes"""
+        return self.dataSize, self.archive.indexCount
+
+    def _getDataFilePaths(self) -> list[str]:
+        return [self.fileUtil.getArchiveFilePath(self.archive, True)]
+
+    def _openDataFile(self) -> StriderArchiveIO:
+        """Opens the data file for appending and caches the last entry timestamp"""
+        self.dataFile = StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True), "a+b"), self.dataFormat)
+        self.dataFile.file.seek(0, os.SEEK_END)
+        self.dataSize = self.dataFile.file.tell()
+        tornSize = max(self.dataSize - self._getSchemaStart(), 0) % self.dataFile.recordSize
+        if tornSize:
+            # a torn record from an interrupted write
+            self.dataSize -= tornSize
+            self.dataFile.file.truncate(self.dataSize)
+            self._trimIndex()
+        if self.dataSize < self.dataFile.recordSize and not self.archive.schemas:
+            self.lastEntryTimestamp = self.archive.minRange
+        else:
+            # the last record can predate the last key
+            self.dataFile.file.seek(self.dataSize - struct.calcsize(self._getSchemaFormat(self._getSchemaKeyCount(self.dataSize - 1))))
+            self.lastEntryTimestamp = struct.unpack("I", self.dataFile.file.read(4))[0]
+        return self.dataFile
+
+    def _writeBuffer(self) -> None:
+        self.dataFile.file.write(self.writeBuffer)
+        self.dataFile.file.flush()
+        if self.metrics is not None:
+            self.metrics.count("bytesWritten", len(self.writeBuffer))
+
+    def _closeDataFile(self) -> None:
+        self.dataFile.file.close()
+        self.dataFile = None
+
+    def _storeRecords(self, records: tuple) -> None:
+        """Replaces the archive data with `records`"""
+        with StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True)+".new", "wb"), self.archiveRecordFormat) as archiveFile:
+            archiveFile.writeRecords(records)
+        os.replace(self.fileUtil.getArchiveFilePath(self.archive, True)+".new", self.fileUtil.getArchiveFilePath(self.archive, True))
+
+    def flush(self) -> None:
+        """Writes buffered records to the data file and saves the index"""
+        if self.writeBuffer:
+            self._writeBuffer()
+            if self.metrics is not None:
+                self.metrics.count("recordsWritten", len(self.writeBuffer) // self.recordStruct.size)
+            self.writeBuffer.clear()
+            self.appendArchiveIndex()
+            self._appendSummaries()
+
+    def sync(self) -> None:
+        """Flushes and forces the index and data files to disk"""
+        self.flush()
+        for path in [self.fileUtil.getArchiveFilePath(self.archive), self.fileUtil.getSummaryFilePath(self.archive), *self._getDataFilePaths()]:
+            if os.path.exists(path):
+                with open(path, "rb+") as archiveFile:
+                    os.fsync(archiveFile.fileno())
+
+    def close(self) -> None:
+        """Flushes and releases the data file handle"""
+        if self.dataFile is not None:
+            self.flush()
+            self._closeDataFile()
+
     def saveArchiveIndex(self) -> None:
-        """Saves archive
-        TODO rename current file to .old"""
-        with StriderFileIO(open(self.fileUtil.getArchiveFilePath(self.archive), "wb")) as archiveFile:
+        """Rewrites the whole archive index file and summarizes every index entry again"""
+        self._writeArchiveIndex()
+        self._saveSummaries()
+
+    def _writeArchiveIndex(self) -> None:
+        """Rewrites the whole archive index file. The new file is written next to the current one and renamed over it"""
+        newPath = self.fileUtil.getArchiveFilePath(self.archive)+".new"
+        with StriderFileIO(open(newPath, "wb")) as archiveFile:
             archiveFile.writeStruct(self.archive)
+            self.indicesOffset = archiveFile.file.tell()
+            archiveFile.writeIndexArrays(self.indexTimestamps, self.indexOffsets)
+            self.savedIndexCount = self.archive.indexCount
+        os.replace(newPath, self.fileUtil.getArchiveFilePath(self.archive))
+        self.indexStat = StriderFileUtil.statFile(self.fileUtil.getArchiveFilePath(self.archive))
 
-    def getIndex(self, time: int) -> Union[None | ArchiveIndex]:
-        index: ArchiveIndex
-        last = None
-        if time < self.archive.minRange:
-            return None
+    def appendArchiveIndex(self) -> None:
+        """Appends indices added since the last save and then patches the header index count.
+        Entries past the stored count are ignored when loading, so an interrupted append leaves the previous index readable"""
+        if self.savedIndexCount == self.archive.indexCount:
+            return
         
-        for index in self.archive.indices:
-            if index.timestamp > time:
-                return last
-            last = index
+        with StriderFileIO(open(self.fileUtil.getArchiveFilePath(self.archive), "r+b")) as archiveFile:
+            archiveFile.file.seek(self.indicesOffset + self.savedIndexCount * INDEX_SIZE)
+            archiveFile.writeIndexArrays(self.indexTimestamps[self.savedIndexCount:], self.indexOffsets[self.savedIndexCount:])
+            archiveFile.file.flush()
+            archiveFile.file.seek(StriderFileIO.fieldOffset(self.archive, "indexCount"))
+            archiveFile.file.write(struct.pack("H", self.archive.indexCount))
+        self.savedIndexCount = self.archive.indexCount
+        self.indexStat = StriderFileUtil.statFile(self.fileUtil.getArchiveFilePath(self.archive))
 
-        return last
+    def refresh(self) -> bool:
+        """Picks up index entries and records appended by another process, only the new index entries are read.
+        Returns False if the archive was rewritten (its index file replaced, a key added), it must then be loaded again"""
+        indexPath = self.fileUtil.getArchiveFilePath(self.archive)
+        indexStat = StriderFileUtil.statFile(indexPath)
+        if indexStat is None or self.indexStat is None or indexStat[0] != self.indexStat[0]:
+            return False
+        if indexStat != self.indexStat:
+            with StriderFileIO(open(indexPath, "rb")) as archiveFile:
+                archive = self._readArchiveIndex(archiveFile)
+                if archive.keyCount != self.archive.keyCount or archive.indexCount < self.savedIndexCount:
+                    return False
+                archiveFile.file.seek(self.indicesOffset + self.savedIndexCount * INDEX_SIZE)
+                timestamps, offsets = archiveFile.readIndexArrays(archive.indexCount - self.savedIndexCount)
+            self.indexTimestamps.extend(timestamps)
+            self.indexOffsets.extend(offsets)
+            self.archive.indexCount = self.savedIndexCount = len(self.indexTimestamps)
+            self.lastIndexTimestamp = self.indexTimestamps[-1] if self.indexTimestamps else 0
+            self.indexStat = indexStat
+            self._readSummaries()
+        # records being written are left out until complete
+        dataSize = self._getDataFileSize()
+        self.dataSize = dataSize - max(dataSize - self._getSchemaStart(), 0) % self.dataRecordSize
+        return True
 
-    def addIndex(self, index: ArchiveIndex) -> None:
-        """TODO somthing"""
-        self.archive.indices.append(index)
-        self.archive.indexCount = len(self.archive.indices)
+    def _getSummaryStruct(self) -> struct.Struct:
+        return struct.Struct(SUMMARY_HEADER + SUMMARY_FIELD * len(self.archiveRecordFormat))
 
-    def setIndexInteval(self, inteval: int) -> None:
-        indices = []
-        last = self.archive.minRange
-        records = None
-        with StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb"), self.archiveRecordFormat) as archiveFile:
-            records = archiveFile.readAllRecords()
-        
-        if records:
-            for i, record in enumerate(records):
-                if (record[0] - last) >= inteval:
-                    indices.append(ArchiveIndex(record[0], (i * archiveFile.recordSize), 1))
-                    last = record[0]
+    def _readSummaries(self) -> None:
+        """Reads the saved summaries past the loaded ones, entries that do not match their index entry are ignored"""
+        path = self.fileUtil.getSummaryFilePath(self.archive)
+        if not os.path.exists(path):
+            return
+        summaryStruct = self._getSummaryStruct()
+        with open(path, "rb") as summaryFile:
+            summaryFile.seek(len(self.summaries) * summaryStruct.size)
+            data = summaryFile.read()
 
-            self.archive.indexInterval = inteval
-            self.archive.indexCount = len(indices)
-            self.archive.indices = indices
-            self.saveArchiveIndex()
+        casts = [float if _type == "f" else bool if _type == "?" else int for _type in self.archiveRecordFormat]
+        for entry in summaryStruct.iter_unpack(data[:len(data) - len(data) % summaryStruct.size]):
+            i = len(self.summaries)
+            if i >= len(self.indexOffsets) or entry[:2] != (self.indexTimestamps[i], self.indexOffsets[i]):
+                break
+            summary = []
+            for fieldI, cast in enumerate(casts):
+                accumulator = Accumulator()
+                accumulator.count = entry[2]
+                low, high, total, last = entry[3 + fieldI * 4:7 + fieldI * 4]
+                accumulator.min, accumulator.max, accumulator.last = cast(low), cast(high), cast(last)
+                accumulator.sum = total if cast is float else int(total)
+                summary.append(accumulator)
+            self.summaries.append(summary)
+        self.savedSummaryCount = len(self.summaries)
 
+    def _packSummaries(self, start: int, end: int) -> bytes:
+        pack = self._getSummaryStruct().pack
+        return b"".join([pack(self.indexTimestamps[i], self.indexOffsets[i], self.summaries[i][0].count,
+                              *[value for accumulator in self.summaries[i] for value in (accumulator.min, accumulator.max, accumulator.sum, accumulator.last)])
+                         for i in range(start, end)])
 
-    def addKey(self, archiveKey: ArchiveKey) -> None:
+    def _appendSummaries(self) -> None:
+        """Saves the summaries of index entries followed by another entry, the last entry's summary changes as records are appended"""
+        count = min(len(self.summaries), len(self.indexOffsets) - 1)
+        if count <= self.savedSummaryCount:
+            return
+        path = self.fileUtil.getSummaryFilePath(self.archive)
+        with open(path, "r+b" if os.path.exists(path) else "wb") as summaryFile:
+            summaryFile.seek(self.savedSummaryCount * self._getSummaryStruct().size)
+            summaryFile.write(self._packSummaries(self.savedSummaryCount, count))
+            summaryFile.truncate()
+        self.savedSummaryCount = count
+
+    def _saveSummaries(self) -> None:
+        """Summarizes every index entry again and rewrites the summary file, after the index was rebuilt"""
+        self.summaries = []
+        self.savedSummaryCount = 0
+        if self.indexOffsets:
+            self._fillSummaries(len(self.indexOffsets))
+        self._writeSummaries()
+
+    def _writeSummaries(self) -> None:
+        """Rewrites the summary file with the summaries of index entries followed by another entry"""
+        path = self.fileUtil.getSummaryFilePath(self.archive)
+        count = min(len(self.summaries), len(self.indexOffsets) - 1)
+        with open(path+".new", "wb") as summaryFile:
+            if count > 0:
+                summaryFile.write(self._packSummaries(0, count))
+        os.replace(path+".new", path)
+        self.savedSummaryCount = max(count, 0)
+
+    def _getSegmentOffsets(self, i: int) -> tuple[int, int]:
+        """Data file byte range of the records of the `i`th index entry"""
+        return self.indexOffsets[i], self.indexOffsets[i + 1] if i + 1 < len(self.indexOffsets) else self.dataSize
+
+    def _readSegmentColumns(self, i: int) -> list:
+        """Values of each record field of the `i`th index entry's records"""
         with StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb"), self.archiveRecordFormat) as archiveFile:
-            records = archiveFile.readAllRecords()
+            archiveFile.mapFile()
+            records = []
+            for startOffset, endOffset, keyCount in self._iterSchemas(*self._getSegmentOffsets(i)):
+                records.extend(self._decodeRecords(archiveFile, startOffset, endOffset, keyCount))
+            return list(zip(*records))
 
-        with StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True)+".new", "w+b"), self.archiveRecordFormat) as archiveFile:
-            archiveFile.setRecordFormat(self.archiveRecordFormat+ARCHIVE_KEY_TYPES(archiveKey.type).name)
-            records = [(*item, 0) for item in records]
-            archiveFile.writeRecords(records)
+    def _fillSummaries(self, count: int) -> None:
+        """Summarizes the index entries without a summary up to entry `count` from the data file"""
+        for i in range(len(self.summaries), count):
+            columns = self._readSegmentColumns(i)
+            if not columns:
+                return
+            self.summaries.append([Accumulator() for _ in columns])
+            for accumulator, values in zip(self.summaries[-1], columns):
+                accumulator.addValues(values)
+
+    def _summarizeRecords(self, columns: list, indexCount: int, dataSize: int) -> None:
+        """Folds appended records, given as the values of each record field, into the summaries of their index entries.
+        `indexCount` and `dataSize` are the index entry count and data size before the records were indexed"""
+        bounds = [(offset - dataSize) // self.dataRecordSize for offset in self.indexOffsets[indexCount:]]
+        for i, first, last in zip(range(indexCount - 1, len(self.indexOffsets)), [0, *bounds], [*bounds, len(columns[0])]):
+            # records before the first index entry are not summarized
+            if i < 0 or first == last:
+                continue
+            if i == len(self.summaries):
+                self.summaries.append([Accumulator() for _ in columns])
+            for accumulator, values in zip(self.summaries[i], columns):
+                _accumulate(accumulator, values[first:last])
+
+    def _splitSummarized(self, start: int, end: int, select: Callable[[list[Accumulator]], bool]) -> Iterator[Union[tuple[int, int], list[Accumulator]]]:
+        """Splits `start` to `end` into the summaries of the index entries inside it chosen by `select` and `(start, end)` time ranges around them, in time order"""
+        position = start
+        i = max(bisect_right(self.indexTimestamps, start) - 1, 0)
+        while i < len(self.summaries) and self.indexTimestamps[i] < end:
+            timestamps = self.summaries[i][0]
+            # the entry's records must not share a timestamp with the records of its neighbours, these are read by time
+            if (start <= timestamps.min and timestamps.max < end
+                    and (i == 0 or self.summaries[i - 1][0].max < self.indexTimestamps[i])
+                    and (i + 1 == len(self.indexTimestamps) or timestamps.max < self.indexTimestamps[i + 1])
+                    and select(self.summaries[i])):
+                if position < timestamps.min:
+                    yield position, timestamps.min
+                if self.metrics is not None:
+                    self.metrics.count("summaryHits")
+                yield self.summaries[i]
+                # no records lie between the entry's and the next entry's, the last entry's summary holds every record after it
+                position = self.indexTimestamps[i + 1] if i + 1 < len(self.indexTimestamps) else end
+            i += 1
+        if position < end:
+            yield position, end
 
-        self.fileUtil.replaceArchive(self.archive, True)
+    def iterSummarized(self, start: int, end: int, bucket: int, chunkSize: int = CHUNK_SIZE) -> Iterator[Union[tuple, list[Accumulator]]]:
+        """Yields the records from `start` to `end` in time order for aggregation into `bucket` second buckets.
+        Index entries whose records all fall in one bucket are yielded as their summary, a list with an accumulator per record field,
+        the records around them are read and yielded in chunks of record tuples, see `iterRecords`"""
+        self.flush()
+        for item in self._splitSummarized(start, end, lambda summary: summary[0].min - summary[0].min % bucket == summary[0].max - summary[0].max % bucket):
+            if isinstance(item, tuple):
+                yield from self.iterRecords(*item, chunkSize)
+            else:
+                yield item
+
+    def getIndex(self, start: int, end: int) -> tuple[int, int]:
+        """Returns the data file byte range `[startOffset, endOffset)` that holds every record from `start` to `end`.
+        Index entries always point at the first record with their timestamp"""
+        first = bisect_right(self.indexTimestamps, start) - 1
+        startOffset = self.indexOffsets[first] if first >= 0 else 0
+
+        i = bisect_left(self.indexTimestamps, end)
+        endOffset = self.indexOffsets[i] if i < len(self.indexOffsets) else self.dataSize
+
+        if self.metrics is not None:
+            self.metrics.count("indexEntriesVisited", i - max(first, 0))
+        return startOffset, endOffset
+
+    def addIndex(self, timestamp: int, offset: int) -> None:
+        self.indexTimestamps.append(timestamp)
+        self.indexOffsets.append(offset)
+        self.archive.indexCount = len(self.indexTimestamps)
+
+    def setIndexInteval(self, inteval: int, chunkSize: int = CHUNK_SIZE) -> None:
+        """Re-indexes the archive with an entry every `inteval` seconds. The data file is streamed `chunkSize` records at a time, see `_iterTimestamps`,
+        the new index is written next to the current one and renamed over it"""
+        self.flush()
+        self.indexTimestamps = array("I")
+        self.indexOffsets = array("I")
+        last = self.archive.minRange
+        for timestamps, offsets in self._iterTimestamps(chunkSize):
+            i = bisect_left(timestamps, last + inteval)
+            while i < len(timestamps):
+                self.addIndex(timestamps[i], offsets[i])
+                last = timestamps[i]
+                i = bisect_left(timestamps, last + inteval, i + 1)
+        self.lastIndexTimestamp = last if self.dataSize else 0
+
+        self.archive.indexInterval = inteval
+        self.archive.indexCount = len(self.indexTimestamps)
+        self.saveArchiveIndex()
+
+    def _iterTimestamps(self, chunkSize: int = CHUNK_SIZE) -> Iterator[tuple[list, range]]:
+        """Yields the timestamps of up to `chunkSize` records at a time and their data file offsets, in order.
+        Only the timestamps are decoded, the rest of each record is skipped as padding"""
+        if not self.dataSize:
+            return
+        with open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb") as dataFile:
+            for startOffset, endOffset, keyCount in list(self._iterSchemas(0, self.dataSize)):
+                recordSize = struct.calcsize(self._getSchemaFormat(keyCount))
+                timestampStruct = struct.Struct(f"I{recordSize - 4}x")
+                dataFile.seek(startOffset)
+                for offset in range(startOffset, endOffset, chunkSize * recordSize):
+                    data = dataFile.read(min(chunkSize * recordSize, endOffset - offset))
+                    data = data[:len(data) - len(data) % recordSize]
+                    yield [timestamp for timestamp, in timestampStruct.iter_unpack(data)], range(offset, offset + len(data), recordSize)
+
+    def addKey(self, archiveKey: ArchiveKey) -> None:
+        """Adds a key without touching the data file, records already written read back with the key's default value.
+        Only the index and summary files are rewritten"""
+        self.close()
+        if self.dataSize > self._getSchemaStart():
+            self.archive.schemas.append(ArchiveSchema(self.dataSize, self.archive.keyCount))
+            self.archive.schemaCount = len(self.archive.schemas)
+            self.archive.revision = CURRENT_REVISION
 
         self.archive.keys.append(archiveKey)
         self.archive.keyCount = len(self.archive.keys)
-        self.saveArchiveIndex()
+        self._buildDataFormat()
+        self._writeArchiveIndex()
+        default = self._getDefaults(self.archive.keyCount - 1)[0]
+        for summary in self.summaries:
+            accumulator = Accumulator()
+            accumulator.count = summary[0].count
+            accumulator.min = accumulator.max = accumulator.last = default
+            accumulator.sum = default
+            summary.append(accumulator)
+        self._writeSummaries()
+
 
+    def getLastEntryTimestamp(self) -> Union[None | int]:
+        """Timestamp of the last record written to the archive"""
+        if self.dataFile is None:
+            self._openDataFile()
+        return self.lastEntryTimestamp if self._hasRecords() else None
 
-    def readRecords(self, start: int, end: int, key: Union[None | str] = None, raw: bool =  False) -> list:
-        """
-        TODO smarter read strategy"""
+    def readRecords(self, start: int, end: int, key: Union[None | str] = None, raw: bool =  False, where: tuple = ()) -> list:
+        """Reads records from `start` to `end`. The index narrows the byte range, which is then binary searched and decoded in one pass on the memory mapped data file.
+        Reads inside the in-memory tail are served from it, see `setTail`. Only records matching every `where` comparison are returned, see `_readMatching`"""
+        tailRecords = self._readTail(start, end)
+        if tailRecords is None:
+            self.flush()
+        elif self.metrics is not None:
+            self.metrics.count("tailHits")
         if key:
-            records = {}
             for i, archivekey in enumerate(self.archive.keys):
                 if archivekey.name == key:
-                    keyI = i+1
+                    if where:
+                        return {record[0]: record[i+1] for record in self._readMatching(start, end, where, tailRecords)}
+                    if tailRecords is not None:
+                        return {record[0]: record[i+1] for record in tailRecords}
+                    return self._readKey(start, end, i+1)
+            return {}
+
+        if where:
+            rawRecords = self._readMatching(start, end, where, tailRecords)
         else:
-            records = []
-            #recordObj = construct_slots(["time", *[key.name for key in self.archive.keys]])
-            recordTuple = namedtuple('Record', 'timestamp '+' '.join([key.name for key in self.archive.keys]))
+            rawRecords = self._readRange(start, end) if tailRecords is None else tailRecords
+        if raw:
+            return list(rawRecords)
+        else:
+            return self.makeRecords(rawRecords)
+
+    def makeRecords(self, rawRecords: tuple) -> list:
+        """Record tuples as `Record` namedtuples with a field per archive key"""
+        #recordObj = construct_slots(["time", *[key.name for key in self.archive.keys]])
+        recordTuple = namedtuple('Record', 'timestamp '+' '.join([key.name for key in self.archive.keys]))
+        return [tuple.__new__(recordTuple, record) for record in rawRecords]
+
+    def _readRange(self, start: int, end: int) -> tuple:
+        """Record tuples from `start` to `end`"""
+        startOffset, endOffset = self.getIndex(start, end)
+        if endOffset <= startOffset:
+            return ()
+        
+        with StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb"), self.archiveRecordFormat) as archiveFile:
+            archiveFile.mapFile()
+            parts = [self._decodeRecords(archiveFile, *recordRange) for recordRange in self._findRecordRanges(archiveFile, start, end, startOffset, endOffset)]
+            return parts[0] if len(parts) == 1 else tuple(record for part in parts for record in part)
+
+    def _countRead(self, byteCount: int, recordCount: int) -> None:
+        self.metrics.count("bytesRead", byteCount)
+        self.metrics.count("recordsScanned", recordCount)
+
+    def _findRecordRanges(self, archiveFile: StriderArchiveIO, start: int, end: int, startOffset: int, endOffset: int) -> Iterator[tuple[int, int, int]]:
+        """Narrows `[startOffset, endOffset)` to the records from `start` to `end` in each schema, yields their range and key count.
+        The mapped `archiveFile` is left set to the record format of the yielded range"""
+        for schemaStart, schemaEnd, keyCount in self._iterSchemas(startOffset, endOffset):
+            archiveFile.setRecordFormat(self._getSchemaFormat(keyCount))
+            firstOffset, lastOffset = archiveFile.findRecordRange(start, end, schemaStart, schemaEnd)
+            if firstOffset < lastOffset:
+                yield firstOffset, lastOffset, keyCount
+
+    def _decodeRecords(self, archiveFile: StriderArchiveIO, startOffset: int, endOffset: int, keyCount: int) -> tuple:
+        """Decodes the mapped records in `[startOffset, endOffset)` written with the first `keyCount` keys, later keys get their default value"""
+        if self.metrics is not None:
+            self._countRead(endOffset - startOffset, (endOffset - startOffset) // struct.calcsize(self._getSchemaFormat(keyCount)))
+        if keyCount == self.archive.keyCount:
+            archiveFile.setRecordFormat(self.archiveRecordFormat)
+            return archiveFile.readRecordRange(startOffset, endOffset)
+        archiveFile.setRecordFormat(self._getSchemaFormat(keyCount))
+        defaults = self._getDefaults(keyCount)
+        return tuple(record + defaults for record in archiveFile.readRecordRange(startOffset, endOffset))
+
+    def _decodeArray(self, archiveFile: StriderArchiveIO, startOffset: int, endOffset: int, keyCount: int, dtype: "numpy.dtype") -> "numpy.ndarray":
+        """Structured array version of `_decodeRecords`"""
+        if self.metrics is not None:
+            self._countRead(endOffset - startOffset, (endOffset - startOffset) // struct.calcsize(self._getSchemaFormat(keyCount)))
+        if keyCount == self.archive.keyCount:
+            return archiveFile.readRecordArray(startOffset, endOffset, dtype)
+        schemaDtype = StriderArchiveIO.getRecordDtype(self._getSchemaFormat(keyCount), list(dtype.names[:keyCount + 1]))
+        schemaRecords = archiveFile.readRecordArray(startOffset, endOffset, schemaDtype)
+        records = numpy.zeros(len(schemaRecords), dtype)
+        for name in schemaDtype.names:
+            records[name] = schemaRecords[name]
+        return records
+
+    def iterRecords(self, start: int, end: int, chunkSize: int = CHUNK_SIZE) -> Iterator[tuple]:
+        """Yields the record tuples from `start` to `end` in chunks of up to `chunkSize` records. 
+        The data file stays open until the generator is exhausted or closed"""
+        self.flush()
+        startOffset, endOffset = self.getIndex(start, end)
+        if endOffset <= startOffset:
+            return
+        
+        with StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb"), self.archiveRecordFormat) as archiveFile:
+            archiveFile.mapFile()
+            for startOffset, endOffset, keyCount in list(self._findRecordRanges(archiveFile, start, end, startOffset, endOffset)):
+                chunkBytes = chunkSize * struct.calcsize(self._getSchemaFormat(keyCount))
+                for offset in range(startOffset, endOffset, chunkBytes):
+                    yield self._decodeRecords(archiveFile, offset, min(offset + chunkBytes, endOffset), keyCount)
+
+    def iterArrays(self, start: int, end: int, chunkSize: int = CHUNK_SIZE) -> Iterator["numpy.ndarray"]:
+        """Yields the records from `start` to `end` as structured arrays of up to `chunkSize` records, see `readArray`"""
+        self.flush()
+        dtype = StriderArchiveIO.getRecordDtype(self.archiveRecordFormat, ["timestamp", *[key.name for key in self.archive.keys]])
+        startOffset, endOffset = self.getIndex(start, end)
+        if endOffset <= startOffset:
+            return
         
-        index = self.getIndex(start)
-        #print(self.archive.index, start, index)
         with StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb"), self.archiveRecordFormat) as archiveFile:
-            if index:
-                archiveFile.file.seek(index.offset)
-
-            lookAhead = True
-            read = True
-            while read:
-                if lookAhead:
-                    nextRecords = archiveFile.readRecords(50)
-                    if nextRecords is None:
-                        lookAhead = False
-
-                if nextRecords is None:
-                    nextRecords = [archiveFile.readRecord()]
-                    if nextRecords[0] is None:
-                        break
-
-                for record in nextRecords:
-                    if record[0] >= start:
-                        if record[0] >= end:
-                            read = False
-                            break
-                        else:
-                            if key:
-                                records[record[0]] = record[keyI]
-                            else:
-                                records.append(record)
-
-            if raw or key:
+            archiveFile.mapFile()
+            for startOffset, endOffset, keyCount in list(self._findRecordRanges(archiveFile, start, end, startOffset, endOffset)):
+                chunkBytes = chunkSize * struct.calcsize(self._getSchemaFormat(keyCount))
+                for offset in range(startOffset, endOffset, chunkBytes):
+                    yield self._decodeArray(archiveFile, offset, min(offset + chunkBytes, endOffset), keyCount, dtype)
+
+    def _readKey(self, start: int, end: int, keyI: int) -> dict:
+        """`{timestamp: value}` of the `keyI` record field from `start` to `end`"""
+        return {record[0]: record[keyI] for record in self._readRange(start, end)}
+
+    def readArray(self, start: int, end: int, where: tuple = ()) -> "numpy.ndarray":
+        """Reads records from `start` to `end` as a NumPy structured array with a `timestamp` field followed by the archive keys,
+        only records matching every `where` comparison are kept"""
+        dtype = StriderArchiveIO.getRecordDtype(self.archiveRecordFormat, ["timestamp", *[key.name for key in self.archive.keys]])
+        tailRecords = self._readTail(start, end)
+        if tailRecords is not None:
+            records = numpy.array(tailRecords, dtype)
+            if not where:
                 return records
-            else:
-                return [tuple.__new__(recordTuple, record) for record in records]
+            bound = bindWhere(where, [key.name for key in self.archive.keys])
+            return records[maskArray(records, bound)] if bound is not None else records[:0]
+        self.flush()
+        if where:
+            return self._readMatchingArray(start, end, where, dtype)
+        return self._readArray(start, end, dtype)
+
+    def _readMatchingArray(self, start: int, end: int, where: tuple, dtype: "numpy.dtype") -> "numpy.ndarray":
+        """Records from `start` to `end` matching every `where` comparison. Index entries whose summary rules a comparison out are skipped,
+        the others are read as structured arrays and filtered with a vectorized mask"""
+        bound = bindWhere(where, [key.name for key in self.archive.keys])
+        if bound is None:
+            return numpy.zeros(0, dtype)
+        arrays = []
+        for item in self._splitSummarized(start, end, lambda summary: not summaryMatches(summary, bound)):
+            if isinstance(item, tuple):
+                records = self._readArray(*item, dtype)
+                arrays.append(records[maskArray(records, bound)])
+        if not arrays:
+            return numpy.zeros(0, dtype)
+        return numpy.concatenate(arrays) if len(arrays) > 1 else arrays[0]
+
+    def _readMatching(self, start: int, end: int, where: tuple, tailRecords: Union[None | list] = None) -> list:
+        """Record tuples from `start` to `end` matching every `where` comparison, from `tailRecords` if set.
+        Filtered on structured arrays if NumPy is available, record by record otherwise"""
+        bound = bindWhere(where, [key.name for key in self.archive.keys])
+        if bound is None:
+            return []
+        if tailRecords is not None:
+            return filterRecords(tailRecords, bound)
+        if numpy is not None:
+            dtype = StriderArchiveIO.getRecordDtype(self.archiveRecordFormat, ["timestamp", *[key.name for key in self.archive.keys]])
+            return self._readMatchingArray(start, end, where, dtype).tolist()
+        return [record for item in self._splitSummarized(start, end, lambda summary: not summaryMatches(summary, bound)) if isinstance(item, tuple)
+                for record in filterRecords(self._readRange(*item), bound)]
+
+    def _readArray(self, start: int, end: int, dtype: "numpy.dtype") -> "numpy.ndarray":
+        startOffset, endOffset = self.getIndex(start, end)
+        if endOffset <= startOffset:
+            return numpy.zeros(0, dtype)
+        
+        with StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb"), self.archiveRecordFormat) as archiveFile:
+            archiveFile.mapFile()
+            arrays = [self._decodeArray(archiveFile, *recordRange, dtype) for recordRange in self._findRecordRanges(archiveFile, start, end, startOffset, endOffset)]
+        if not arrays:
+            return numpy.zeros(0, dtype)
+        return numpy.concatenate(arrays) if len(arrays) > 1 else arrays[0]
+
+    def convert(self, handlerClass: type["ArchiveHandler"]) -> "ArchiveHandler":
+        """Rewrites the archive in the layout of `handlerClass`, returns the new handler"""
+        self.close()
+        records = self._readRange(0, 2**32 - 1)
+        oldPaths = self._getDataFilePaths()
+
+        converted = handlerClass(self.fileUtil)
+        converted.archive = self.archive
+        converted.archive.revision = CURRENT_REVISION
+        converted.archive.layout = converted.layout
+        # every record is rewritten with every key
+        converted.archive.schemas = []
+        converted.archive.schemaCount = 0
+        converted._buildDataFormat()
+        converted.archive.blockSize = converted.blockSize
+        converted._storeRecords(records)
+        converted.dataSize = converted._getDataFileSize()
+        converted.setIndexInteval(self.archive.indexInterval)
+
+        for path in set(oldPaths) - set(converted._getDataFilePaths()):
+            if os.path.exists(path):
+                os.remove(path)
+        return converted
+
+    def _indexRecords(self, timestamps: list) -> None:
+        """Indexes records appended after the current end of the data file, `timestamps` are in order"""
+        i = bisect_left(timestamps, self.lastIndexTimestamp + self.archive.indexInterval)
+        while i < len(timestamps):
+            self.addIndex(timestamps[i], self.dataSize + (i * self.dataRecordSize))
+            self.lastIndexTimestamp = timestamps[i]
+            i = bisect_left(timestamps, self.lastIndexTimestamp + self.archive.indexInterval, i + 1)
+        self.dataSize += len(timestamps) * self.dataRecordSize
 
     def writeRecords(self, records: list) -> None:
-        with StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True), "a+b"), self.archiveRecordFormat) as archiveFile:
-            if archiveFile.file.tell() == 0:
-                self.lastEntryTimestamp = self.archive.minRange
-            else:
-                archiveFile.file.seek(-archiveFile.recordSize, 1)
-                lastRecord = archiveFile.readRecord()
-                self.lastEntryTimestamp = lastRecord[0]
+        """Appends records to the archive. Records are packed and checked before anything is buffered,
+        so a rejected batch leaves the archive and its index untouched"""
+        if self.dataFile is None:
+            self._openDataFile()
+        pack = self.recordStruct.pack
+        recordBytes = b"".join([pack(*record) for record in records])
 
-            for i, record in enumerate(records):
-                if record[0] < self.lastEntryTimestamp:
-                    raise SequenceViolation()
+        lastEntryTimestamp = self.lastEntryTimestamp
+        for record in records:
+            if record[0] < lastEntryTimestamp:
+                raise SequenceViolation()
+            lastEntryTimestamp = record[0]
 
-                if (record[0] - self.lastIndexTimestamp) >= self.archive.indexInterval:
-                    #print(record[0], self.lastIndexTimestamp, record[0] - self.lastIndexTimestamp, self.archive.indexInterval)
-                    index = ArchiveIndex(record[0], archiveFile.file.tell() + (i * archiveFile.recordSize), 1)
-                    self.addIndex(index)
-                    self.lastIndexTimestamp = index.timestamp
+        columns = list(zip(*records))
+        self._appendRecords(recordBytes, list(columns[0]) if columns else [], columns)
 
-            self.lastEntryTimestamp = record[0]
-            archiveFile.writeRecords(records)
+    def writeArray(self, records: "numpy.ndarray") -> None:
+        """Appends a structured array of records, see `readArray` for its dtype. The array is packed in one step"""
+        if self.dataFile is None:
+            self._openDataFile()
+        dtype = StriderArchiveIO.getRecordDtype(self.archiveRecordFormat, ["timestamp", *[key.name for key in self.archive.keys]])
+        if records.dtype != dtype:
+            raise ValueError("Record array does not match the archive format")
+        if not len(records):
+            return
+
+        timestamps = records["timestamp"]
+        if timestamps[0] < self.lastEntryTimestamp or (numpy.diff(timestamps.astype("i8")) < 0).any():
+            raise SequenceViolation()
+        self._appendRecords(records.tobytes(), timestamps.tolist(), [records[name] for name in records.dtype.names])
+
+    def _appendRecords(self, recordBytes: bytes, timestamps: list, columns: list) -> None:
+        """Indexes, summarizes and buffers checked records packed in the archive record format, `columns` holds the values of each record field"""
+        if self.wal is not None:
+            self.wal.append(self.archiveRecordFormat, recordBytes)
+        previousTimestamp = self.lastEntryTimestamp
+        indexCount, dataSize = len(self.indexOffsets), self.dataSize
+        if len(self.summaries) < indexCount and not self.writeBuffer:
+            # entries loaded without a summary, from an older archive or a summary file that lags behind
+            self._fillSummaries(indexCount)
+        self._indexRecords(timestamps)
+        if timestamps and len(self.summaries) >= indexCount:
+            self._summarizeRecords(columns, indexCount, dataSize)
+        if not self.writeBuffer:
+            self.bufferTime = time.monotonic()
+        self.writeBuffer += recordBytes
+        self.lastEntryTimestamp = timestamps[-1] if timestamps else previousTimestamp
+        if self.tail is not None:
+            self._fillTail(recordBytes, len(timestamps), previousTimestamp)
 
-            self.saveArchiveIndex()
+        if len(self.writeBuffer) >= self.bufferSize * self.recordStruct.size or (self.bufferAge and time.monotonic() - self.bufferTime >= self.bufferAge):
+            self.flush()
@@ -0,0 +1,387 @@
+from array import array
+from bisect import bisect_left
+from typing import Iterator, Self, Union, BinaryIO
+import os
+import struct
+
+from strider.io import StriderArchiveIO, StriderFileUtil, numpy
+from strider.archive import ArchiveHandler, CHUNK_SIZE
+from strider.aggregate import Accumulator
+from strider.compression import encodeBlock, decodeBlock, decodeColumn, getBlockHeader, FIRST_VALUE_BITS
+from strider.exceptions import *
+from strider.datatypes import DatabaseArchive, ArchiveKey, ARCHIVE_LAYOUT
+
+# records per block of new block archives
+BLOCK_SIZE = 256
+# open block file header, the data file offset its block is encoded at and the key count of its records
+OPEN_BLOCK_HEADER = struct.Struct("=IH")
+
+
+class BlockArchiveHandler(ArchiveHandler):
+    """Compressed archive, records are stored in blocks of `blockSize` records with delta-of-delta encoded integers and XOR encoded floats.
+    Every block has an index entry with its first timestamp and offset. Records of the last, open, block are appended uncompressed to the
+    open block file and only encoded once `blockSize` of them fill the block, blocks in the data file are never rewritten.
+    Blocks written before a key was added keep their columns, the key reads back with its default value"""
+    layout: ARCHIVE_LAYOUT = ARCHIVE_LAYOUT.block
+    blockSize: int = BLOCK_SIZE
+    # records of the open block while the data file is open, its index entry points at the end of the data file
+    openRecords: list
+    openFile: Union[None | BinaryIO] = None
+    # open block file size when the archive was last refreshed
+    openSize: int = 0
+    # the open block file was forced to disk, its records are only dropped once the data file holding their block is
+    openSynced: bool = False
+
+    def __init__(self, fileUtil: StriderFileUtil) -> None:
+        super().__init__(fileUtil)
+        self.openRecords = []
+
+    def load(self, archive: DatabaseArchive) -> Self:
+        super().load(archive)
+        if not self.archive.blockSize:
+            raise DatabaseCorrupt(f"Archive {self.archive.index} has no block size")
+        return self
+
+    def _openDataFile(self) -> StriderArchiveIO:
+        """Opens the data file and the open block file. Blocks written after the last indexed one are indexed,
+        a torn block left by an interrupted write is truncated. The open block file is only kept if it starts at the end of the data file,
+        otherwise its records were encoded in a block before it was emptied"""
+        path = self.fileUtil.getArchiveFilePath(self.archive, True)
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        self.dataFile = StriderArchiveIO(open(path, "r+b"), self.dataFormat)
+
+        # the open block's entry is added back below if its records are still there
+        super()._trimIndex(bisect_left(self.indexOffsets, self._getDataFileSize()))
+        offset = self.indexOffsets[-1] if self.indexOffsets else 0
+        self.dataFile.file.seek(offset)
+        data = self.dataFile.file.read()
+        lastTimestamp = None
+        position = 0
+        while position < len(data):
+            try:
+                columns, nextPosition = self._decodeBlock(data, position, offset)
+            except (struct.error, ValueError, IndexError):
+                break
+            if position or not self.indexOffsets:
+                self.addIndex(columns[0][0], offset + position)
+            lastTimestamp = columns[0][-1]
+            position = nextPosition
+        self.dataSize = offset + position
+        self.dataFile.file.truncate(self.dataSize)
+        super()._trimIndex()
+        if lastTimestamp is None and self.indexOffsets:
+            # the block the scan started at was torn
+            columns = self._readSegmentColumns(len(self.indexOffsets) - 1)
+            lastTimestamp = columns[0][-1] if columns else None
+
+        self.openRecords = self._readOpenRecords()
+        if self.openRecords and self._getOpenKeyCount() != self.archive.keyCount:
+            # interrupted while a key was added
+            self._replaceOpenFile()
+        self.openFile = open(self.fileUtil.getOpenBlockFilePath(self.archive), "a+b")
+        if self.openRecords:
+            self.addIndex(self.openRecords[0][0], self.dataSize)
+            lastTimestamp = self.openRecords[-1][0]
+        else:
+            self._resetOpenFile()
+        self.appendArchiveIndex()
+
+        self.lastEntryTimestamp = lastTimestamp if lastTimestamp is not None else self.archive.minRange
+        return self.dataFile
+
+    def _closeDataFile(self) -> None:
+        super()._closeDataFile()
+        self.openFile.close()
+        self.openFile = None
+
+    def _getDataFilePaths(self) -> list[str]:
+        return [self.fileUtil.getArchiveFilePath(self.archive, True), self.fileUtil.getOpenBlockFilePath(self.archive)]
+
+    def _readOpenHeader(self) -> Union[None | tuple[int, int]]:
+        try:
+            with open(self.fileUtil.getOpenBlockFilePath(self.archive), "rb") as openFile:
+                header = openFile.read(OPEN_BLOCK_HEADER.size)
+        except FileNotFoundError:
+            return None
+        return OPEN_BLOCK_HEADER.unpack(header) if len(header) == OPEN_BLOCK_HEADER.size else None
+
+    def _getOpenKeyCount(self) -> int:
+        header = self._readOpenHeader()
+        return header[1] if header is not None else self.archive.keyCount
+
+    def _readOpenRecords(self) -> list:
+        """Records of the open block file, none if the file does not start at the end of the data file or at a block being written.
+        Records written before a key was added get its default value"""
+        try:
+            with open(self.fileUtil.getOpenBlockFilePath(self.archive), "rb") as openFile:
+                data = openFile.read()
+        except FileNotFoundError:
+            return []
+        if len(data) < OPEN_BLOCK_HEADER.size:
+            return []
+        offset, keyCount = OPEN_BLOCK_HEADER.unpack_from(data)
+        if (offset != self.dataSize and not (offset < self.dataSize and self._isTorn(offset))) or keyCount > self.archive.keyCount:
+            return []
+        recordStruct = struct.Struct(self._getSchemaFormat(keyCount))
+        # a torn record from an interrupted write is left out
+        end = len(data) - (len(data) - OPEN_BLOCK_HEADER.size) % recordStruct.size
+        records = recordStruct.iter_unpack(data[OPEN_BLOCK_HEADER.size:end])
+        if keyCount == self.archive.keyCount:
+            return list(records)
+        defaults = self._getDefaults(keyCount)
+        return [record + defaults for record in records]
+
+    def _isTorn(self, offset: int) -> bool:
+        """Whether the block at data file `offset` is incomplete, being written or left by an interrupted write"""
+        with open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb") as archiveFile:
+            archiveFile.seek(offset)
+            data = archiveFile.read(self.dataSize - offset)
+        try:
+            self._decodeBlock(data, 0, offset, (0,))
+        except (struct.error, ValueError, IndexError):
+            return True
+        return False
+
+    def _getOpenRecords(self) -> list:
+        """Records of the open block, read from the open block file unless the data file is open"""
+        return self.openRecords if self.dataFile is not None else self._readOpenRecords()
+
+    def _resetOpenFile(self, recordBytes: bytes = b"") -> None:
+        """Empties the open block file and starts it at the current end of the data file with `recordBytes`.
+        Records synced to the open block file are only dropped once the data file is synced too"""
+        if self.openSynced:
+            os.fsync(self.dataFile.file.fileno())
+            self.openSynced = False
+        self.openFile.truncate(0)
+        self.openFile.write(OPEN_BLOCK_HEADER.pack(self.dataSize, self.archive.keyCount) + recordBytes)
+        self.openFile.flush()
+
+    def _replaceOpenFile(self) -> None:
+        """Writes the open block's records in the current record format next to the open block file and renames it over it"""
+        path = self.fileUtil.getOpenBlockFilePath(self.archive)
+        with open(path+".new", "wb") as openFile:
+            openFile.write(OPEN_BLOCK_HEADER.pack(self.dataSize, self.archive.keyCount))
+            openFile.write(b"".join([self.recordStruct.pack(*record) for record in self.openRecords]))
+        os.replace(path+".new", path)
+
+    def _hasRecords(self) -> bool:
+        return self.dataSize > 0 or bool(self._getOpenRecords())
+
+    def getStoredSize(self) -> tuple:
+        return (*super().getStoredSize(), self.openSize)
+
+    def _trimIndex(self, count: Union[None | int] = None) -> None:
+        """The open block's entry points at the end of the data file, it is kept while the open block file holds its records"""
+        if count is None:
+            count = bisect_left(self.indexOffsets, self.dataSize)
+            openRecords = self._getOpenRecords()
+            if openRecords and count < len(self.indexOffsets) and (self.indexTimestamps[count], self.indexOffsets[count]) == (openRecords[0][0], self.dataSize):
+                count += 1
+        super()._trimIndex(count)
+
+    def sync(self) -> None:
+        super().sync()
+        self.openSynced = True
+
+    def _decodeBlock(self, data: bytes, position: int, offset: int, columns: tuple = None) -> tuple[list[list], int]:
+        """Decodes the block at `position` of `data`, read from data file `offset`, see `decodeBlock`.
+        Columns of keys added after the block was written hold their default value"""
+        keyCount = self._getSchemaKeyCount(offset + position)
+        if keyCount == self.archive.keyCount:
+            return decodeBlock(data, position, self.archiveRecordFormat, columns)
+        schemaFormat = self._getSchemaFormat(keyCount)
+        columns = range(len(self.archiveRecordFormat)) if columns is None else columns
+        values, nextPosition = decodeBlock(data, position, schemaFormat, (0, *[column for column in columns if 0 < column < len(schemaFormat)]))
+        count = len(values[0])
+        defaults = (0, *self._getDefaults(0))
+        values = iter(values[1:] if columns[0] else values)
+        return [next(values) if column < len(schemaFormat) else [defaults[column]] * count for column in columns], nextPosition
+
+    def refresh(self) -> bool:
+        """A block being written is skipped when read, see `_iterBlocks`. The open block file is read again by each read"""
+        if not super().refresh():
+            return False
+        self.dataSize = self._getDataFileSize()
+        try:
+            self.openSize = os.path.getsize(self.fileUtil.getOpenBlockFilePath(self.archive))
+        except FileNotFoundError:
+            self.openSize = 0
+        return True
+
+    def _indexRecords(self, timestamps: list) -> None:
+        """Blocks are indexed as they are written"""
+
+    def _summarizeRecords(self, columns: list, indexCount: int, dataSize: int) -> None:
+        """Blocks are summarized as they are written"""
+
+    def _readSegmentColumns(self, i: int) -> list:
+        startOffset, endOffset = self._getSegmentOffsets(i)
+        if startOffset >= self.dataSize:
+            return list(zip(*self._getOpenRecords()))
+        with open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb") as archiveFile:
+            archiveFile.seek(startOffset)
+            data = archiveFile.read(endOffset - startOffset)
+        try:
+            return list(self._decodeBlock(data, 0, startOffset)[0])
+        except (struct.error, ValueError, IndexError):
+            return []
+
+    def _writeBuffer(self) -> None:
+        """Encodes the blocks filled by the open block and the buffered records at the end of the data file,
+        the records left over are appended to the open block file. Blocks are encoded once, whatever the number of flushes"""
+        openCount = len(self.openRecords)
+        records = self.openRecords + list(self.recordStruct.iter_unpack(self.writeBuffer))
+        self._fillSummaries(len(self.indexOffsets))
+        summarize = len(self.summaries) == len(self.indexOffsets)
+
+        offset = self.dataSize
+        self.dataFile.file.seek(offset)
+        for i in range(0, len(records), self.archive.blockSize):
+            block = records[i:i+self.archive.blockSize]
+            if i or not openCount:
+                self.addIndex(block[0][0], offset)
+                if summarize:
+                    self.summaries.append([Accumulator() for _ in self.archiveRecordFormat])
+            if summarize:
+                # the open block's summary already holds its records
+                for accumulator, values in zip(self.summaries[-1], zip(*block[max(openCount - i, 0):])):
+                    accumulator.addValues(values)
+            if len(block) == self.archive.blockSize:
+                data = encodeBlock(block, self.archiveRecordFormat)
+                self.dataFile.file.write(data)
+                offset += len(data)
+        self.dataFile.file.flush()
+
+        self.openRecords = records[len(records) - len(records) % self.archive.blockSize:]
+        openBytes = len(self.openRecords) * self.recordStruct.size
+        if offset > self.dataSize:
+            # the records of the open block are in the first new block
+            blockBytes, self.dataSize = offset - self.dataSize, offset
+            self._resetOpenFile(self.writeBuffer[len(self.writeBuffer) - openBytes:])
+        else:
+            blockBytes, openBytes = 0, len(self.writeBuffer)
+            self.openFile.write(self.writeBuffer)
+            self.openFile.flush()
+        if self.metrics is not None:
+            self.metrics.count("bytesWritten", blockBytes + openBytes)
+
+    def addKey(self, archiveKey: ArchiveKey) -> None:
+        """Only the open block file is rewritten, its records get the key's default value. The open block is encoded with every key once full"""
+        self.close()
+        super().addKey(archiveKey)
+        self.openRecords = self._readOpenRecords()
+        if self.openRecords:
+            self._replaceOpenFile()
+
+    def _storeRecords(self, records: tuple) -> None:
+        path = self.fileUtil.getArchiveFilePath(self.archive, True)
+        with open(path+".new", "wb") as archiveFile:
+            for i in range(0, len(records), self.archive.blockSize):
+                archiveFile.write(encodeBlock(records[i:i+self.archive.blockSize], self.archiveRecordFormat))
+        os.replace(path+".new", path)
+        if os.path.exists(self.fileUtil.getOpenBlockFilePath(self.archive)):
+            os.remove(self.fileUtil.getOpenBlockFilePath(self.archive))
+
+    def getIndex(self, start: int, end: int) -> tuple[int, int]:
+        """Byte range of the blocks holding every record from `start` to `end`,
+        the block before the first one starting at `start` can hold records with that timestamp too"""
+        first = bisect_left(self.indexTimestamps, start) - 1
+        startOffset = self.indexOffsets[first] if first >= 0 else 0
+
+        i = bisect_left(self.indexTimestamps, end)
+        endOffset = self.indexOffsets[i] if i < len(self.indexOffsets) else self.dataSize
+
+        if self.metrics is not None:
+            self.metrics.count("indexEntriesVisited", i - max(first, 0))
+        return startOffset, endOffset
+
+    def _iterBlockStarts(self) -> Iterator[tuple[int, int]]:
+        """Yields the first timestamp and data file offset of each block, only the block header and the start of its timestamp column are read.
+        The open block is yielded last"""
+        with open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb") as archiveFile:
+            offset = 0
+            while offset < self.dataSize:
+                header = getBlockHeader(self._getSchemaFormat(self._getSchemaKeyCount(offset)))
+                archiveFile.seek(offset)
+                headerBytes = archiveFile.read(header.size)
+                if len(headerBytes) < header.size:
+                    return
+                _, *lengths = header.unpack(headerBytes)
+                # the first timestamp is stored whole at the start of its stream
+                yield decodeColumn(archiveFile.read(min(lengths[0], (FIRST_VALUE_BITS + 7) // 8)), self.archiveRecordFormat[0], 1)[0], offset
+                offset += header.size + sum(lengths)
+        openRecords = self._getOpenRecords()
+        if openRecords:
+            yield openRecords[0][0], self.dataSize
+
+    def _iterBlocks(self, start: int, end: int, columns: tuple = None) -> Iterator[list]:
+        """Yields the column values of each block from `start` to `end`, trimmed to that range, the open block last"""
+        columns = (0, *[column for column in columns if column]) if columns is not None else None
+        startOffset, endOffset = self.getIndex(start, end)
+        data = b""
+        if startOffset < endOffset:
+            with open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb") as archiveFile:
+                archiveFile.seek(startOffset)
+                data = archiveFile.read(endOffset - startOffset)
+            if self.metrics is not None:
+                self.metrics.count("bytesRead", len(data))
+
+        offset = 0
+        while offset < len(data):
+            try:
+                values, offset = self._decodeBlock(data, offset, startOffset, columns)
+            except (struct.error, ValueError, IndexError):
+                # a block being written by another process
+                break
+            yield from self._trimBlock(values, start, end)
+
+        openRecords = self._getOpenRecords()
+        if openRecords and openRecords[0][0] < end and start <= openRecords[-1][0]:
+            values = list(zip(*openRecords))
+            yield from self._trimBlock(values if columns is None else [values[column] for column in columns], start, end)
+
+    def _trimBlock(self, values: list, start: int, end: int) -> Iterator[list]:
+        timestamps = values[0]
+        if self.metrics is not None:
+            self.metrics.count("recordsScanned", len(timestamps))
+        first, last = bisect_left(timestamps, start), bisect_left(timestamps, end)
+        if first < last:
+            yield [column[first:last] for column in values]
+
+    def _readRange(self, start: int, end: int) -> tuple:
+        return tuple(record for columns in self._iterBlocks(start, end) for record in zip(*columns))
+
+    def iterRecords(self, start: int, end: int, chunkSize: int = CHUNK_SIZE) -> Iterator[tuple]:
+        self.flush()
+        chunk = []
+        for columns in self._iterBlocks(start, end):
+            chunk.extend(zip(*columns))
+            while len(chunk) >= chunkSize:
+                yield tuple(chunk[:chunkSize])
+                chunk = chunk[chunkSize:]
+        if chunk:
+            yield tuple(chunk)
+
+    def _readKey(self, start: int, end: int, keyI: int) -> dict:
+        return {timestamp: value for timestamps, values in self._iterBlocks(start, end, (keyI,)) for timestamp, value in zip(timestamps, values)}
+
+    def _readArray(self, start: int, end: int, dtype: "numpy.dtype") -> "numpy.ndarray":
+        return numpy.array(list(self._readRange(start, end)), dtype)
+
+    def iterArrays(self, start: int, end: int, chunkSize: int = CHUNK_SIZE) -> Iterator["numpy.ndarray"]:
+        dtype = StriderArchiveIO.getRecordDtype(self.archiveRecordFormat, ["timestamp", *[key.name for key in self.archive.keys]])
+        for chunk in self.iterRecords(start, end, chunkSize):
+            yield numpy.array(list(chunk), dtype)
+
+    def setIndexInteval(self, inteval: int, chunkSize: int = CHUNK_SIZE) -> None:
+        """Blocks are always indexed, only the interval setting is stored. Blocks are indexed again from their headers, see `_iterBlockStarts`"""
+        self.flush()
+        self.indexTimestamps = array("I")
+        self.indexOffsets = array("I")
+        for timestamp, offset in self._iterBlockStarts():
+            self.addIndex(timestamp, offset)
+
+        self.archive.indexInterval = inteval
+        self.archive.indexCount = len(self.indexTimestamps)
+        self.saveArchiveIndex()
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterator, Union
+
+
+class LRUCache:
+    """Mapping that evicts its least recently used entries once it holds more than `maxSize` of them, or more than `maxSize` in total
+    of `sizeOf` their values if set. A `maxSize` of None never evicts. Evicted values are passed to `onEvict`,
+    values for which `isPinned` returns True are never evicted"""
+    maxSize: Union[None | int]
+    size: int = 0
+
+    def __init__(self, maxSize: Union[None | int] = None, onEvict: Union[None | Callable[[Any], None]] = None, isPinned: Union[None | Callable[[Any], bool]] = None,
+                 sizeOf: Union[None | Callable[[Any], int]] = None) -> None:
+        self.maxSize = maxSize
+        self.onEvict = onEvict
+        self.isPinned = isPinned
+        self.sizeOf = sizeOf
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def _sizeOf(self, value: Any) -> int:
+        return self.sizeOf(value) if self.sizeOf is not None else 1
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = self.entries[key]
+        self.entries.move_to_end(key)
+        return value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key in self.entries:
+            return self[key]
+        return default
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        if key in self.entries:
+            self.size -= self._sizeOf(self.entries[key])
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.size += self._sizeOf(value)
+        self.evict()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.size -= self._sizeOf(value)
+        return value
+
+    def keys(self) -> Iterator[Hashable]:
+        return self.entries.keys()
+
+    def values(self) -> Iterator[Any]:
+        return self.entries.values()
+
+    def items(self) -> Iterator[tuple[Hashable, Any]]:
+        return self.entries.items()
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def evict(self) -> None:
+        """Evicts least recently used entries until the cache fits `maxSize`"""
+        if self.maxSize is None or self.size <= self.maxSize:
+            return
+        for key in list(self.entries):
+            if self.size <= self.maxSize:
+                break
+            value = self.entries[key]
+            if self.isPinned is not None and self.isPinned(value):
+                continue
+            del self.entries[key]
+            self.size -= self._sizeOf(value)
+            if self.onEvict is not None:
+                self.onEvict(value)
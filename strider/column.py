@@ -0,0 +1,160 @@
+from io import BufferedIOBase
+from typing import Iterator
+import os
+import struct
+
+from strider.io import StriderArchiveIO, numpy
+from strider.archive import ArchiveHandler, CHUNK_SIZE
+from strider.datatypes import ArchiveKey, ARCHIVE_LAYOUT
+
+
+class ColumnArchiveHandler(ArchiveHandler):
+    """Column archive, the data file holds the record timestamps and every key is stored in its own column file.
+    Index offsets point into the timestamp column, a single key query only reads the timestamp and key columns.
+    The column of an added key starts at the first row written after it was added, earlier rows read back with its default value"""
+    layout: ARCHIVE_LAYOUT = ARCHIVE_LAYOUT.column
+    columnFiles: list[BufferedIOBase]
+
+    def _buildDataFormat(self):
+        super()._buildDataFormat()
+        self.dataFormat = "I"
+        self.dataRecordSize = struct.calcsize(self.dataFormat)
+
+    def _getSchemaFormat(self, keyCount: int) -> str:
+        return self.dataFormat
+
+    def _getColumnStart(self, column: int) -> int:
+        """First row stored in the file of `column`"""
+        start = 0
+        for schema in self.archive.schemas:
+            if schema.keyCount < column:
+                start = schema.offset // self.dataRecordSize
+        return start
+
+    def _getDataFilePaths(self) -> list[str]:
+        return [self.fileUtil.getArchiveFilePath(self.archive, True),
+                *[self.fileUtil.getColumnFilePath(self.archive, column) for column in range(1, len(self.archiveRecordFormat))]]
+
+    def _openDataFile(self) -> StriderArchiveIO:
+        """Opens the timestamp and column files, columns left at different lengths by an interrupted write are truncated to the shortest"""
+        super()._openDataFile()
+        self.columnFiles = [open(path, "ab") for path in self._getDataFilePaths()[1:]]
+        sizes = [struct.calcsize(_type) for _type in self.archiveRecordFormat]
+        starts = [self._getColumnStart(column) for column in range(len(self.archiveRecordFormat))]
+        rows = min([self.dataSize // sizes[0], *[start + os.path.getsize(columnFile.name) // size for columnFile, size, start in zip(self.columnFiles, sizes[1:], starts[1:])]])
+        if rows * sizes[0] != self.dataSize or any(os.path.getsize(columnFile.name) != (rows - start) * size for columnFile, size, start in zip(self.columnFiles, sizes[1:], starts[1:])):
+            for dataFile, size, start in zip([self.dataFile.file, *self.columnFiles], sizes, starts):
+                dataFile.truncate(max(rows - start, 0) * size)
+            self.dataSize = rows * sizes[0]
+            self._trimIndex()
+            self.lastEntryTimestamp = self.archive.minRange
+            if rows:
+                self.dataFile.file.seek(-sizes[0], os.SEEK_END)
+                self.lastEntryTimestamp = self.dataFile.readRecord()[0]
+        return self.dataFile
+
+    def _closeDataFile(self) -> None:
+        for columnFile in self.columnFiles:
+            columnFile.close()
+        self.columnFiles = []
+        super()._closeDataFile()
+
+    def _packColumns(self, records: tuple) -> list[bytes]:
+        columns = list(zip(*records))
+        return [struct.pack(f"{len(column)}{_type}", *column) for _type, column in zip(self.archiveRecordFormat, columns)]
+
+    def _writeBuffer(self) -> None:
+        """Key columns are written before the timestamps, so readers of the timestamp column always find the values of its rows"""
+        columns = self._packColumns(tuple(self.recordStruct.iter_unpack(self.writeBuffer)))
+        for columnFile, column in reversed(list(zip([self.dataFile.file, *self.columnFiles], columns))):
+            columnFile.write(column)
+            columnFile.flush()
+        if self.metrics is not None:
+            self.metrics.count("bytesWritten", sum(len(column) for column in columns))
+
+    def _storeRecords(self, records: tuple) -> None:
+        paths = self._getDataFilePaths()
+        columns = self._packColumns(records) if records else [b""] * len(paths)
+        for path, column in zip(paths, columns):
+            with open(path+".new", "wb") as columnFile:
+                columnFile.write(column)
+            os.replace(path+".new", path)
+
+    def _findRows(self, start: int, end: int) -> tuple[int, int]:
+        """First and last row, exclusive, from `start` to `end`"""
+        startOffset, endOffset = self.getIndex(start, end)
+        if endOffset <= startOffset:
+            return 0, 0
+
+        with StriderArchiveIO(open(self.fileUtil.getArchiveFilePath(self.archive, True), "rb"), self.dataFormat) as timestampFile:
+            timestampFile.mapFile()
+            startOffset, endOffset = timestampFile.findRecordRange(start, end, startOffset, endOffset)
+        if self.metrics is not None:
+            self.metrics.count("recordsScanned", (endOffset - startOffset) // self.dataRecordSize)
+        return startOffset // self.dataRecordSize, endOffset // self.dataRecordSize
+
+    def _readColumn(self, column: int, startRow: int, endRow: int) -> bytes:
+        """Raw bytes of `column` rows, column 0 being the timestamps. Rows written before the column was added are zero bytes, the key's default value"""
+        size = struct.calcsize(self.archiveRecordFormat[column])
+        columnStart = self._getColumnStart(column)
+        defaults = bytes(max(min(endRow, columnStart) - startRow, 0) * size)
+        startRow = max(startRow, columnStart)
+        if endRow <= startRow:
+            return defaults
+        path = self.fileUtil.getColumnFilePath(self.archive, column) if column else self.fileUtil.getArchiveFilePath(self.archive, True)
+        with open(path, "rb") as columnFile:
+            columnFile.seek((startRow - columnStart) * size)
+            data = columnFile.read((endRow - startRow) * size)
+        if self.metrics is not None:
+            self.metrics.count("bytesRead", len(data))
+        return defaults + data
+
+    def _readColumnValues(self, column: int, startRow: int, endRow: int) -> tuple:
+        return struct.unpack(f"{endRow - startRow}{self.archiveRecordFormat[column]}", self._readColumn(column, startRow, endRow))
+
+    def _readSegmentColumns(self, i: int) -> list:
+        startRow, endRow = [offset // self.dataRecordSize for offset in self._getSegmentOffsets(i)]
+        if endRow <= startRow:
+            return []
+        return [self._readColumnValues(column, startRow, endRow) for column in range(len(self.archiveRecordFormat))]
+
+    def _readRange(self, start: int, end: int) -> tuple:
+        startRow, endRow = self._findRows(start, end)
+        if endRow <= startRow:
+            return ()
+        return tuple(zip(*[self._readColumnValues(column, startRow, endRow) for column in range(len(self.archiveRecordFormat))]))
+
+    def iterRecords(self, start: int, end: int, chunkSize: int = CHUNK_SIZE) -> Iterator[tuple]:
+        self.flush()
+        startRow, endRow = self._findRows(start, end)
+        for row in range(startRow, endRow, chunkSize):
+            chunkEnd = min(row + chunkSize, endRow)
+            yield tuple(zip(*[self._readColumnValues(column, row, chunkEnd) for column in range(len(self.archiveRecordFormat))]))
+
+    def _readKey(self, start: int, end: int, keyI: int) -> dict:
+        startRow, endRow = self._findRows(start, end)
+        if endRow <= startRow:
+            return {}
+        return dict(zip(self._readColumnValues(0, startRow, endRow), self._readColumnValues(keyI, startRow, endRow)))
+
+    def _readColumnArray(self, dtype: "numpy.dtype", startRow: int, endRow: int) -> "numpy.ndarray":
+        records = numpy.zeros(max(endRow - startRow, 0), dtype)
+        if endRow > startRow:
+            for column, name in enumerate(dtype.names):
+                records[name] = numpy.frombuffer(self._readColumn(column, startRow, endRow), self.archiveRecordFormat[column])
+        return records
+
+    def _readArray(self, start: int, end: int, dtype: "numpy.dtype") -> "numpy.ndarray":
+        return self._readColumnArray(dtype, *self._findRows(start, end))
+
+    def iterArrays(self, start: int, end: int, chunkSize: int = CHUNK_SIZE) -> Iterator["numpy.ndarray"]:
+        self.flush()
+        dtype = StriderArchiveIO.getRecordDtype(self.archiveRecordFormat, ["timestamp", *[key.name for key in self.archive.keys]])
+        startRow, endRow = self._findRows(start, end)
+        for row in range(startRow, endRow, chunkSize):
+            yield self._readColumnArray(dtype, row, min(row + chunkSize, endRow))
+
+    def addKey(self, archiveKey: ArchiveKey) -> None:
+        """Adds an empty column, existing columns are left untouched"""
+        open(self.fileUtil.getColumnFilePath(self.archive, len(self.archiveRecordFormat)), "wb").close()
+        super().addKey(archiveKey)
@@ -0,0 +1,223 @@
+from itertools import pairwise
+import struct
+
+# delta-of-delta buckets, (prefix, prefix bit count, value bit count), the last bucket holds any 32 bit value range
+DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12), (0b1111, 4, 36))
+# bit count of the first value of an integer column, zigzag encoded
+FIRST_VALUE_BITS = 36
+DOD_PREFIX_BITS = 4
+
+
+def getDodPrefixes() -> list:
+    """Bucket of every 4 bit prefix, its field bit count, prefix included, and value mask, None for a leading zero bit"""
+    prefixes = [None] * (1 << DOD_PREFIX_BITS)
+    for prefix, prefixBits, valueBits in DOD_BUCKETS:
+        for low in range(1 << (DOD_PREFIX_BITS - prefixBits)):
+            prefixes[prefix << (DOD_PREFIX_BITS - prefixBits) | low] = (prefixBits + valueBits, (1 << valueBits) - 1)
+    return prefixes
+
+
+DOD_PREFIXES = getDodPrefixes()
+
+
+class BitWriter:
+    """Collects bit fields most significant bit first, shifted into a single int. Streams are a block's column so they stay small"""
+
+    def __init__(self) -> None:
+        self.value = 0
+        self.bits = 0
+
+    def write(self, value: int, width: int) -> None:
+        self.value = self.value << width | value
+        self.bits += width
+
+    def getBytes(self) -> bytes:
+        padding = -self.bits % 8
+        return (self.value << padding).to_bytes((self.bits + padding) // 8, "big")
+
+
+class BitReader:
+    """Reads the bit fields written by `BitWriter`, fields are shifted out of the stream held as a single int.
+    The column decoders shift their fields out of `value` themselves and update `remaining`"""
+
+    def __init__(self, data: bytes) -> None:
+        self.value = int.from_bytes(data, "big")
+        # bits left to read, the next field ends this many bits above the least significant bit
+        self.remaining = len(data) * 8
+
+    def read(self, width: int) -> int:
+        self.remaining -= width
+        if self.remaining < 0:
+            raise ValueError("Truncated bit stream")
+        return (self.value >> self.remaining) & ((1 << width) - 1)
+
+
+def zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value: int) -> int:
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+def encodeIntegers(values: list, writer: BitWriter) -> None:
+    """Delta-of-delta encoding, a run of evenly spaced values takes a single bit per value.
+    The fields are shifted into one int, a zero bit is a shift by one"""
+    stream = zigzag(values[0])
+    width = FIRST_VALUE_BITS
+    previousDelta = 0
+    for previous, value in pairwise(values):
+        delta = value - previous
+        dod = delta - previousDelta
+        previousDelta = delta
+        if dod == 0:
+            stream <<= 1
+            width += 1
+            continue
+        dod = zigzag(dod)
+        for prefix, prefixBits, valueBits in DOD_BUCKETS:
+            if dod < 1 << valueBits:
+                stream = (stream << prefixBits | prefix) << valueBits | dod
+                width += prefixBits + valueBits
+                break
+    writer.write(stream, width)
+
+
+def decodeIntegers(reader: BitReader, count: int) -> list:
+    value = unzigzag(reader.read(FIRST_VALUE_BITS))
+    values = [value]
+    delta = 0
+    bits, remaining = reader.value, reader.remaining
+    while len(values) < count:
+        if remaining >= DOD_PREFIX_BITS:
+            bucket = DOD_PREFIXES[bits >> (remaining - DOD_PREFIX_BITS) & 0b1111]
+        else:
+            bucket = DOD_PREFIXES[bits << (DOD_PREFIX_BITS - remaining) & 0b1111]
+        if bucket is None:
+            # a run of unchanged deltas is skipped in one step
+            zeros = min(remaining - (bits & ((1 << remaining) - 1)).bit_length(), count - len(values))
+            remaining -= zeros
+            values.extend(range(value + delta, value + delta * (zeros + 1), delta) if delta else [value] * zeros)
+            value += delta * zeros
+            continue
+        width, mask = bucket
+        remaining -= width
+        if remaining < 0:
+            raise ValueError("Truncated bit stream")
+        dod = bits >> remaining & mask
+        delta += dod >> 1 ^ -(dod & 1)
+        value += delta
+        values.append(value)
+    reader.remaining = remaining
+    return values
+
+
+def encodeFloats(values: list, writer: BitWriter) -> None:
+    """Gorilla XOR encoding of 32 bit floats, unchanged values take a single bit.
+    The fields are shifted into one int, a zero bit is a shift by one"""
+    patterns = struct.unpack(f"{len(values)}I", struct.pack(f"{len(values)}f", *values))
+    stream = patterns[0]
+    width = 32
+    leading = trailing = None
+    for previous, pattern in pairwise(patterns):
+        xor = previous ^ pattern
+        if xor == 0:
+            stream <<= 1
+            width += 1
+            continue
+        xorLeading = 32 - xor.bit_length()
+        xorTrailing = (xor & -xor).bit_length() - 1
+        if leading is not None and xorLeading >= leading and xorTrailing >= trailing:
+            stream = (stream << 2 | 0b10) << (32 - leading - trailing) | xor >> trailing
+            width += 34 - leading - trailing
+        else:
+            leading, trailing = xorLeading, xorTrailing
+            stream = (((stream << 2 | 0b11) << 5 | leading) << 5 | 31 - leading - trailing) << (32 - leading - trailing) | xor >> trailing
+            width += 44 - leading - trailing
+    writer.write(stream, width)
+
+
+def decodeFloats(reader: BitReader, count: int) -> list:
+    pattern = reader.read(32)
+    patterns = [pattern]
+    leading = trailing = 0
+    width, mask = 32, 0xFFFFFFFF
+    bits, remaining = reader.value, reader.remaining
+    while len(patterns) < count:
+        if remaining < 2 or not bits >> (remaining - 1) & 1:
+            # a run of unchanged values is skipped in one step
+            zeros = min(remaining - (bits & ((1 << remaining) - 1)).bit_length(), count - len(patterns))
+            remaining -= zeros
+            patterns.extend([pattern] * zeros)
+            continue
+        if bits >> (remaining - 2) & 1:
+            remaining -= 12
+            if remaining < 0:
+                raise ValueError("Truncated bit stream")
+            leading = bits >> (remaining + 5) & 0b11111
+            trailing = 31 - leading - (bits >> remaining & 0b11111)
+            width = 32 - leading - trailing
+            mask = (1 << width) - 1
+        else:
+            remaining -= 2
+        remaining -= width
+        if remaining < 0:
+            raise ValueError("Truncated bit stream")
+        pattern ^= (bits >> remaining & mask) << trailing
+        patterns.append(pattern)
+    reader.remaining = remaining
+    return list(struct.unpack(f"{count}f", struct.pack(f"{count}I", *patterns)))
+
+
+def encodeColumn(values: list, _type: str) -> bytes:
+    writer = BitWriter()
+    match _type:
+        case "f":
+            encodeFloats(values, writer)
+        case "?":
+            bits = 0
+            for value in values:
+                bits = bits << 1 | (1 if value else 0)
+            writer.write(bits, len(values))
+        case _:
+            encodeIntegers(values, writer)
+    return writer.getBytes()
+
+
+def decodeColumn(data: bytes, _type: str, count: int) -> list:
+    reader = BitReader(data)
+    match _type:
+        case "f":
+            return decodeFloats(reader, count)
+        case "?":
+            bits = reader.read(count)
+            return [bits >> shift & 1 == 1 for shift in range(count - 1, -1, -1)]
+        case _:
+            return decodeIntegers(reader, count)
+
+
+def getBlockHeader(recordFormat: str) -> struct.Struct:
+    """Block header, the record count followed by the byte length of each column stream"""
+    return struct.Struct("=H" + "I" * len(recordFormat))
+
+
+def encodeBlock(records: list, recordFormat: str) -> bytes:
+    """Encodes records column by column, each column is a separate stream so it can be decoded on its own"""
+    streams = [encodeColumn(column, _type) for column, _type in zip(zip(*records), recordFormat)]
+    return getBlockHeader(recordFormat).pack(len(records), *[len(stream) for stream in streams]) + b"".join(streams)
+
+
+def decodeBlock(data: bytes, offset: int, recordFormat: str, columns: tuple = None) -> tuple[list[list], int]:
+    """Decodes the block at `offset`, returns the values of `columns` (every column by default) and the offset of the next block"""
+    header = getBlockHeader(recordFormat)
+    count, *lengths = header.unpack_from(data, offset)
+    offset += header.size
+    streamOffsets = [offset]
+    for length in lengths:
+        streamOffsets.append(streamOffsets[-1] + length)
+    if streamOffsets[-1] > len(data):
+        raise ValueError("Truncated block")
+
+    columns = range(len(recordFormat)) if columns is None else columns
+    values = [decodeColumn(data[streamOffsets[column]:streamOffsets[column+1]], recordFormat[column], count) for column in columns]
+    return values, streamOffsets[-1]
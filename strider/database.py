@@ -1,21 +1,55 @@
 from typing import Union
 from datetime import datetime
 import calendar
+import os
+import shutil
 
 from strider.io import StriderFileIO, StriderFileUtil
 from strider.archive import ArchiveHandler
+from strider.column import ColumnArchiveHandler
+from strider.block import BlockArchiveHandler
+from strider.aggregate import getRollupKey
+from strider.metrics import Metrics
 from strider.exceptions import *
 
-from strider.datatypes import Database, DatabaseArchive, ArchiveKey, ARCHIVE_RANGE, ARCHIVE_KEY_TYPES
+from strider.strider import CURRENT_REVISION
+from strider.datatypes import Database, DatabaseArchive, ArchiveKey, ARCHIVE_RANGE, ARCHIVE_KEY_TYPES, ARCHIVE_LAYOUT, ARCHIVE_RESOLUTIONS
+
+ARCHIVE_HANDLERS: dict[ARCHIVE_LAYOUT, type[ArchiveHandler]] = {ARCHIVE_LAYOUT.row: ArchiveHandler,
+                                                               ARCHIVE_LAYOUT.column: ColumnArchiveHandler,
+                                                               ARCHIVE_LAYOUT.block: BlockArchiveHandler}
 
 
 class DatabaseHandler:
     database: Union[None, Database]
     fileUtil: StriderFileUtil
+    # database file stat when it was last read or saved
+    fileStat: Union[None | tuple[int, int, int]] = None
+    # passed on to the archives it loads and creates, None while metrics are disabled
+    metrics: Union[None | Metrics] = None
 
     def __init__(self, database: Database, fileUtil: StriderFileUtil) -> None:
         self.database = database
         self.fileUtil = fileUtil
+        self.fileStat = StriderFileUtil.statFile(fileUtil.getDatabaseFilepath())
+
+    @staticmethod
+    def readDatabase(fileUtil: StriderFileUtil) -> Database:
+        """Reads the database file, raises struct.error if it is truncated"""
+        with StriderFileIO(open(fileUtil.getDatabaseFilepath(), "rb")) as databaseFile:
+            database: Database = databaseFile.readStruct(Database)
+            database.archives = databaseFile.readStructSequence(DatabaseArchive, database.archiveCount)
+            database.keys = databaseFile.readStructSequence(ArchiveKey, database.keyCount)
+        return database
+
+    def refresh(self) -> bool:
+        """Reads the database file again if another process saved it, returns whether it changed"""
+        fileStat = StriderFileUtil.statFile(self.fileUtil.getDatabaseFilepath())
+        if fileStat is None or fileStat == self.fileStat:
+            return False
+        self.database = self.readDatabase(self.fileUtil)
+        self.fileStat = fileStat
+        return True
 
     def getArchivePeriod(self, date: datetime):
         match self.database.archiveRange:
@@ -29,18 +63,22 @@ class DatabaseHandler:
             case _:
                 raise ValueError()
 
+    def getArchiveHandler(self) -> type[ArchiveHandler]:
+        return ARCHIVE_HANDLERS[self.database.archiveLayout]
+
     def getArchiveKey(self, date: datetime) -> int:
         timestamp = int(date.timestamp())
         return timestamp - (timestamp % self.getArchivePeriod(date))
 
     def save(self) -> None:
-        """Saves database"""
-        try:
-            self.fileUtil.safeOverwrite(self.fileUtil.getDatabaseFilepath()+".old", self.fileUtil.getDatabaseFilepath())
-        except FileNotFoundError:
-            pass
-        with StriderFileIO(open(self.fileUtil.getDatabaseFilepath(), "wb")) as databaseFile:
+        """Saves database, the previous file is kept as a backup and the new one is renamed over it so readers never see a partial file"""
+        path = self.fileUtil.getDatabaseFilepath()
+        if os.path.isfile(path):
+            shutil.copy2(path, path+".old")
+        with StriderFileIO(open(path+".new", "wb")) as databaseFile:
             databaseFile.writeStruct(self.database)
+        os.replace(path+".new", path)
+        self.fileStat = StriderFileUtil.statFile(path)
 
     def addKey(self, archiveKey: ArchiveKey) -> bool:
         """Correctly adds an key to the database file"""
@@ -53,49 +91,98 @@ class DatabaseHandler:
         self.save()
         return True
     
-    def getKeys(self) -> list[ArchiveKey]:
+    def getKeys(self, resolution: int = 0) -> list[ArchiveKey]:
+        """Database keys, as stored in archives of the `resolution` level"""
+        if resolution:
+            return [getRollupKey(key) for key in self.database.keys]
         return self.database.keys
+
+    def getRollups(self) -> list[int]:
+        """Resolution levels kept as rollup archives"""
+        return [level for level in range(1, len(ARCHIVE_RESOLUTIONS)) if self.database.rollups & (1 << level)]
+
+    def setRollups(self, resolutions: list[int]) -> None:
+        """Keeps rollup archives for `resolutions`, in seconds, from now on"""
+        rollups = 0
+        for resolution in resolutions:
+            if resolution not in ARCHIVE_RESOLUTIONS[1:]:
+                raise ValueError(f"Resolution must be one of {ARCHIVE_RESOLUTIONS[1:]}")
+            rollups |= 1 << ARCHIVE_RESOLUTIONS.index(resolution)
+        self.database.rollups = rollups
+        self.save()
+
+    def getResolutionLevel(self, resolution: int) -> int:
+        """Coarsest kept resolution level with records at most `resolution` seconds apart"""
+        level = 0
+        for rollup in self.getRollups():
+            if ARCHIVE_RESOLUTIONS[rollup] <= resolution:
+                level = rollup
+        return level
     
     def setIndexInteval(self, inteval) -> None:
         self.database.indexInterval = inteval
         self.save()
         return True
 
-    def hasArchive(self, archiveKey: int) -> bool:
+    def hasArchive(self, archiveKey: int, resolution: int = 0) -> bool:
         for archive in self.database.archives:
-            if archive.minRange == archiveKey:
+            if archive.minRange == archiveKey and archive.resolution == resolution:
                 return True
         return False
 
     def hasArchivePeriod(self, date: datetime) -> bool:
         return self.hasArchive(self.getArchiveKey(date))
 
-    def loadArchive(self, archiveKey: int) -> ArchiveHandler:
+    def loadArchive(self, archiveKey: int, resolution: int = 0) -> ArchiveHandler:
         """Loads archive
         TODO check if archive exists etc"""
         for archive in self.database.archives:
-            if archive.minRange == archiveKey:
+            if archive.minRange == archiveKey and archive.resolution == resolution:
                 databaseArchive = archive
 
-        archiveHandler = ArchiveHandler(self.fileUtil).load(databaseArchive)
+        archiveHandler = self._newArchiveHandler().load(databaseArchive)
+        return archiveHandler
+
+    def _newArchiveHandler(self) -> ArchiveHandler:
+        archiveHandler = self.getArchiveHandler()(self.fileUtil)
+        if self.metrics is not None:
+            archiveHandler.metrics = self.metrics
+            self.metrics.count("archivesOpened")
         return archiveHandler
 
-    def loadArchives(self) -> dict[int, ArchiveHandler]:
+    def loadArchives(self) -> dict[tuple[int, int], ArchiveHandler]:
         archives = {}
         for archive in self.database.archives:
-            archiveHandler = ArchiveHandler(self.fileUtil).load(archive)
-            archives[archive.minRange] = archiveHandler
+            archiveHandler = self._newArchiveHandler().load(archive)
+            archives[(archive.minRange, archive.resolution)] = archiveHandler
         return archives
 
-    def createArchive(self, date: datetime) -> ArchiveHandler:
+    def getFirstArchive(self, resolution: int = 0) -> Union[None | DatabaseArchive]:
+        archives = [archive for archive in self.database.archives if archive.resolution == resolution]
+        return min(archives, key=lambda archive: archive.minRange) if archives else None
+
+    def getLastArchive(self, resolution: int = 0) -> Union[None | DatabaseArchive]:
+        archives = [archive for archive in self.database.archives if archive.resolution == resolution]
+        return max(archives, key=lambda archive: archive.minRange) if archives else None
+
+    def convertArchives(self, archiveLayout: ARCHIVE_LAYOUT) -> None:
+        """Rewrites every archive in `archiveLayout` and makes it the layout of new archives"""
+        for archive in self.database.archives:
+            self.loadArchive(archive.minRange, archive.resolution).convert(ARCHIVE_HANDLERS[archiveLayout])
+
+        self.database.archiveLayout = archiveLayout
+        self.database.revision = CURRENT_REVISION
+        self.save()
+
+    def createArchive(self, date: datetime, resolution: int = 0) -> ArchiveHandler:
         """Depending on the archive range, archives are created starting on the first hour of the day or week and cannot overlap unless the resolution is different
         TODO checks, errors"""
         archiveMin = self.getArchiveKey(date)
         archiveMax = archiveMin + self.getArchivePeriod(date)
 
-        databaseArchive = DatabaseArchive(archiveMin, archiveMax, self.database.archiveCount + 1, 0)
+        databaseArchive = DatabaseArchive(archiveMin, archiveMax, self.database.archiveCount + 1, resolution)
 
-        archiveHandler = ArchiveHandler(self.fileUtil).create(databaseArchive, self.database)
+        archiveHandler = self._newArchiveHandler().create(databaseArchive, self.database, self.getKeys(resolution))
 
         self.database.archives.append(databaseArchive)
         self.database.archiveCount = len(self.database.archives)
@@ -5,6 +5,12 @@ from enum import Enum
 
 class StriderStruct:
     format = tuple()
+    # revision each format field was introduced in, missing entries are revision 0
+    revisions = tuple()
+
+    @classmethod
+    def fieldRevision(cls, i: int) -> int:
+        return cls.revisions[i] if i < len(cls.revisions) else 0
 
     def __post_init__(self):
         for field in fields(self):
@@ -14,6 +20,22 @@ class StriderStruct:
 
 ARCHIVE_RANGE = Enum("Range", "day week month")
 
+ARCHIVE_LAYOUT = Enum("Layout", "row column block")
+
+# archives a session keeps loaded: every archive, the most recently used ones or only those being written to
+ARCHIVE_RESIDENCY = Enum("Residency", "all current none")
+
+# pools that multi-archive queries can fan archive reads out to
+QUERY_EXECUTORS = Enum("Executor", "thread process")
+
+# when the write-ahead log is forced to disk: on every write, every sync interval or only on flush
+WAL_SYNC = Enum("WalSync", "always interval never")
+
+# seconds per record of each archive resolution level, level 0 stores the raw records
+ARCHIVE_RESOLUTIONS = (0, 60, 300, 900, 3600, 86400)
+
+DOWNSAMPLE_FUNCS = Enum("DownsampleFunc", "avg min max sum last count", start=0)
+
 
 @dataclass
 class DatabaseArchive(StriderStruct):
@@ -37,7 +59,8 @@ class ArchiveKey(StriderStruct):
 
 @dataclass
 class Database(StriderStruct):
-    format = (str, "I", str, "H", "H", "H", "I")
+    format = (str, "I", str, "H", "H", "H", "I", "B", "B")
+    revisions = (0, 0, 0, 0, 0, 0, 0, 1, 2)
     magic: str
     revision: int
     databaseName: str
@@ -45,6 +68,9 @@ class Database(StriderStruct):
     keyCount: int
     indexInterval: int
     archiveRange: Enum = field(default_factory=ARCHIVE_RANGE)
+    archiveLayout: Enum = field(default_factory=lambda value=ARCHIVE_LAYOUT.row: ARCHIVE_LAYOUT(value))
+    # bitmask of the ARCHIVE_RESOLUTIONS levels kept as rollup archives
+    rollups: int = 0
     # should keys and stride be global?
     # todo archive ranges
     archives: list[DatabaseArchive] = field(default_factory=list)
@@ -62,9 +88,18 @@ class ArchiveIndex(StriderStruct):
     type: Enum = field(default_factory=ARCHIVE_INDEX_TYPES)
 
 
+@dataclass
+class ArchiveSchema(StriderStruct):
+    # records from the previous schema's offset up to data file `offset` hold the first `keyCount` archive keys
+    format = ("I", "H")
+    offset: int
+    keyCount: int
+
+
 @dataclass
 class ArchiveFile(StriderStruct):
-    format = (str, "I", "B", "I", "I", "H", "H", "H", "I")
+    format = (str, "I", "B", "I", "I", "H", "H", "H", "I", "B", "H", "H")
+    revisions = (0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 3, 4)
     magic: str
     revision: int
     resolution: int
@@ -74,5 +109,11 @@ class ArchiveFile(StriderStruct):
     keyCount: int
     indexCount: int
     indexInterval: int
+    layout: Enum = field(default_factory=lambda value=ARCHIVE_LAYOUT.row: ARCHIVE_LAYOUT(value))
+    # records per block of the block layout
+    blockSize: int = 0
+    # records written before the last keys were added, see `ArchiveSchema`
+    schemaCount: int = 0
     keys: list[ArchiveKey] = field(default_factory=list)
     indices: list[ArchiveIndex] = field(default_factory=list)
+    schemas: list[ArchiveSchema] = field(default_factory=list)
@@ -11,6 +11,10 @@ class DatabaseCorrupt(Exception):
     pass
 
 
+class DatabaseLocked(Exception):
+    pass
+
+
 # Archive
 class ArchiveNotFound(Exception):
     pass
@@ -1,11 +1,93 @@
 from io import BufferedIOBase
+from array import array
+import mmap
 import struct
 import dataclasses
 import os
-import shutil
 from typing import Union, Type
 
-from strider.datatypes import StriderStruct, ArchiveFile, DatabaseArchive
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from strider.datatypes import StriderStruct, ArchiveFile, ArchiveIndex, DatabaseArchive, ARCHIVE_INDEX_TYPES
+
+
+class StructCodec:
+    """Compiled reader and writer of a `StriderStruct` subclass. Consecutive fixed size fields introduced in the same revision
+    are packed and unpacked by a single `struct.Struct`, length prefixed strings are handled between them.
+    Codecs are built once per subclass, see `forStruct`"""
+    codecs: dict[type, "StructCodec"] = {}
+    # (revision, struct or None for a string, field names) per run of fields
+    segments: list[tuple[int, Union[None | struct.Struct], list[str]]]
+
+    def __init__(self, striderStruct: Type[StriderStruct]) -> None:
+        self.striderStruct = striderStruct
+        structFields = dataclasses.fields(striderStruct)
+        self.enumFields = {field.name for field in structFields[:len(striderStruct.format)] if field.type.__name__ == "Enum"}
+        self.sequenceFields = [field.name for field in structFields[len(striderStruct.format):]]
+
+        segments = []
+        for i, (field, _type) in enumerate(zip(structFields, striderStruct.format)):
+            revision = striderStruct.fieldRevision(i)
+            if _type == str:
+                segments.append((revision, None, [field.name]))
+            elif segments and segments[-1][1] is not None and segments[-1][0] == revision:
+                segments[-1][1].append(_type)
+                segments[-1][2].append(field.name)
+            else:
+                segments.append((revision, [_type], [field.name]))
+        # standard sizes without alignment padding, fields used to be packed one by one
+        self.segments = [(revision, struct.Struct("=" + "".join(formats)) if formats is not None else None, names) for revision, formats, names in segments]
+        # structs of a single fixed size run are read in bulk
+        self.recordStruct = self.segments[0][1] if len(self.segments) == 1 and not self.sequenceFields else None
+
+    @classmethod
+    def forStruct(cls, striderStruct: Type[StriderStruct]) -> "StructCodec":
+        codec = cls.codecs.get(striderStruct)
+        if codec is None:
+            codec = cls.codecs[striderStruct] = cls(striderStruct)
+        return codec
+
+    def read(self, file: BufferedIOBase) -> StriderStruct:
+        """Reads a struct, fields introduced after the revision stored in the struct are left to their defaults.
+        Raises struct.error if the file ends early"""
+        values = {}
+        for revision, segmentStruct, names in self.segments:
+            if revision > values.get("revision", 0):
+                break
+            if segmentStruct is None:
+                length = struct.unpack("B", file.read(1))[0]
+                values[names[0]] = file.read(length).decode("utf8")
+            else:
+                values.update(zip(names, segmentStruct.unpack(file.read(segmentStruct.size))))
+        return self.striderStruct(*values.values())
+
+    def readSequence(self, file: BufferedIOBase, count: int) -> list[StriderStruct]:
+        if self.recordStruct is not None:
+            data = file.read(self.recordStruct.size * count)
+            if len(data) != self.recordStruct.size * count:
+                raise struct.error(f"Expected {count} {self.striderStruct.__name__} structs")
+            return [self.striderStruct(*values) for values in self.recordStruct.iter_unpack(data)]
+        return [self.read(file) for _ in range(count)]
+
+    def pack(self, striderStruct: StriderStruct) -> bytes:
+        """Serialized struct followed by the items of its sequence fields"""
+        revision = getattr(striderStruct, "revision", 0)
+        parts = []
+        for segmentRevision, segmentStruct, names in self.segments:
+            if segmentRevision > revision:
+                continue
+            if segmentStruct is None:
+                encoded = getattr(striderStruct, names[0]).encode()
+                parts.append(struct.pack("B", len(encoded)) + encoded)
+            else:
+                parts.append(segmentStruct.pack(*[getattr(striderStruct, name).value if name in self.enumFields else getattr(striderStruct, name) for name in names]))
+        for name in self.sequenceFields:
+            for item in getattr(striderStruct, name):
+                parts.append(self.forStruct(type(item)).pack(item))
+        return b"".join(parts)
 
 
 class StriderFileIO:
@@ -40,45 +122,79 @@ class StriderFileIO:
         return string
 
     def writeString(self, string: str) -> None:
-        self.file.write(struct.pack("B", len(string)))
-        self.file.write(string.encode())
+        encoded = string.encode()
+        self.file.write(struct.pack("B", len(encoded)))
+        self.file.write(encoded)
 
     def readStruct(self, striderStruct: type[StriderStruct]) -> type[StriderStruct]:
-        return striderStruct(*self.readFormat(striderStruct.format))
+        """Reads a struct, fields introduced after the revision stored in the struct are left to their defaults"""
+        return StructCodec.forStruct(striderStruct).read(self.file)
 
     def writeStruct(self, striderStruct: StriderStruct) -> None:
-        for i, field in enumerate(dataclasses.fields(striderStruct)):
-            if i < len(striderStruct.format):
-                value = getattr(striderStruct, field.name)
+        """Writes a struct and the items of its sequence fields in one write"""
+        self.file.write(StructCodec.forStruct(type(striderStruct)).pack(striderStruct))
 
-                match field.type.__name__:
-                    case "str":
-                        self.writeString(value)
-                        continue
-                    case "Enum":
-                        value = value.value
+    @staticmethod
+    def structSize(striderStruct: Type[StriderStruct]) -> int:
+        """Size in bytes of a struct without strings or sequences"""
+        return sum(struct.calcsize(_type) for _type in striderStruct.format)
 
-                self.file.write(struct.pack(striderStruct.format[i], value))
+    @staticmethod
+    def fieldOffset(striderStruct: StriderStruct, fieldName: str) -> int:
+        """Offset in bytes of a header field from the start of the serialized struct"""
+        offset = 0
+        revision = getattr(striderStruct, "revision", 0)
+        for i, field in enumerate(dataclasses.fields(striderStruct)):
+            if field.name == fieldName:
+                return offset
+            if striderStruct.fieldRevision(i) > revision:
+                continue
+            if striderStruct.format[i] == str:
+                offset += 1 + len(getattr(striderStruct, field.name).encode())
             else:
-                for item in getattr(striderStruct, field.name):
-                    self.writeStruct(item)
+                offset += struct.calcsize(striderStruct.format[i])
+        raise KeyError(fieldName)
 
     def readStructSequence(self, striderStruct: Type[StriderStruct], count: int) -> list[Type[StriderStruct]]:
-        seq = []
-        for _ in range(count):
-            seq.append(self.readStruct(striderStruct))
-        return seq
+        """Reads `count` structs, fixed size structs are read and unpacked in one step"""
+        return StructCodec.forStruct(striderStruct).readSequence(self.file, count)
+
+    def readIndexArrays(self, count: int) -> tuple[array, array]:
+        """Reads `count` ArchiveIndex structs as parallel timestamp and offset arrays, unpacked in one step"""
+        indexFormat = "".join(ArchiveIndex.format)
+        indexBytes = self.file.read(struct.calcsize("=" + indexFormat) * count)
+        count = len(indexBytes) // struct.calcsize("=" + indexFormat)
+        values = struct.unpack(f"={indexFormat * count}", indexBytes[:count * struct.calcsize("=" + indexFormat)])
+        fields = len(ArchiveIndex.format)
+        return array("I", values[0::fields]), array("I", values[1::fields])
+
+    def writeIndexArrays(self, timestamps: array, offsets: array) -> None:
+        """Writes parallel timestamp and offset arrays as ArchiveIndex structs, packed in one step"""
+        fields = len(ArchiveIndex.format)
+        values = [ARCHIVE_INDEX_TYPES.default.value] * (len(timestamps) * fields)
+        values[0::fields] = timestamps
+        values[1::fields] = offsets
+        self.file.write(struct.pack(f"={''.join(ArchiveIndex.format) * len(timestamps)}", *values))
 
 
 class StriderArchiveIO(StriderFileIO):
+    map: Union[None | mmap.mmap] = None
+
     def __init__(self, file, recordFormat) -> None:
         super().__init__(file)
         self.file: BufferedIOBase = file
         self.setRecordFormat(recordFormat)
+
+    def __exit__(self, *args):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        super().__exit__(*args)
     
     def setRecordFormat(self, newFormat: str) -> None:
         self.recordFormat = newFormat
-        self.recordSize = struct.calcsize(newFormat)
+        self.recordStruct = struct.Struct(newFormat)
+        self.recordSize = self.recordStruct.size
 
     def readRecord(self) -> tuple:
         recordBytes = self.file.read(self.recordSize)
@@ -97,12 +213,74 @@ class StriderArchiveIO(StriderFileIO):
         if recordBytes:
             return tuple(struct.iter_unpack(self.recordFormat, recordBytes))
 
+    @staticmethod
+    def getRecordDtype(recordFormat: str, names: list[str]) -> "numpy.dtype":
+        """NumPy structured dtype matching the native record layout, including its alignment padding"""
+        if numpy is None:
+            raise ImportError("NumPy is required for array output, install strider[numpy]")
+        offsets = [struct.calcsize(recordFormat[:i+1]) - struct.calcsize(_type) for i, _type in enumerate(recordFormat)]
+        return numpy.dtype({"names": names, "formats": list(recordFormat), "offsets": offsets, "itemsize": struct.calcsize(recordFormat)})
+
+    def readRecordArray(self, startOffset: int, endOffset: int, dtype: "numpy.dtype") -> "numpy.ndarray":
+        """Copies the mapped records in `[startOffset, endOffset)` into a structured array without decoding them in Python"""
+        if self.map is None or endOffset <= startOffset:
+            return numpy.zeros(0, dtype)
+        with self.viewRecords(startOffset, endOffset) as records:
+            return numpy.frombuffer(bytearray(records), dtype)
+
+    def mapFile(self) -> int:
+        """Memory maps the file for reading, returns the mapped size"""
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            self.map = None
+            return 0
+        return len(self.map)
+
+    def findRecord(self, timestamp: int, startOffset: int, endOffset: int) -> int:
+        """Binary searches the mapped file for the offset of the first record in `[startOffset, endOffset)` with a timestamp >= `timestamp`"""
+        unpackTimestamp = struct.Struct("I").unpack_from
+        lo = 0
+        hi = (endOffset - startOffset) // self.recordSize
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if unpackTimestamp(self.map, startOffset + mid * self.recordSize)[0] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return startOffset + lo * self.recordSize
+
+    def findRecordRange(self, start: int, end: int, startOffset: int, endOffset: int) -> tuple[int, int]:
+        """Narrows `[startOffset, endOffset)` to the records with timestamps in `[start, end)`, records are laid out from `startOffset`"""
+        if self.map is None:
+            return 0, 0
+        endOffset = min(endOffset, len(self.map))
+        endOffset -= max(endOffset - startOffset, 0) % self.recordSize
+        startOffset = self.findRecord(start, startOffset, endOffset)
+        return startOffset, self.findRecord(end, startOffset, endOffset)
+
+    def viewRecords(self, startOffset: int, endOffset: int) -> memoryview:
+        """Zero-copy view of the mapped records, the view must be released before the file is closed"""
+        return memoryview(self.map)[startOffset:endOffset]
+
+    def readRecordRange(self, startOffset: int, endOffset: int) -> tuple:
+        """Decodes the mapped records in `[startOffset, endOffset)` in a single pass"""
+        if self.map is None or endOffset <= startOffset:
+            return ()
+        with memoryview(self.map) as view, view[startOffset:endOffset] as records:
+            return tuple(self.recordStruct.iter_unpack(records))
+
     def writeRecord(self, record: tuple) -> None:
         self.file.write(struct.pack(self.recordFormat, *record))
 
-        
+    def packRecords(self, records: tuple) -> bytes:
+        """Packs records back to back. Records are packed one by one since repeating a native format would insert alignment padding between them"""
+        pack = self.recordStruct.pack
+        return b"".join([pack(*record) for record in records])
+
     def writeRecords(self, records: tuple) -> None:
-        self.file.write(struct.pack(self.recordFormat*len(records), *[recordItem for record in records for recordItem in record]))
+        self.file.write(self.packRecords(records))
 
 
 class StriderFileUtil:
@@ -112,14 +290,36 @@ class StriderFileUtil:
     def getArchiveFilePath(self, archive: Union[DatabaseArchive | ArchiveFile], data=False) -> str:
         return os.path.join(self.databaseDirectory, f"achv_i{archive.index}_r{archive.resolution}.strdr{'data' if data else 'idx'}")
 
+    def getColumnFilePath(self, archive: Union[DatabaseArchive | ArchiveFile], column: int) -> str:
+        return os.path.join(self.databaseDirectory, f"achv_i{archive.index}_r{archive.resolution}_c{column}.strdrcol")
+
+    def getSummaryFilePath(self, archive: Union[DatabaseArchive | ArchiveFile]) -> str:
+        return os.path.join(self.databaseDirectory, f"achv_i{archive.index}_r{archive.resolution}.strdrsum")
+
+    def getOpenBlockFilePath(self, archive: Union[DatabaseArchive | ArchiveFile]) -> str:
+        return os.path.join(self.databaseDirectory, f"achv_i{archive.index}_r{archive.resolution}.strdropen")
+
     def getDatabaseFilepath(self) -> str:
         return os.path.join(self.databaseDirectory, "db.strdr")
+
+    def getWalFilePath(self) -> str:
+        return os.path.join(self.databaseDirectory, "wal.strdrwal")
+
+    def getLockFilePath(self) -> str:
+        return os.path.join(self.databaseDirectory, "db.strdrlock")
+
+    @staticmethod
+    def statFile(path: str) -> Union[None | tuple[int, int, int]]:
+        """Inode, modification time and size of a file, they change when the file is replaced or written to"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
     
     def safeOverwrite(self, old: str, new: str) -> None:
-        if os.path.exists(old):
-            os.remove(old)
-        shutil.copy2(new, old)
-        os.remove(new)
+        """Atomically replaces `old` with `new`"""
+        os.replace(new, old)
     
     def replaceArchive(self, archive: ArchiveFile, data: bool = False) -> None:
         old = self.getArchiveFilePath(archive, data)
@@ -0,0 +1,38 @@
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FileLock:
+    """Exclusive advisory lock on a file, held until released or until the process exits.
+    Locking relies on `fcntl.flock`, where it is unavailable every acquire succeeds"""
+    path: str
+    locked: bool = False
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = None
+
+    def acquire(self) -> bool:
+        """Takes the lock without waiting, returns False if another open file holds it"""
+        if self.locked:
+            return True
+        self.file = open(self.path, "a+b")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.file.close()
+                self.file = None
+                return False
+        self.locked = True
+        return True
+
+    def release(self) -> None:
+        if self.locked:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+            self.locked = False
@@ -0,0 +1,75 @@
+from typing import Callable, Union
+from bisect import bisect_left
+import functools
+import threading
+import time
+
+# upper bounds, in seconds, of the latency histogram buckets, followed by an unbounded bucket
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    """Counters and per operation latency histograms of a session and its archives.
+    Every counted value and observed latency is also passed to `callback(kind, name, value)`, with kind `counter` or `latency`, if set"""
+    counters: dict[str, int]
+    # per operation, the count of each latency bucket, the total count, the sum and the maximum in seconds
+    latencies: dict[str, list]
+    callback: Union[None | Callable[[str, str, float], None]] = None
+
+    def __init__(self, callback: Union[None | Callable[[str, str, float], None]] = None) -> None:
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.latencies = {}
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.callback is not None:
+            self.callback("counter", name, value)
+
+    def observe(self, operation: str, seconds: float) -> None:
+        with self.lock:
+            latency = self.latencies.get(operation)
+            if latency is None:
+                latency = self.latencies[operation] = [[0] * (len(LATENCY_BUCKETS) + 1), 0, 0.0, 0.0]
+            latency[0][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            latency[1] += 1
+            latency[2] += seconds
+            latency[3] = max(latency[3], seconds)
+        if self.callback is not None:
+            self.callback("latency", operation, seconds)
+
+    def snapshot(self) -> dict:
+        """Copy of the counters and, per operation, the latency count, sum and maximum in seconds
+        and the cumulative `(upper bound, count)` histogram buckets, the last bound being infinity"""
+        with self.lock:
+            latencies = {}
+            for operation, (buckets, count, total, maximum) in self.latencies.items():
+                cumulative, histogram = 0, []
+                for bound, bucketCount in zip((*LATENCY_BUCKETS, float("inf")), buckets):
+                    cumulative += bucketCount
+                    histogram.append((bound, cumulative))
+                latencies[operation] = {"count": count, "sum": total, "max": maximum, "buckets": histogram}
+            return {"counters": dict(self.counters), "latency": latencies}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters = {}
+            self.latencies = {}
+
+
+def timed(operation: str) -> Callable:
+    """Observes the latency of a method of an object with a `metrics` attribute, only a None check is added while metrics are disabled"""
+    def decorator(method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return method(self, *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(operation, time.perf_counter() - started)
+        return wrapper
+    return decorator
@@ -0,0 +1,63 @@
+from typing import Union, Callable
+import operator
+
+from strider.io import numpy
+from strider.aggregate import Accumulator
+
+# comparisons `where` filters can use
+WHERE_OPS: dict[str, Callable] = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge, "==": operator.eq, "!=": operator.ne}
+
+
+def parseWhere(where: Union[tuple, list]) -> tuple[tuple[str, str, Union[int | float | bool]], ...]:
+    """Normalizes a `(key, op, value)` comparison, or a sequence of comparisons that must all hold, to a tuple of comparisons"""
+    if len(where) and isinstance(where[0], str):
+        where = (where,)
+    comparisons = tuple(tuple(comparison) for comparison in where)
+    for comparison in comparisons:
+        if len(comparison) != 3 or comparison[1] not in WHERE_OPS:
+            raise ValueError(f"Invalid comparison {comparison}, comparisons are (key, op, value) with op one of {' '.join(WHERE_OPS)}")
+    return comparisons
+
+
+def bindWhere(where: tuple, keyNames: list[str]) -> Union[None | list[tuple[int, str, Union[int | float | bool]]]]:
+    """Comparisons on the record fields of an archive with keys `keyNames`. Keys the archive does not have read as 0,
+    returns None if a comparison on such a key fails, no record of the archive matches then"""
+    bound = []
+    for key, op, value in where:
+        if key in keyNames:
+            bound.append((keyNames.index(key) + 1, op, value))
+        elif not WHERE_OPS[op](0, value):
+            return None
+    return bound
+
+
+def filterRecords(records: Union[tuple, list], bound: list) -> list:
+    return [record for record in records if all(WHERE_OPS[op](record[field], value) for field, op, value in bound)]
+
+
+def maskArray(records: "numpy.ndarray", bound: list) -> "numpy.ndarray":
+    """Boolean mask of the records of a structured array matching every comparison"""
+    mask = numpy.ones(len(records), bool)
+    for field, op, value in bound:
+        mask &= WHERE_OPS[op](records[records.dtype.names[field]], value)
+    return mask
+
+
+def summaryMatches(summary: list[Accumulator], bound: list) -> bool:
+    """Whether any record summarized by `summary` could match every comparison, from the min and max of each field"""
+    for field, op, value in bound:
+        low, high = summary[field].min, summary[field].max
+        match op:
+            case "<" if not low < value:
+                return False
+            case "<=" if not low <= value:
+                return False
+            case ">" if not high > value:
+                return False
+            case ">=" if not high >= value:
+                return False
+            case "==" if not low <= value <= high:
+                return False
+            case "!=" if low == high == value:
+                return False
+    return True
@@ -1,103 +1,626 @@
 import math
 import os
+import copy
+import time
+import warnings
 from datetime import datetime
-from typing import Union
+from typing import Union, Iterator, Callable
+from collections import namedtuple
+from contextlib import closing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import struct
 
-CURRENT_REVISION = 0
-from strider.io import StriderFileIO, StriderFileUtil
+CURRENT_REVISION = 4
+from strider.io import StriderFileIO, StriderFileUtil, StriderArchiveIO, numpy
 from strider.database import DatabaseHandler
-from strider.archive import ArchiveHandler
+from strider.archive import ArchiveHandler, CHUNK_SIZE
+from strider.aggregate import Rollup, BucketAggregator, Accumulator, getRollupKey
+from strider.predicate import parseWhere
+from strider.cache import LRUCache
+from strider.wal import WriteAheadLog
+from strider.lock import FileLock
+from strider.metrics import Metrics, timed
 from strider.exceptions import *
 
-from strider.datatypes import Database, DatabaseArchive, ArchiveFile, ArchiveKey, ARCHIVE_RANGE, ARCHIVE_KEY_TYPES
+from strider.datatypes import Database, DatabaseArchive, ArchiveFile, ArchiveKey, ARCHIVE_RANGE, ARCHIVE_KEY_TYPES, ARCHIVE_LAYOUT, ARCHIVE_RESIDENCY, ARCHIVE_RESOLUTIONS, DOWNSAMPLE_FUNCS, QUERY_EXECUTORS, WAL_SYNC
+
+
+def _readArchive(handlerClass: type[ArchiveHandler], fileUtil: StriderFileUtil, databaseArchive: DatabaseArchive, read: str, args: tuple):
+    """Loads an archive and calls its `read` method, runs in query worker processes"""
+    return getattr(handlerClass(fileUtil).load(databaseArchive), read)(*args)
+
+
+def _reindexArchive(handlerClass: type[ArchiveHandler], fileUtil: StriderFileUtil, databaseArchive: DatabaseArchive, inteval: int) -> None:
+    """Loads an archive and re-indexes it, runs in reindex workers"""
+    handlerClass(fileUtil).load(databaseArchive).setIndexInteval(inteval)
 
 
 class DatabaseSession:
     """"""
     databaseHandler: DatabaseHandler
     fileUtil: StriderFileUtil
-    loadedArchives: dict[int, ArchiveHandler] = {}
-
-    def __init__(self, handler: DatabaseHandler, fileUtil: StriderFileUtil) -> None:
+    loadedArchives: LRUCache
+    writeArchives: dict[int, ArchiveHandler]
+    rollups: dict[int, Rollup]
+    bufferSize: int = 0
+    bufferAge: float = 0
+    tailSize: int = 0
+    residency: ARCHIVE_RESIDENCY = ARCHIVE_RESIDENCY.current
+    queryWorkers: int = 0
+    queryExecutor: QUERY_EXECUTORS = QUERY_EXECUTORS.thread
+    executor: Union[None | Executor] = None
+    # archive read results, keyed by archive, read method and arguments, see `_readArchives`
+    queryCache: LRUCache
+    wal: Union[None | WriteAheadLog] = None
+    walEnabled: bool = False
+    walSync: WAL_SYNC = WAL_SYNC.always
+    walSyncInterval: float = 0.1
+    walCheckpointSize: int = 0
+    # archives written to since the last checkpoint
+    walArchives: dict[tuple[int, int], ArchiveHandler]
+    # held by the one session per database allowed to write
+    writeLock: FileLock
+    # shared with the database handler and the loaded archives, None while metrics are disabled
+    metrics: Union[None | Metrics] = None
+
+    def __init__(self, handler: DatabaseHandler, fileUtil: StriderFileUtil, bufferSize: int = 0, bufferAge: float = 0, tailSize: int = 0,
+                 residency: ARCHIVE_RESIDENCY = ARCHIVE_RESIDENCY.current, archiveCacheSize: int = 8,
+                 queryWorkers: int = 0, queryExecutor: QUERY_EXECUTORS = QUERY_EXECUTORS.thread,
+                 wal: bool = False, walSync: WAL_SYNC = WAL_SYNC.always, walSyncInterval: float = 0.1, walCheckpointSize: int = 4 * 1024 * 1024,
+                 queryCacheSize: int = 0, metrics: bool = False, metricsCallback: Union[None | Callable[[str, str, float], None]] = None) -> None:
+        """`bufferSize` and `bufferAge` enable buffered writes on the archive being written to, see `ArchiveHandler.setBuffer`.
+        `tailSize` keeps the most recent records written to an archive in memory for reads, see `ArchiveHandler.setTail`.
+        `residency` sets which archives stay loaded, `all` loads every archive upfront, `current` loads archives on first access
+        and keeps the `archiveCacheSize` most recently used ones, `none` only keeps the archives being written to.
+        `queryWorkers` reads the archives of a query in parallel on a pool of that many `queryExecutor` workers, threads or processes.
+        `wal` logs every raw record to a write-ahead log before it is buffered, forced to disk according to `walSync`, see `WriteAheadLog`.
+        The log is checkpointed, archives synced to disk and the log emptied, once it grows past `walCheckpointSize` bytes and on close.
+        Any number of sessions, in any process, can read a database but only one can write to it. A session becomes the writer on its first write
+        and stays it until closed, writes from other sessions raise `DatabaseLocked`. Other sessions pick up the writer's flushed records on each query.
+        `queryCacheSize` caches the query results of archives whose range has ended, up to that many records, see `_readArchives`.
+        `metrics`, or a `metricsCallback`, counts operation latencies, bytes and records read and written, index entries visited,
+        archives opened and cache hits, see `getMetrics` and `Metrics`. Reads done by `queryExecutor` worker processes are not counted"""
         self.databaseHandler = handler
+        if metrics or metricsCallback is not None:
+            self.metrics = Metrics(metricsCallback)
+            handler.metrics = self.metrics
         self.fileUtil = fileUtil
-        self.loadedArchives = handler.loadArchives()
-
-    def _getArchiveForDate(self, date: datetime) -> Union[None | ArchiveHandler]:
+        self.bufferSize = bufferSize
+        self.bufferAge = bufferAge
+        self.tailSize = tailSize
+        self.residency = residency
+        self.queryWorkers = queryWorkers
+        self.queryExecutor = queryExecutor
+        self.walCheckpointSize = walCheckpointSize
+        self.walArchives = {}
+        self.walEnabled = wal
+        self.walSync = walSync
+        self.walSyncInterval = walSyncInterval
+        self.writeLock = FileLock(fileUtil.getLockFilePath())
+        self.queryCache = LRUCache(queryCacheSize, sizeOf=lambda result: max(len(result), 1))
+        self.writeArchives = {}
+        self.rollups = {}
+        match residency:
+            case ARCHIVE_RESIDENCY.all:
+                cacheSize = None
+            case ARCHIVE_RESIDENCY.current:
+                cacheSize = archiveCacheSize
+            case ARCHIVE_RESIDENCY.none:
+                cacheSize = 0
+        self.loadedArchives = LRUCache(cacheSize, lambda archive: archive.close(), self._isWriteArchive)
+        if residency == ARCHIVE_RESIDENCY.all:
+            for archiveKey, archive in handler.loadArchives().items():
+                self.loadedArchives[archiveKey] = archive
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _getArchiveForDate(self, date: datetime, resolution: int = 0) -> Union[None | ArchiveHandler]:
         archiveKey = self.databaseHandler.getArchiveKey(date)
 
-        if archiveKey in self.loadedArchives:
-            return self.loadedArchives[archiveKey]
+        writeArchive = self.writeArchives.get(resolution)
+        if writeArchive is not None and writeArchive.archive.minRange == archiveKey:
+            return writeArchive
 
-        if self.databaseHandler.hasArchive(archiveKey):
-            archive = self.databaseHandler.loadArchive(archiveKey)
-            self.loadedArchives[archiveKey] = archive
+        if (archiveKey, resolution) in self.loadedArchives:
+            if self.metrics is not None:
+                self.metrics.count("archiveCacheHits")
+            return self.loadedArchives[(archiveKey, resolution)]
+
+        if self.databaseHandler.hasArchive(archiveKey, resolution):
+            archive = self.databaseHandler.loadArchive(archiveKey, resolution)
+            self.loadedArchives[(archiveKey, resolution)] = archive
             return archive
 
         return None
 
-    def _getOrCreateArchive(self, date: datetime) -> ArchiveHandler:
-        archiveHandler = self._getArchiveForDate(date)
+    def _getOrCreateArchive(self, date: datetime, resolution: int = 0) -> ArchiveHandler:
+        archiveHandler = self._getArchiveForDate(date, resolution)
         if archiveHandler is None:
-            archiveHandler = self.databaseHandler.createArchive(date)
-            self.loadedArchives[archiveHandler.archive.minRange] = archiveHandler
+            archiveHandler = self.databaseHandler.createArchive(date, resolution)
+        self._setWriteArchive(archiveHandler, resolution)
+        self.loadedArchives[(archiveHandler.archive.minRange, resolution)] = archiveHandler
         return archiveHandler
+
+    def _lockWriter(self) -> None:
+        """Makes this session the database writer, the database is refreshed since another writer may have changed it"""
+        if self.writeLock.locked:
+            return
+        if not self.writeLock.acquire():
+            raise DatabaseLocked()
+        self.refresh()
+        if self.walEnabled:
+            self.wal = WriteAheadLog(self.fileUtil.getWalFilePath(), self.walSync, self.walSyncInterval)
+
+    def _unlockWriter(self) -> None:
+        """Writes buffered records and lets other sessions write. Unfinished rollup buckets are dropped, the next writer restores them, see `_getRollups`"""
+        for writeArchive in self.writeArchives.values():
+            writeArchive.close()
+            writeArchive.setTail(0)
+        self.writeArchives = {}
+        self.rollups = {}
+        if self.wal is not None:
+            self.checkpoint()
+            self.wal.close()
+            self.wal = None
+        self.walArchives = {}
+        self.writeLock.release()
+
+    def refresh(self) -> None:
+        """Picks up the changes other sessions made to the database and its loaded archives"""
+        self.databaseHandler.refresh()
+        for archiveKey, archive in list(self.loadedArchives.items()):
+            self._refreshArchive(archive, archiveKey[1])
+
+    def _refreshArchive(self, archive: ArchiveHandler, resolution: int = 0) -> ArchiveHandler:
+        """Archives rewritten by another session are loaded again, cached results of changed archives are dropped"""
+        size = archive.getStoredSize()
+        refreshed = archive.refresh()
+        if refreshed and size == archive.getStoredSize():
+            return archive
+        self._invalidateQueryCache(archive.archive.minRange, resolution)
+        if refreshed:
+            return archive
+        archive.close()
+        archive = self.databaseHandler.loadArchive(archive.archive.minRange, resolution)
+        self.loadedArchives[(archive.archive.minRange, resolution)] = archive
+        return archive
+
+    def _isWriteArchive(self, archiveHandler: ArchiveHandler) -> bool:
+        """Archives being written to are never evicted from the archive cache"""
+        return any(archiveHandler is writeArchive for writeArchive in self.writeArchives.values())
+
+    def _setWriteArchive(self, archiveHandler: ArchiveHandler, resolution: int = 0) -> None:
+        """Only one archive per resolution keeps its data file open for writing, switching archives releases the previous one"""
+        writeArchive = self.writeArchives.get(resolution)
+        if archiveHandler is not writeArchive:
+            if writeArchive is not None:
+                writeArchive.close()
+                writeArchive.setTail(0)
+            archiveHandler.setBuffer(self.bufferSize, self.bufferAge)
+            archiveHandler.setTail(self.tailSize)
+            archiveHandler.wal = self.wal if resolution == 0 else None
+            self.writeArchives[resolution] = archiveHandler
+            self.walArchives[(archiveHandler.archive.minRange, resolution)] = archiveHandler
+            self.loadedArchives.evict()
+            self._invalidateQueryCache(archiveHandler.archive.minRange, resolution)
+
+    def _invalidateQueryCache(self, archiveKey: Union[None | int] = None, resolution: int = 0) -> None:
+        """Drops the cached results of an archive, of every archive if `archiveKey` is None"""
+        if not len(self.queryCache):
+            return
+        if archiveKey is None:
+            self.queryCache.clear()
+            return
+        for cacheKey in [cacheKey for cacheKey in self.queryCache.keys() if cacheKey[:2] == (archiveKey, resolution)]:
+            self.queryCache.pop(cacheKey)
+
+    @timed("flush")
+    def flush(self) -> None:
+        """Writes buffered records to disk, the write-ahead log is forced to disk"""
+        for writeArchive in self.writeArchives.values():
+            writeArchive.flush()
+        if self.wal is not None:
+            self.wal.fsync()
+
+    @timed("checkpoint")
+    def checkpoint(self) -> None:
+        """Forces the archives written since the last checkpoint to disk and empties the write-ahead log"""
+        for archive in self.walArchives.values():
+            archive.sync()
+        self.walArchives = {(archive.archive.minRange, resolution): archive for resolution, archive in self.writeArchives.items()}
+        if self.wal is not None:
+            self.wal.truncate()
+        elif self.writeLock.locked and os.path.isfile(self.fileUtil.getWalFilePath()):
+            os.remove(self.fileUtil.getWalFilePath())
+
+    def replayWal(self) -> int:
+        """Writes the logged records that did not reach the archives and checkpoints, returns the number of records written.
+        An archive holds every logged record up to its last entry, records with that timestamp are matched by count.
+        Nothing is replayed while another session writes to the database, the log is still in use"""
+        if not os.path.isfile(self.fileUtil.getWalFilePath()):
+            return 0
+        try:
+            self._lockWriter()
+        except DatabaseLocked:
+            return 0
+        wal, self.wal = self.wal, None
+        durable = {}
+        replayed = 0
+        try:
+            keyCount = len(self.databaseHandler.getKeys())
+            for recordFormat, records in WriteAheadLog.readEntries(self.fileUtil.getWalFilePath()):
+                if not records:
+                    continue
+                archive = self._getOrCreateArchive(datetime.fromtimestamp(records[0][0]))
+                if archive.archive.minRange not in durable:
+                    lastTimestamp = archive.getLastEntryTimestamp()
+                    count = len(archive.readRecords(lastTimestamp, lastTimestamp + 1, raw=True)) if lastTimestamp is not None else 0
+                    durable[archive.archive.minRange] = [lastTimestamp if lastTimestamp is not None else -1, count]
+                last = durable[archive.archive.minRange]
+
+                newRecords = []
+                for record in records:
+                    if record[0] < last[0]:
+                        continue
+                    if record[0] == last[0] and last[1]:
+                        last[1] -= 1
+                        continue
+                    # records logged before a key was added get it zero filled
+                    newRecords.append((*record, *[0] * (keyCount + 1 - len(record))))
+                self._writeRecords(archive, newRecords)
+                replayed += len(newRecords)
+        finally:
+            self.wal = wal
+            if 0 in self.writeArchives:
+                self.writeArchives[0].wal = wal
+        self.checkpoint()
+        self._unlockWriter()
+        return replayed
+
+    def close(self) -> None:
+        """Flushes buffered records, releases open archive files and the write lock"""
+        for archive in self.loadedArchives.values():
+            archive.close()
+        self._unlockWriter()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def getMetrics(self) -> dict:
+        """Snapshot of the counters and latency histograms, see `Metrics.snapshot`, empty if metrics are disabled"""
+        if self.metrics is None:
+            return {}
+        return self.metrics.snapshot()
+
+    def _getExecutor(self) -> Executor:
+        if self.executor is None:
+            if self.queryExecutor == QUERY_EXECUTORS.process:
+                self.executor = ProcessPoolExecutor(self.queryWorkers)
+            else:
+                self.executor = ThreadPoolExecutor(self.queryWorkers, "strider-query")
+        return self.executor
+
+    def _getQueryCacheKey(self, archive: ArchiveHandler, read: str, args: tuple) -> Union[None | tuple]:
+        """Cache key of an archive read, None if the archive can still change. An archive's range has ended once
+        its `maxRange` is past, archives being written to are left out for backfills. The time range is clipped to the archive,
+        so queries ending at the current time share the results of ended archives"""
+        if not self.queryCache.maxSize or archive.archive.maxRange > time.time() or self._isWriteArchive(archive):
+            return None
+        start, end, *options = args
+        return (archive.archive.minRange, archive.archive.resolution, read,
+                max(start, archive.archive.minRange), min(end, archive.archive.maxRange), *options)
+
+    def _readArchives(self, archives: list[ArchiveHandler], read: str, *args) -> list:
+        """Calls the `read(start, end, ...)` method of each archive, results of archives whose range has ended are served from the query cache if enabled.
+        Results are returned in archive order, archives cover consecutive ranges so that is timestamp order.
+        Cached results are copies, so callers can modify them"""
+        cacheKeys = [self._getQueryCacheKey(archive, read, args) for archive in archives]
+        results = [copy.copy(self.queryCache[cacheKey]) if cacheKey in self.queryCache else None for cacheKey in cacheKeys]
+        if self.metrics is not None:
+            cached = sum(result is not None for result in results)
+            self.metrics.count("queryCacheHits", cached)
+            self.metrics.count("queryCacheMisses", sum(cacheKey is not None for cacheKey in cacheKeys) - cached)
+
+        misses = [i for i, result in enumerate(results) if result is None]
+        for i, result in zip(misses, self._readUncached([archives[i] for i in misses], read, *args)):
+            results[i] = result
+            if cacheKeys[i] is not None:
+                self.queryCache[cacheKeys[i]] = copy.copy(result)
+        return results
+
+    def _readUncached(self, archives: list[ArchiveHandler], read: str, *args) -> list:
+        """Calls the `read` method of each archive, in parallel on the query workers if there are more than one archive.
+        Buffered records are flushed first, worker processes load the archives from disk and ignore the in-memory tail"""
+        if not self.queryWorkers or len(archives) < 2:
+            return [getattr(archive, read)(*args) for archive in archives]
+
+        self.flush()
+        executor = self._getExecutor()
+        if self.queryExecutor == QUERY_EXECUTORS.process:
+            futures = [executor.submit(_readArchive, type(archive), self.fileUtil,
+                                       DatabaseArchive(archive.archive.minRange, archive.archive.maxRange, archive.archive.index, archive.archive.resolution),
+                                       read, args) for archive in archives]
+        else:
+            futures = [executor.submit(getattr(archive, read), *args) for archive in archives]
+        return [future.result() for future in futures]
     
-    def _getActiveArchive(self) -> Union[None | ArchiveHandler]:
+    def _getActiveArchive(self, resolution: int = 0) -> Union[None | ArchiveHandler]:
         date = datetime.now()
-        return self._getArchiveForDate(date)
-
-    def query(self, start: datetime, end: datetime, key: Union[None | str] = None, raw: bool = False, asArrays:bool = False) -> Union[list | dict]:
-        """Queries from start to end date. If `key` is set, returns a single key in `{timestamp:keyvalue}` format. If `raw` is set, returns records as tuples"""
+        return self._getArchiveForDate(date, resolution)
+
+    def _getArchivesForRange(self, start: datetime, end: datetime, resolution: int = 0) -> list[ArchiveHandler]:
+        """Existing archives of the `resolution` level from start to end date, in order.
+        Unless this session is the writer, the archives are refreshed first"""
+        reader = not self.writeLock.locked
+        if reader:
+            self.databaseHandler.refresh()
         startTimestamp = int(start.timestamp())
-        endTimestamp = int(end.timestamp())
         archivePeriod = self.databaseHandler.getArchivePeriod(start)
         startArchive = self.databaseHandler.getArchiveKey(start)
         endArchive = self.databaseHandler.getArchiveKey(end)
         archiveCount = int((endArchive+archivePeriod - startArchive) / archivePeriod)
-        
-        results = []
 
+        archives = []
         for archiveI in range(archiveCount):
-            archive = self._getArchiveForDate(datetime.fromtimestamp(startTimestamp + (archiveI * archivePeriod)))
+            archive = self._getArchiveForDate(datetime.fromtimestamp(startTimestamp + (archiveI * archivePeriod)), resolution)
             if archive:
-                results += archive.readRecords(startTimestamp, endTimestamp, key, raw if not asArrays else True)
+                archives.append(self._refreshArchive(archive, resolution) if reader else archive)
+        return archives
+
+    @timed("query")
+    def query(self, start: datetime, end: datetime, key: Union[None | str] = None, raw: bool = False, asArrays:bool = False, format: Union[None | str] = None, resolution: int = 0,
+              where: Union[tuple, list] = ()) -> Union[list | dict]:
+        """Queries from start to end date. If `key` is set, returns a single key in `{timestamp:keyvalue}` format. If `raw` is set, returns records as tuples.
+        `format="numpy"` returns a NumPy structured array with a `timestamp` field and a field per database key.
+        `resolution` in seconds serves the query from the coarsest rollup with records at most that far apart, rollup records are timestamped at the start of their bucket.
+        `where` only returns records matching a `(key, op, value)` comparison, or every comparison of a list, with op one of `< <= > >= == !=`.
+        Records are filtered as they are read, keys an archive does not have compare as 0"""
+        startTimestamp = int(start.timestamp())
+        endTimestamp = int(end.timestamp())
+        level = self.databaseHandler.getResolutionLevel(resolution)
+        where = parseWhere(where)
+        databaseKeys = [databaseKey.name for databaseKey in self.databaseHandler.getKeys(level)]
+        for comparison in where:
+            if comparison[0] not in databaseKeys:
+                raise ValueError(f"Unknown key {comparison[0]}")
+        archives = self._getArchivesForRange(start, end, level)
+
+        if format == "numpy":
+            results = self._queryArray(archives, startTimestamp, endTimestamp, level, where)
+            if self.metrics is not None:
+                self.metrics.count("recordsReturned", len(results))
+            return results
+        elif format is not None:
+            raise ValueError(f"Unknown query format {format}")
+        
+        results = {} if key else []
+        archive = None
+
+        # records are read raw and wrapped here, the per archive namedtuples cannot be sent back from worker processes
+        for archive, records in zip(archives, self._readArchives(archives, "readRecords", startTimestamp, endTimestamp, key, True, where)):
+            if key:
+                results.update(records)
+            else:
+                results += records if raw or asArrays else archive.makeRecords(records)
+        if self.metrics is not None:
+            self.metrics.count("recordsReturned", len(results))
 
         if asArrays and len(results):
-            keys = ["time", *[key.name for key in (archive.archive.keys if archive else self.databaseHandler.getKeys())]]
+            keys = ["time", *[key.name for key in (archive.archive.keys if archive else self.databaseHandler.getKeys(level))]]
             return {keyName: [record[recordIndex] for record in results] for recordIndex, keyName in enumerate(keys)}
         
         return results
 
+    @timed("aggregate")
+    def aggregate(self, start: datetime, end: datetime, bucket: int, funcs: list = (DOWNSAMPLE_FUNCS.avg,), keys: Union[None | list[str]] = None, chunkSize: int = CHUNK_SIZE) -> list:
+        """Aggregates `keys`, all by default, from start to end date into `bucket` second buckets with each of `funcs` (avg, min, max, sum, last, count).
+        Returns a record per non empty bucket with a `{key}_{func}` field per key and function.
+        Archives are streamed in chunks of `chunkSize` records, so memory is bounded by the number of buckets.
+        Index entries whose records all fall in one bucket are folded from their summaries without reading them, see `ArchiveHandler.iterSummarized`"""
+        funcs = [DOWNSAMPLE_FUNCS[func] if isinstance(func, str) else DOWNSAMPLE_FUNCS(func) for func in funcs]
+        keys = list(keys) if keys else [key.name for key in self.databaseHandler.getKeys()]
+        startTimestamp = int(start.timestamp())
+        endTimestamp = int(end.timestamp())
+        aggregator = BucketAggregator(int(bucket), len(keys))
+
+        for archive in self._getArchivesForRange(start, end):
+            archiveKeys = [archiveKey.name for archiveKey in archive.archive.keys]
+            columns = [(keyI, archiveKeys.index(key) + 1) for keyI, key in enumerate(keys) if key in archiveKeys]
+            for chunk in archive.iterSummarized(startTimestamp, endTimestamp, int(bucket), chunkSize):
+                if isinstance(chunk[0], Accumulator):
+                    aggregator.addSummary(chunk, columns)
+                else:
+                    aggregator.addChunk(chunk, columns)
+
+        recordTuple = namedtuple("Aggregate", ["timestamp", *[f"{key}_{func.name}" for key in keys for func in funcs]])
+        return [tuple.__new__(recordTuple, record) for record in aggregator.results(funcs)]
+
+    def iterQuery(self, start: datetime, end: datetime, keys: Union[None | list[str]] = None, chunkSize: int = CHUNK_SIZE, raw: bool = False, format: Union[None | str] = None, resolution: int = 0) -> Iterator[Union[list, "numpy.ndarray"]]:
+        """Yields the records from start to end date in chunks of up to `chunkSize` records, archive by archive.
+        Chunks hold namedtuples, tuples if `raw` is set or a NumPy structured array with `format="numpy"`, restricted to `keys` if set.
+        Each archive's files are only open while its chunks are consumed, so the caller can stop at any point"""
+        startTimestamp = int(start.timestamp())
+        endTimestamp = int(end.timestamp())
+        level = self.databaseHandler.getResolutionLevel(resolution)
+        databaseKeys = [key for key in self.databaseHandler.getKeys(level) if keys is None or key.name in keys]
+        keyNames = [key.name for key in databaseKeys]
+
+        if format == "numpy":
+            dtype = self._getRecordDtype(databaseKeys)
+            for archive in self._getArchivesForRange(start, end, level):
+                with closing(archive.iterArrays(startTimestamp, endTimestamp, chunkSize)) as chunks:
+                    for chunk in chunks:
+                        yield self._conformArray(chunk, dtype)
+            return
+        elif format is not None:
+            raise ValueError(f"Unknown query format {format}")
+
+        recordTuple = namedtuple("Record", ["timestamp", *keyNames])
+        for archive in self._getArchivesForRange(start, end, level):
+            archiveKeys = [key.name for key in archive.archive.keys]
+            columns = [archiveKeys.index(key) + 1 if key in archiveKeys else None for key in keyNames]
+            project = archiveKeys != keyNames
+            with closing(archive.iterRecords(startTimestamp, endTimestamp, chunkSize)) as chunks:
+                for chunk in chunks:
+                    if project:
+                        chunk = [(record[0], *[record[column] if column else 0 for column in columns]) for record in chunk]
+                    yield list(chunk) if raw else [tuple.__new__(recordTuple, record) for record in chunk]
+
+    def _getRecordDtype(self, keys: list[ArchiveKey]) -> "numpy.dtype":
+        return StriderArchiveIO.getRecordDtype("I" + "".join(ARCHIVE_KEY_TYPES(key.type).name for key in keys), ["timestamp", *[key.name for key in keys]])
+
+    def _conformArray(self, array: "numpy.ndarray", dtype: "numpy.dtype") -> "numpy.ndarray":
+        """Casts an archive's structured array to `dtype`, fields missing from the archive are zero filled"""
+        if array.dtype == dtype:
+            return array
+        conformed = numpy.zeros(len(array), dtype)
+        for name in dtype.names:
+            if name in array.dtype.names:
+                conformed[name] = array[name]
+        return conformed
+
+    def _queryArray(self, archives: list[ArchiveHandler], start: int, end: int, resolution: int = 0, where: tuple = ()) -> "numpy.ndarray":
+        """Concatenates each archive's structured array. Archives created before a key was added get that key zero filled"""
+        dtype = self._getRecordDtype(self.databaseHandler.getKeys(resolution))
+        arrays = [self._conformArray(array, dtype) for array in self._readArchives(archives, "readArray", start, end, where)]
+
+        if not arrays:
+            return numpy.zeros(0, dtype)
+        return numpy.concatenate(arrays) if len(arrays) > 1 else arrays[0]
+
+    @timed("add")
     def add(self, time: datetime, data: dict) -> None:
         """Adds an entry to the database."""
         if len(data) == 0:
             raise ValueError("Data is empty")
         
+        self._lockWriter()
         archive = self._getOrCreateArchive(time)
         databaseKeys = [key.name for key in self.databaseHandler.getKeys()]
         record = [int(time.timestamp())]
         record.extend([data.get(key, 0) for key in databaseKeys])
 
-        archive.writeRecords([record])
+        self._writeRecords(archive, [record])
+
+    def _writeRecords(self, archive: ArchiveHandler, records: list) -> None:
+        """Writes records to a raw archive and folds them into the rollups"""
+        if not records:
+            return
+        rollups = self._getRollups(records[0][0])
+        archive.writeRecords(records)
+        for level, rollup in rollups.items():
+            self._writeRollup(level, rollup.add(records))
+        self._checkWal()
+
+    def _checkWal(self) -> None:
+        if self.wal is not None and self.wal.size() >= self.walCheckpointSize:
+            self.checkpoint()
+
+    def _getRollups(self, timestamp: int) -> dict[int, Rollup]:
+        """Rollup states, on first use the unfinished buckets are restored from the raw archives up to `timestamp`.
+        Raw records after the last written rollup bucket are folded again, without rollup records only those of the current bucket are,
+        see `backfillRollups`"""
+        for level in self.databaseHandler.getRollups():
+            if level not in self.rollups:
+                period = ARCHIVE_RESOLUTIONS[level]
+                rollup = Rollup(period, self.databaseHandler.getKeys())
+                lastTimestamp = self._getLastRollupTimestamp(level)
+                recoverFrom = lastTimestamp + period if lastTimestamp is not None else timestamp - timestamp % period
+
+                for chunk in self.iterQuery(datetime.fromtimestamp(recoverFrom), datetime.fromtimestamp(timestamp + 1), raw=True):
+                    self._writeRollup(level, rollup.add(chunk))
+                self.rollups[level] = rollup
+        return self.rollups
+
+    def _getLastRollupTimestamp(self, level: int) -> Union[None | int]:
+        lastArchive = self.databaseHandler.getLastArchive(level)
+        if lastArchive is None:
+            return None
+        return self._getArchiveForDate(datetime.fromtimestamp(lastArchive.minRange), level).getLastEntryTimestamp()
+
+    def _writeRollup(self, resolution: int, records: list) -> None:
+        """Writes completed rollup buckets. The raw records they were folded from are already written,
+        so a bucket that cannot be stored is dropped with a warning instead of failing the write"""
+        recordsQueue = []
+        archive = None
+        for record in records:
+            recordArchive = self._getOrCreateArchive(datetime.fromtimestamp(record[0]), resolution)
+            if recordArchive is not archive:
+                if recordsQueue:
+                    self._writeRollupRecords(archive, recordsQueue)
+                recordsQueue = []
+                archive = recordArchive
+            recordsQueue.append(record)
+
+        if recordsQueue:
+            self._writeRollupRecords(archive, recordsQueue)
 
-    def addKey(self, keyName: str, keyType: str) -> None:
-        """"Adds keyName to the database keys. This operation only affects current and future archives since the database does not have update operations (yet?)"""
-        archiveKey = ArchiveKey(keyName, 0, ARCHIVE_KEY_TYPES(keyType))
+    def _writeRollupRecords(self, archive: ArchiveHandler, records: list) -> None:
+        try:
+            archive.writeRecords(records)
+        except (struct.error, SequenceViolation) as error:
+            if self.metrics is not None:
+                self.metrics.count("rollupErrors", len(records))
+            warnings.warn(f"Dropped {len(records)} records of the {ARCHIVE_RESOLUTIONS[archive.archive.resolution]}s rollup: {error}", RuntimeWarning)
+
+    @timed("addKey")
+    def addKey(self, keyName: str, keyType: str, downsampleFunc: DOWNSAMPLE_FUNCS = DOWNSAMPLE_FUNCS.avg) -> None:
+        """"Adds keyName to the database keys. This operation only affects current and future archives since the database does not have update operations (yet?)
+        `downsampleFunc` folds the key values in rollup archives"""
+        archiveKey = ArchiveKey(keyName, DOWNSAMPLE_FUNCS(downsampleFunc).value, ARCHIVE_KEY_TYPES(keyType))
+        self._lockWriter()
+        self._invalidateQueryCache()
         self.databaseHandler.addKey(archiveKey)
         
         activeArchive = self._getActiveArchive()
         if activeArchive:
             activeArchive.addKey(archiveKey)
 
-    def setIndexInteval(self, inteval: int, full: bool = False) -> None:
-        """"Changes database index inteval if ´full´ is False, only re-indexes the current archive"""
+        for level in self.databaseHandler.getRollups():
+            activeArchive = self._getActiveArchive(level)
+            if activeArchive:
+                activeArchive.addKey(getRollupKey(archiveKey))
+        self.rollups = {}
+
+    def setRollups(self, resolutions: list[int]) -> None:
+        """Keeps rollup archives, downsampled to each of `resolutions` in seconds, up to date from now on, see `backfillRollups` for the history"""
+        self._lockWriter()
+        self.flush()
+        self.databaseHandler.setRollups(resolutions)
+        self.rollups = {}
+
+    def backfillRollups(self, chunkSize: int = CHUNK_SIZE) -> None:
+        """Downsamples the whole raw history into the rollup levels without rollup records yet, streamed `chunkSize` records at a time.
+        `setRollups` only keeps rollups up to date from the current bucket on"""
+        self._lockWriter()
+        self.flush()
+        firstArchive = self.databaseHandler.getFirstArchive()
+        lastArchive = self.databaseHandler.getLastArchive()
+        if firstArchive is None:
+            return
+
+        for level in self.databaseHandler.getRollups():
+            if self._getLastRollupTimestamp(level) is None:
+                rollup = Rollup(ARCHIVE_RESOLUTIONS[level], self.databaseHandler.getKeys())
+                for chunk in self.iterQuery(datetime.fromtimestamp(firstArchive.minRange), datetime.fromtimestamp(lastArchive.maxRange + 1), chunkSize=chunkSize, raw=True):
+                    self._writeRollup(level, rollup.add(chunk))
+                self.rollups[level] = rollup
+
+    @timed("setIndexInteval")
+    def setIndexInteval(self, inteval: int, full: bool = False, workers: int = 0, progress: Union[None | Callable[[int, int], None]] = None) -> None:
+        """"Changes database index inteval if ´full´ is False, only re-indexes the current archive.
+        Otherwise every archive of the database is re-indexed, each one streamed and its new index renamed into place, see `ArchiveHandler.setIndexInteval`.
+        Archives not being written to are re-indexed on a pool of `workers` `queryExecutor` workers if set, `progress(done, total)` is called as each archive is done"""
         inteval = int(inteval)
+        self._lockWriter()
+        self._invalidateQueryCache()
         
         if full:
-            for archive in self.loadedArchives.values():
-                archive.setIndexInteval(inteval)
+            self._reindexArchives(inteval, workers, progress)
         else:
             activeArchive = self._getActiveArchive()
             if activeArchive:
@@ -106,15 +629,47 @@ class DatabaseSession:
         return True
 
 
-    def bulkAdd(self, ingest: dict) -> None:
+    def _reindexArchives(self, inteval: int, workers: int = 0, progress: Union[None | Callable[[int, int], None]] = None) -> None:
+        """Re-indexes every archive, archives being written to in this session and the others on `workers` workers, see `setIndexInteval`"""
+        self.flush()
+        databaseArchives = list(self.databaseHandler.database.archives)
+        writeArchives = {(archive.archive.minRange, archive.archive.resolution): archive for archive in self.writeArchives.values()}
+        pending = [databaseArchive for databaseArchive in databaseArchives if (databaseArchive.minRange, databaseArchive.resolution) not in writeArchives]
+        for databaseArchive in pending:
+            # loaded again with its new index on next access
+            loadedArchive = self.loadedArchives.pop((databaseArchive.minRange, databaseArchive.resolution))
+            if loadedArchive is not None:
+                loadedArchive.close()
+
+        def reindex() -> Iterator[None]:
+            for archive in writeArchives.values():
+                yield archive.setIndexInteval(inteval)
+            handlerClass = self.databaseHandler.getArchiveHandler()
+            if not workers:
+                for databaseArchive in pending:
+                    yield _reindexArchive(handlerClass, self.fileUtil, databaseArchive, inteval)
+                return
+            with ProcessPoolExecutor(workers) if self.queryExecutor == QUERY_EXECUTORS.process else ThreadPoolExecutor(workers, "strider-reindex") as executor:
+                futures = [executor.submit(_reindexArchive, handlerClass, self.fileUtil, databaseArchive, inteval) for databaseArchive in pending]
+                for future in as_completed(futures):
+                    yield future.result()
+
+        for done, _ in enumerate(reindex(), 1):
+            if progress is not None:
+                progress(done, len(databaseArchives))
+
+    @timed("bulkAdd")
+    def bulkAdd(self, ingest: Union[dict, list]) -> None:
         """Add data to Database in bulk. 
-        This function ingests data as a dictionary `datetime:{key:value}`
+        This function ingests data as a dictionary `datetime:{key:value}` or a list of `(datetime, {key:value})` pairs
         keys already must exist in the database
         TODO type safety"""
         if len(ingest) == 0:
-            return None
+            raise ValueError("Data is empty")
+        ingest = ingest.items() if isinstance(ingest, dict) else ingest
+        self._lockWriter()
         
-        time: datetime = next(iter(ingest))
+        time: datetime = next(iter(ingest))[0]
         archive = self._getOrCreateArchive(time)
         archiveKey = self.databaseHandler.getArchiveKey(time)
         archivePeriod = self.databaseHandler.getArchivePeriod(time)
@@ -123,11 +678,11 @@ class DatabaseSession:
         
         recordsQueue = []
 
-        for time, dataDict in ingest.items():
+        for time, dataDict in ingest:
             timestamp = int(time.timestamp())
 
-            if (timestamp > archiveKey+archivePeriod):
-                archive.writeRecords(recordsQueue)
+            if (timestamp >= archiveKey+archivePeriod):
+                self._writeRecords(archive, recordsQueue)
                 recordsQueue = []
                 archive = self._getOrCreateArchive(time)
                 archiveKey = self.databaseHandler.getArchiveKey(time)
@@ -137,7 +692,47 @@ class DatabaseSession:
             record.extend([dataDict.get(key, 0) for key in databaseKeys])
             recordsQueue.append(record)
 
-        archive.writeRecords(recordsQueue)
+        self._writeRecords(archive, recordsQueue)
+
+    @timed("bulkAddArrays")
+    def bulkAddArrays(self, timestamps: Union[list, "numpy.ndarray"], columns: dict) -> None:
+        """Add data to Database in bulk from arrays. `timestamps` are epoch seconds in ascending order,
+        `columns` maps key names to sequences or NumPy arrays of their values, keys left out are zero filled.
+        Records are split at archive boundaries with a binary search and each archive's records are packed in one step. Requires NumPy"""
+        dtype = self._getRecordDtype(self.databaseHandler.getKeys())
+        records = numpy.zeros(len(timestamps), dtype)
+        if len(records) == 0:
+            raise ValueError("Data is empty")
+        for keyName, values in columns.items():
+            if keyName not in records.dtype.names[1:]:
+                raise ValueError(f"Unknown key {keyName}")
+            if len(values) != len(records):
+                raise ValueError(f"Key {keyName} has {len(values)} values for {len(records)} timestamps")
+            records[keyName] = values
+        records["timestamp"] = timestamps
+
+        timestamps = records["timestamp"]
+        if (numpy.diff(timestamps.astype("i8")) < 0).any():
+            raise SequenceViolation()
+        self._lockWriter()
+
+        start = 0
+        while start < len(records):
+            time = datetime.fromtimestamp(int(timestamps[start]))
+            archive = self._getOrCreateArchive(time)
+            end = int(numpy.searchsorted(timestamps, self.databaseHandler.getArchiveKey(time) + self.databaseHandler.getArchivePeriod(time)))
+            self._writeArray(archive, records[start:end])
+            start = end
+
+    def _writeArray(self, archive: ArchiveHandler, records: "numpy.ndarray") -> None:
+        """Writes a structured array of records to a raw archive and folds them into the rollups"""
+        rollups = self._getRollups(int(records["timestamp"][0]))
+        archive.writeArray(records)
+        if rollups:
+            records = records.tolist()
+            for level, rollup in rollups.items():
+                self._writeRollup(level, rollup.add(records))
+        self._checkWal()
 
 class DatabaseMultiSession:
     databases: dict = {}
@@ -171,41 +766,50 @@ class DatabaseMultiSession:
 class DatabaseManager:
     """The DatabaseManager is responsible for creating, loading, checking and repariring databases"""
 
-    def load(self, baseDir: str, name: str) -> DatabaseSession:
-        """Loads Strider database
+    def load(self, baseDir: str, name: str, **sessionOptions) -> DatabaseSession:
+        """Loads Strider database, `sessionOptions` are passed on to `DatabaseSession`
         TODO integrity checks and errors"""
         fileUtil = StriderFileUtil(baseDir, name)
         try:
-            databaseFile = StriderFileIO(open(fileUtil.getDatabaseFilepath(), "rb"))
+            database = DatabaseHandler.readDatabase(fileUtil)
         except FileNotFoundError:
             raise DatabaseNotFound()
-
-        try:
-            database: Database = databaseFile.readStruct(Database)
-            database.archives = databaseFile.readStructSequence(DatabaseArchive, database.archiveCount)
-            database.keys = databaseFile.readStructSequence(ArchiveKey, database.keyCount)
         except struct.error:
             if os.path.isfile(fileUtil.getDatabaseFilepath()+".old"):
                 fileUtil.safeOverwrite(fileUtil.getDatabaseFilepath(), fileUtil.getDatabaseFilepath()+".old")
-                return self.load(baseDir, name)
+                return self.load(baseDir, name, **sessionOptions)
             else:
                 database = self.rebuildDatabase(fileUtil)
 
-        return DatabaseSession(DatabaseHandler(database, fileUtil), fileUtil)
+        session = DatabaseSession(DatabaseHandler(database, fileUtil), fileUtil, **sessionOptions)
+        session.replayWal()
+        return session
 
-    def new(self, baseDir: str, name: str, archiveRange: ARCHIVE_RANGE = ARCHIVE_RANGE.week) -> DatabaseSession:
-        """Creates new Strider database"""
+    def new(self, baseDir: str, name: str, archiveRange: ARCHIVE_RANGE = ARCHIVE_RANGE.week, archiveLayout: ARCHIVE_LAYOUT = ARCHIVE_LAYOUT.row, rollups: tuple = (), **sessionOptions) -> DatabaseSession:
+        """Creates new Strider database, `sessionOptions` are passed on to `DatabaseSession`.
+        The column layout stores each key in its own file, so single key queries only read that key"""
         fileUtil = StriderFileUtil(baseDir, name)
         if os.path.isdir(fileUtil.databaseDirectory):
             raise DatabaseExists()
         else:
-            database = Database("strdrdb", CURRENT_REVISION, name, 0, 0, 3600, archiveRange, [], [])
+            database = Database("strdrdb", CURRENT_REVISION, name, 0, 0, 3600, archiveRange, archiveLayout, [], [])
 
             os.mkdir(fileUtil.databaseDirectory)
             databaseHandler = DatabaseHandler(database, fileUtil)
-            databaseHandler.save()
-            return DatabaseSession(databaseHandler, fileUtil)
+            databaseHandler.setRollups(rollups)
+            return DatabaseSession(databaseHandler, fileUtil, **sessionOptions)
         
+    def convert(self, baseDir: str, name: str, archiveLayout: ARCHIVE_LAYOUT, **sessionOptions) -> DatabaseSession:
+        """Rewrites every archive of a database in `archiveLayout`. Raises `DatabaseLocked` if another session writes to the database,
+        sessions reading it should be closed"""
+        session = self.load(baseDir, name)
+        session._lockWriter()
+        try:
+            session.databaseHandler.convertArchives(archiveLayout)
+        finally:
+            session.close()
+        return self.load(baseDir, name, **sessionOptions)
+
     def rebuildDatabase(self, fileUtil: StriderFileUtil):
         archives:list[ArchiveFile] = []
         lastArchive = None
@@ -233,6 +837,7 @@ class DatabaseManager:
                             len(lastArchive.keys),
                             lastArchive.indexInterval,
                             archiveRange,
+                            lastArchive.layout,
                             [DatabaseArchive(archive.minRange, archive.maxRange, archive.index, archive.resolution) for archive in archives],
                             lastArchive.keys)
         databaseHandler = DatabaseHandler(database, fileUtil)
@@ -0,0 +1,68 @@
+from typing import Iterator
+import os
+import struct
+import time
+import zlib
+
+from strider.datatypes import WAL_SYNC
+
+# checksum, payload size and record format length of an entry, the payload is the record format followed by the packed records
+ENTRY_HEADER = struct.Struct("=IIB")
+
+
+class WriteAheadLog:
+    """Append only log of the records written to a database's raw archives.
+    Each entry is checksummed, so a torn or corrupt tail is detected and ignored when the log is read back"""
+    sync: WAL_SYNC
+    syncInterval: float
+    lastSync: float
+
+    def __init__(self, path: str, sync: WAL_SYNC = WAL_SYNC.always, syncInterval: float = 0.1) -> None:
+        """`sync` sets when the log is forced to disk, on `always` every append, on `interval` once `syncInterval` seconds
+        have passed since the last sync (checked on append), on `never` only when the session is flushed"""
+        self.path = path
+        self.sync = sync
+        self.syncInterval = syncInterval
+        self.file = open(path, "ab")
+        self.lastSync = time.monotonic()
+
+    def append(self, recordFormat: str, recordBytes: bytes) -> None:
+        """Logs records packed in `recordFormat`"""
+        payload = recordFormat.encode() + recordBytes
+        header = struct.pack("=IB", len(payload), len(recordFormat))
+        self.file.write(ENTRY_HEADER.pack(zlib.crc32(header + payload), len(payload), len(recordFormat)) + payload)
+        self.file.flush()
+        if self.sync == WAL_SYNC.always or (self.sync == WAL_SYNC.interval and time.monotonic() - self.lastSync >= self.syncInterval):
+            self.fsync()
+
+    def fsync(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.lastSync = time.monotonic()
+
+    def size(self) -> int:
+        return self.file.tell()
+
+    def truncate(self) -> None:
+        """Empties the log, once every logged record is durable in the archives"""
+        self.file.truncate(0)
+        self.fsync()
+
+    def close(self) -> None:
+        self.file.close()
+
+    @staticmethod
+    def readEntries(path: str) -> Iterator[tuple[str, list[tuple]]]:
+        """Yields the record format and records of each entry, up to the first torn or corrupt entry"""
+        with open(path, "rb") as walFile:
+            data = walFile.read()
+
+        offset = 0
+        while offset + ENTRY_HEADER.size <= len(data):
+            checksum, size, formatSize = ENTRY_HEADER.unpack_from(data, offset)
+            payload = data[offset + ENTRY_HEADER.size:offset + ENTRY_HEADER.size + size]
+            if len(payload) != size or zlib.crc32(struct.pack("=IB", size, formatSize) + payload) != checksum:
+                return
+            recordFormat = payload[:formatSize].decode()
+            yield recordFormat, list(struct.iter_unpack(recordFormat, payload[formatSize:]))
+            offset += ENTRY_HEADER.size + size
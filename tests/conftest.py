@@ -1,6 +1,7 @@
 import pytest
 import shutil
 import os 
+import functools
 
 from strider import DatabaseManager, datatypes
 
@@ -26,4 +27,26 @@ def databaseMonth():
 
     yield database
 
-    shutil.rmtree(os.path.join("data/test", "test_tmp"))
\ No newline at end of file
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+@pytest.fixture()
+def databaseColumn():
+    database = DatabaseManager.new("data/test", "test_tmp", archiveLayout=datatypes.ARCHIVE_LAYOUT.column)
+
+    yield database
+
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+@pytest.fixture()
+def databaseBlock():
+    database = DatabaseManager.new("data/test", "test_tmp", archiveLayout=datatypes.ARCHIVE_LAYOUT.block)
+
+    yield database
+
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+@pytest.fixture(params=list(datatypes.ARCHIVE_LAYOUT), ids=lambda layout: layout.name)
+def newDatabaseLayout(request):
+    yield functools.partial(DatabaseManager.new, "data/test", "test_tmp", archiveLayout=request.param)
+
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
@@ -0,0 +1,73 @@
+import pytest
+import asyncio
+import strider
+import shutil, os
+from datetime import datetime
+
+
+def testAdd(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+
+    async def ingest():
+        async with strider.AsyncDatabaseSession(database, queueSize=10, batchSize=4) as session:
+            acks = [await session.add(datetime(2024, 5, 10, 15, 30, second), {"testKey": float(second)}) for second in range(30)]
+            await asyncio.gather(*acks)
+            records = await session.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))
+            assert [record.testKey for record in records] == [float(second) for second in range(30)]
+
+    asyncio.run(ingest())
+
+@pytest.mark.parametrize("wal", [False, True])
+def testAddDurable(wal, monkeypatch):
+    database = strider.DatabaseManager.new("data/test", "test_tmp", wal=wal)
+    database.addKey("testKey", 5)
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(os.fstat(fd).st_ino) or fsync(fd))
+
+    async def ingest():
+        async with strider.AsyncDatabaseSession(database) as session:
+            time = datetime(2024, 5, 10, 15, 30, 0)
+            ack = await session.add(time, {"testKey": 1.0})
+            await ack
+            # acknowledged records are on disk
+            if wal:
+                path = database.fileUtil.getWalFilePath()
+            else:
+                path = database.fileUtil.getArchiveFilePath(database._getArchiveForDate(time).archive, True)
+            assert os.stat(path).st_ino in synced
+
+    try:
+        asyncio.run(ingest())
+    finally:
+        shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+def testFlush(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+
+    async def ingest():
+        session = strider.AsyncDatabaseSession(database)
+        for second in range(10):
+            await session.add(datetime(2024, 5, 10, 15, 30, second), {"testKey": 1.0})
+        await session.flush()
+        assert session.queue.empty()
+        assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 10
+        await session.close()
+
+    asyncio.run(ingest())
+
+def testAddError(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+
+    async def ingest():
+        async with strider.AsyncDatabaseSession(database) as session:
+            ack = await session.add(datetime(2024, 5, 10, 15, 30, 30), {"testKey": 1.0})
+            await ack
+            ack = await session.add(datetime(2024, 5, 10, 15, 30, 0), {"testKey": 1.0})
+            with pytest.raises(strider.SequenceViolation):
+                await ack
+            ack = await session.add(datetime(2024, 5, 10, 15, 31, 0), {"testKey": 1.0})
+            await ack
+
+    asyncio.run(ingest())
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 2
@@ -1,8 +1,9 @@
 import pytest
-from datetime import datetime
+from datetime import datetime, timedelta
 from tests import util
 import strider
 import struct
+import shutil, os
 
 def testAddKey(database: strider.DatabaseSession):
     database.addKey("testKey", 5)
@@ -97,4 +98,826 @@ def testBulkAddInvalidData(database: strider.DatabaseSession):
                 datetime(2024, 5, 11, 15, 30, 30): {"testKey": 5.0},
                 datetime(2024, 5, 12, 15, 30, 30): {"testKey": 5.0},
                 datetime(2024, 5, 13, 15, 30, 30): {"testKey": 5.0},}
-        database.bulkAdd(data)
\ No newline at end of file
+        database.bulkAdd(data)
+
+def testBufferedAdd():
+    database = strider.DatabaseManager.new("data/test", "test_tmp", bufferSize=100)
+    database.addKey("testKey", 5)
+    for second in range(10):
+        database.add(datetime(2024, 5, 10, 15, 30, second), {"testKey": float(second)})
+
+    archive = database._getArchiveForDate(datetime(2024, 5, 10, 15, 30, 0))
+    assert os.path.getsize(database.fileUtil.getArchiveFilePath(archive.archive, True)) == 0
+
+    with pytest.raises(strider.SequenceViolation):
+        database.add(datetime(2024, 5, 10, 15, 29, 0), {"testKey": 5.0})
+
+    database.close()
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 10
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+def testBufferedQuery():
+    database = strider.DatabaseManager.new("data/test", "test_tmp", bufferSize=100)
+    database.addKey("testKey", 5)
+    database.add(datetime(2024, 5, 10, 15, 30, 30), {"testKey": 5.0})
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 1
+    database.close()
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+def testIndexAppend(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+    database.setIndexInteval(60)
+    for minute in range(10):
+        database.add(datetime(2024, 5, 10, 15, minute, 0), {"testKey": 5.0})
+    archive = database._getArchiveForDate(datetime(2024, 5, 10, 15, 0, 0))
+    database.close()
+
+    with open(database.fileUtil.getArchiveFilePath(archive.archive), "ab") as archiveFile:
+        archiveFile.write(b"\x01\x02\x03")
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    reloaded = database._getArchiveForDate(datetime(2024, 5, 10, 15, 0, 0))
+    assert reloaded.archive.indexCount == 10
+    assert reloaded.indexOffsets == archive.indexOffsets
+
+    database.add(datetime(2024, 5, 10, 15, 10, 0), {"testKey": 5.0})
+    database.close()
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    assert database._getArchiveForDate(datetime(2024, 5, 10, 15, 0, 0)).archive.indexCount == 11
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 11
+
+def testQueryIndexRange(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+    database.setIndexInteval(60)
+    database.bulkAdd({datetime(2024, 5, 10, 15, second // 60, second % 60): {"testKey": float(second)} for second in range(0, 3600, 30)})
+
+    records = database.query(datetime(2024, 5, 10, 15, 10), datetime(2024, 5, 10, 15, 20))
+    assert len(records) == 20
+    assert records[0].testKey == 600.0 and records[-1].testKey == 1170.0
+
+    archive = database._getArchiveForDate(datetime(2024, 5, 10, 15, 0, 0))
+    recordSize = struct.calcsize(archive.archiveRecordFormat)
+    startOffset, endOffset = archive.getIndex(int(datetime(2024, 5, 10, 15, 10).timestamp()), int(datetime(2024, 5, 10, 15, 20).timestamp()))
+    assert (startOffset, endOffset) == (20 * recordSize, 40 * recordSize)
+
+def testQueryKey(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+    database.addKey("otherKey", 3)
+    database.bulkAdd({datetime(2024, 5, 10, 15, 0, second): {"testKey": float(second), "otherKey": second} for second in range(0, 60, 2)})
+    database.add(datetime(2024, 5, 10, 15, 0, 58), {"testKey": 1.0, "otherKey": 1})
+
+    records = database.query(datetime(2024, 5, 10, 15, 0, 10), datetime(2024, 5, 10, 15, 0, 58), "otherKey")
+    assert list(records.values()) == list(range(10, 58, 2))
+    assert len(database.query(datetime(2024, 5, 10, 15, 0, 58), datetime(2024, 5, 10, 15, 1), raw=True)) == 2
+    assert database.query(datetime(2024, 5, 10, 14, 0), datetime(2024, 5, 10, 15, 0)) == []
+
+def testQueryNumpy(databaseDay):
+    numpy = pytest.importorskip("numpy")
+    databaseDay.addKey("testKey", 5)
+    databaseDay.addKey("flag", 1)
+    databaseDay.bulkAdd({datetime(2024, 5, 10, 23, 50, 0): {"testKey": 1.0, "flag": True},
+                         datetime(2024, 5, 10, 23, 55, 0): {"testKey": 2.0, "flag": False},
+                         datetime(2024, 5, 11, 0, 5, 0): {"testKey": 3.0, "flag": True}})
+
+    records = databaseDay.query(datetime(2024, 5, 10, 23, 0), datetime(2024, 5, 11, 1, 0), format="numpy")
+    assert records.dtype.names == ("timestamp", "testKey", "flag")
+    assert records["testKey"].tolist() == [1.0, 2.0, 3.0]
+    assert records["flag"].tolist() == [True, False, True]
+    assert records["timestamp"].tolist() == [record.timestamp for record in databaseDay.query(datetime(2024, 5, 10, 23, 0), datetime(2024, 5, 11, 1, 0))]
+    assert len(databaseDay.query(datetime(2024, 5, 9), datetime(2024, 5, 10), format="numpy")) == 0
+
+def testQueryColumn(databaseColumn):
+    testQuery(databaseColumn)
+
+def testBulkAddColumn(databaseColumn):
+    testBulkAdd(databaseColumn)
+
+def testQueryKeyColumn(databaseColumn):
+    testQueryKey(databaseColumn)
+
+def testQueryIndexRangeColumn(databaseColumn):
+    databaseColumn.addKey("testKey", 5)
+    databaseColumn.setIndexInteval(60)
+    databaseColumn.bulkAdd({datetime(2024, 5, 10, 15, second // 60, second % 60): {"testKey": float(second)} for second in range(0, 3600, 30)})
+
+    records = databaseColumn.query(datetime(2024, 5, 10, 15, 10), datetime(2024, 5, 10, 15, 20))
+    assert [record.testKey for record in records] == [float(second) for second in range(600, 1200, 30)]
+
+def testAddKeyActiveArchive(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+    database.setIndexInteval(1)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(strider.strider, "datetime", util.fixedDatetime(datetime(2024, 5, 10, 16, 0)))
+        database.add(datetime(2024, 5, 10, 15, 30, 30), {"testKey": 5.0})
+        database.add(datetime(2024, 5, 10, 15, 30, 31), {"testKey": 6.0})
+        database.addKey("otherKey", 3)
+        database.add(datetime(2024, 5, 10, 15, 30, 32), {"testKey": 7.0, "otherKey": 2})
+
+    records = database.query(datetime(2024, 5, 10, 15, 30, 31), datetime(2024, 5, 10, 16, 0), raw=True)
+    assert records == [(int(datetime(2024, 5, 10, 15, 30, 31).timestamp()), 6.0, 0), (int(datetime(2024, 5, 10, 15, 30, 32).timestamp()), 7.0, 2)]
+
+def testAddKeyActiveArchiveColumn(databaseColumn):
+    testAddKeyActiveArchive(databaseColumn)
+
+def testLoadRevision0(database: strider.DatabaseSession):
+    testBulkAdd(database)
+    database.databaseHandler.database.revision = 0
+    database.databaseHandler.save()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    assert database.databaseHandler.database.archiveLayout == strider.datatypes.ARCHIVE_LAYOUT.row
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 13, 16, 0))) == 4
+
+def testQueryNumpyColumn(databaseColumn):
+    testQueryNumpy(databaseColumn)
+
+def testConvertLayout(database: strider.DatabaseSession):
+    testBulkAdd(database)
+    expected = database.query(datetime(2024, 5, 10), datetime(2024, 5, 14), raw=True)
+    database.close()
+
+    database = strider.DatabaseManager.convert("data/test", "test_tmp", strider.datatypes.ARCHIVE_LAYOUT.column)
+    assert database.databaseHandler.database.archiveLayout == strider.datatypes.ARCHIVE_LAYOUT.column
+    assert database.query(datetime(2024, 5, 10), datetime(2024, 5, 14), raw=True) == expected
+    assert len(database.query(datetime(2024, 5, 10), datetime(2024, 5, 14), "testKey")) == 4
+    database.add(datetime(2024, 5, 13, 16, 0, 0), {"testKey": 1.0})
+    database.close()
+
+    database = strider.DatabaseManager.convert("data/test", "test_tmp", strider.datatypes.ARCHIVE_LAYOUT.row)
+    assert len(database.query(datetime(2024, 5, 10), datetime(2024, 5, 14), raw=True)) == 5
+    assert not [file for file in os.listdir(database.fileUtil.databaseDirectory) if file.endswith("strdrcol")]
+
+def testRollups():
+    database = strider.DatabaseManager.new("data/test", "test_tmp", rollups=(60, 3600))
+    database.addKey("testKey", 5)
+    database.addKey("maxKey", 3, strider.datatypes.DOWNSAMPLE_FUNCS.max)
+    database.bulkAdd({datetime(2024, 5, 10, 15, second // 60, second % 60): {"testKey": float(second), "maxKey": second} for second in range(0, 300, 10)})
+    database.add(datetime(2024, 5, 10, 16, 0, 0), {"testKey": 1.0, "maxKey": 1})
+
+    minutes = database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 17, 0), resolution=60)
+    assert [record.testKey for record in minutes] == [25.0, 85.0, 145.0, 205.0, 265.0]
+    assert [record.maxKey for record in minutes] == [50, 110, 170, 230, 290]
+    assert minutes[0].timestamp == int(datetime(2024, 5, 10, 15, 0).timestamp())
+
+    hours = database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 17, 0), resolution=7200)
+    assert [(record.testKey, record.maxKey) for record in hours] == [(145.0, 290)]
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 17, 0), resolution=30)) == 31
+    database.close()
+
+    # unfinished buckets are restored from the raw archive
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    database.add(datetime(2024, 5, 10, 16, 0, 30), {"testKey": 3.0, "maxKey": 3})
+    database.add(datetime(2024, 5, 10, 16, 1, 0), {"testKey": 1.0, "maxKey": 1})
+    minutes = database.query(datetime(2024, 5, 10, 16, 0), datetime(2024, 5, 10, 17, 0), resolution=60)
+    assert [(record.testKey, record.maxKey) for record in minutes] == [(2.0, 3)]
+    database.close()
+
+    # the next write comes hours after the unfinished bucket
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    database.add(datetime(2024, 5, 10, 19, 0), {"testKey": 1.0, "maxKey": 1})
+    database.add(datetime(2024, 5, 10, 19, 1), {"testKey": 1.0, "maxKey": 1})
+    minutes = database.query(datetime(2024, 5, 10, 16, 0), datetime(2024, 5, 10, 20, 0), resolution=60)
+    assert [(datetime.fromtimestamp(record.timestamp), record.testKey) for record in minutes] == [
+        (datetime(2024, 5, 10, 16, 0), 2.0), (datetime(2024, 5, 10, 16, 1), 1.0), (datetime(2024, 5, 10, 19, 0), 1.0)]
+    database.close()
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+def testRollupsHistory(database: strider.DatabaseSession):
+    database.addKey("testKey", 5, strider.datatypes.DOWNSAMPLE_FUNCS.sum)
+    database.bulkAdd({datetime(2024, 5, 10, 15, second // 60, second % 60): {"testKey": 1.0} for second in range(0, 120, 10)})
+
+    # the history is not downsampled, the first bucket folded is the current one
+    database.setRollups([60])
+    database.add(datetime(2024, 5, 10, 18, 0, 0), {"testKey": 1.0})
+    database.add(datetime(2024, 5, 10, 18, 0, 30), {"testKey": 1.0})
+    database.add(datetime(2024, 5, 10, 18, 1, 0), {"testKey": 1.0})
+    minutes = database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 19, 0), resolution=60)
+    assert [(datetime.fromtimestamp(record.timestamp), record.testKey) for record in minutes] == [(datetime(2024, 5, 10, 18, 0), 2.0)]
+
+    # levels without rollup records are backfilled, the others are kept as they are
+    database.setRollups([60, 3600])
+    database.backfillRollups(chunkSize=5)
+    database.add(datetime(2024, 5, 10, 19, 0), {"testKey": 1.0})
+    hours = database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 20, 0), resolution=3600)
+    assert [(datetime.fromtimestamp(record.timestamp), record.testKey) for record in hours] == [
+        (datetime(2024, 5, 10, 15, 0), 12.0), (datetime(2024, 5, 10, 18, 0), 3.0)]
+    minutes = database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 20, 0), resolution=60)
+    assert [(datetime.fromtimestamp(record.timestamp), record.testKey) for record in minutes] == [
+        (datetime(2024, 5, 10, 18, 0), 2.0), (datetime(2024, 5, 10, 18, 1), 1.0)]
+
+def testRollupSums(database: strider.DatabaseSession):
+    database.setRollups([60])
+    database.addKey("uintKey", 4, strider.datatypes.DOWNSAMPLE_FUNCS.sum)
+    database.addKey("shortKey", 2, strider.datatypes.DOWNSAMPLE_FUNCS.sum)
+    database.bulkAdd({datetime(2024, 5, 10, 15, 0, second): {"uintKey": 2 ** 31, "shortKey": 30000} for second in range(0, 30, 10)})
+    database.add(datetime(2024, 5, 10, 15, 1), {"uintKey": 1, "shortKey": 1})
+
+    minutes = database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0), resolution=60)
+    assert [(record.uintKey, record.shortKey) for record in minutes] == [(3 * 2 ** 31, 90000)]
+
+def testAggregate(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+    database.addKey("otherKey", 3)
+    database.bulkAdd({datetime(2024, 5, 10, 15, second // 60, second % 60): {"testKey": float(second), "otherKey": 1} for second in range(0, 600, 10)})
+
+    buckets = database.aggregate(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 15, 9), 300, ["avg", "min", "max", "count"], ["testKey"], chunkSize=7)
+    assert buckets[0]._fields == ("timestamp", "testKey_avg", "testKey_min", "testKey_max", "testKey_count")
+    assert [tuple(bucket[1:]) for bucket in buckets] == [(145.0, 0.0, 290.0, 30), (415.0, 300.0, 530.0, 24)]
+    assert buckets[1].timestamp - buckets[0].timestamp == 300
+
+    buckets = database.aggregate(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0), 3600, [strider.datatypes.DOWNSAMPLE_FUNCS.sum])
+    assert [tuple(bucket[1:]) for bucket in buckets] == [(sum(range(0, 600, 10)), 60)]
+
+def testAggregateColumn(databaseColumn):
+    testAggregate(databaseColumn)
+
+def testIterQueryDay(databaseDay):
+    testIterQuery(databaseDay)
+    chunks = list(databaseDay.iterQuery(datetime(2024, 5, 10, 23, 0), datetime(2024, 5, 11, 1, 0), chunkSize=20))
+    assert [len(chunk) for chunk in chunks] == [20, 20, 10, 20, 20, 10]
+
+def testIterQuery(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+    database.addKey("otherKey", 3)
+    database.bulkAdd({datetime(2024, 5, 10, 23, 55, second): {"testKey": float(second), "otherKey": second} for second in range(0, 50)})
+    database.bulkAdd({datetime(2024, 5, 11, 0, 0, second): {"testKey": float(second), "otherKey": second} for second in range(0, 50)})
+
+    chunks = list(database.iterQuery(datetime(2024, 5, 10, 23, 0), datetime(2024, 5, 11, 1, 0), chunkSize=20))
+    assert sum(len(chunk) for chunk in chunks) == 100 and max(len(chunk) for chunk in chunks) == 20
+    assert [record for chunk in chunks for record in chunk] == database.query(datetime(2024, 5, 10, 23, 0), datetime(2024, 5, 11, 1, 0))
+
+    chunk = next(iter(database.iterQuery(datetime(2024, 5, 10, 23, 0), datetime(2024, 5, 11, 1, 0), keys=["otherKey"], raw=True)))
+    assert chunk[:2] == [(int(datetime(2024, 5, 10, 23, 55, 0).timestamp()), 0), (int(datetime(2024, 5, 10, 23, 55, 1).timestamp()), 1)]
+
+    iterator = database.iterQuery(datetime(2024, 5, 10, 23, 0), datetime(2024, 5, 11, 1, 0), chunkSize=10)
+    next(iterator)
+    iterator.close()
+
+def testIterQueryColumn(databaseColumn):
+    testIterQuery(databaseColumn)
+
+def testIterQueryNumpy(database: strider.DatabaseSession):
+    pytest.importorskip("numpy")
+    database.addKey("testKey", 5)
+    database.addKey("otherKey", 3)
+    database.bulkAdd({datetime(2024, 5, 10, 15, 0, second): {"testKey": float(second), "otherKey": second} for second in range(0, 50)})
+    chunks = list(database.iterQuery(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0), keys=["otherKey"], chunkSize=20, format="numpy"))
+    assert [len(chunk) for chunk in chunks] == [20, 20, 10]
+    assert chunks[0].dtype.names == ("timestamp", "otherKey")
+    assert chunks[2]["otherKey"].tolist() == list(range(40, 50))
+
+def testLazyArchiveLoading(databaseDay):
+    testBulkAdd(databaseDay)
+    databaseDay.close()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp", archiveCacheSize=2)
+    assert len(database.loadedArchives) == 0
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 13, 16, 0))) == 4
+    assert list(database.loadedArchives.keys()) == [(int(datetime(2024, 5, day).timestamp()), 0) for day in (12, 13)]
+
+    database.add(datetime(2024, 5, 13, 16, 0, 0), {"testKey": 1.0})
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 12, 16, 0))) == 3
+    assert (int(datetime(2024, 5, 13).timestamp()), 0) in database.loadedArchives
+    assert len(database.query(datetime(2024, 5, 13, 15, 0), datetime(2024, 5, 13, 17, 0))) == 2
+
+def testResidency(databaseDay):
+    testBulkAdd(databaseDay)
+    databaseDay.close()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp", residency=strider.datatypes.ARCHIVE_RESIDENCY.all)
+    assert len(database.loadedArchives) == 4
+    database.close()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp", residency=strider.datatypes.ARCHIVE_RESIDENCY.none, bufferSize=10)
+    database.add(datetime(2024, 5, 13, 16, 0, 0), {"testKey": 1.0})
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 13, 17, 0))) == 5
+    assert list(database.loadedArchives.keys()) == [(int(datetime(2024, 5, 13).timestamp()), 0)]
+    database.close()
+
+def testHotTail(monkeypatch):
+    database = strider.DatabaseManager.new("data/test", "test_tmp", tailSize=5)
+    database.addKey("testKey", 5)
+    for second in range(10):
+        database.add(datetime(2024, 5, 10, 15, 30, second), {"testKey": second + 0.1})
+    records = database.query(datetime(2024, 5, 10, 15, 30, 0), datetime(2024, 5, 10, 16, 0))
+    assert len(records) == 10
+    expected = records[6:]
+    expectedKey = {record.timestamp: record.testKey for record in expected}
+
+    archive = database._getArchiveForDate(datetime(2024, 5, 10, 15, 30, 0))
+    def readFile(*args):
+        raise AssertionError("tail read went to disk")
+    monkeypatch.setattr(archive, "_readRange", readFile)
+    monkeypatch.setattr(archive, "_readKey", readFile)
+    assert database.query(datetime(2024, 5, 10, 15, 30, 6), datetime(2024, 5, 10, 16, 0)) == expected
+    assert database.query(datetime(2024, 5, 10, 15, 30, 6), datetime(2024, 5, 10, 16, 0), "testKey") == expectedKey
+    assert len(database.query(datetime(2024, 5, 10, 15, 30, 6), datetime(2024, 5, 10, 15, 30, 8))) == 2
+    with pytest.raises(AssertionError):
+        database.query(datetime(2024, 5, 10, 15, 30, 4), datetime(2024, 5, 10, 16, 0))
+    database.close()
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+def testQueryBlock(databaseBlock):
+    testQuery(databaseBlock)
+
+def testBulkAddBlock(databaseBlock):
+    testBulkAdd(databaseBlock)
+
+def testQueryKeyBlock(databaseBlock):
+    testQueryKey(databaseBlock)
+
+def testAddKeyActiveArchiveBlock(databaseBlock):
+    testAddKeyActiveArchive(databaseBlock)
+
+def testQueryNumpyBlock(databaseBlock):
+    testQueryNumpy(databaseBlock)
+
+def testAggregateBlock(databaseBlock):
+    testAggregate(databaseBlock)
+
+def testIterQueryBlock(databaseBlock):
+    testIterQuery(databaseBlock)
+
+def testBlockArchive(databaseBlock):
+    databaseBlock.addKey("testKey", 5)
+    databaseBlock.addKey("otherKey", 3)
+    data = {datetime(2024, 5, 10, 15, second // 60, second % 60): {"testKey": float(second // 100), "otherKey": second} for second in range(0, 3000, 3)}
+    databaseBlock.bulkAdd(dict(list(data.items())[:600]))
+    databaseBlock.close()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    for time, values in list(data.items())[600:]:
+        database.add(time, values)
+    archive = database._getArchiveForDate(datetime(2024, 5, 10, 15, 0, 0))
+    database.close()
+    assert archive.archive.indexCount == 4
+    assert os.path.getsize(database.fileUtil.getArchiveFilePath(archive.archive, True)) * 5 < len(data) * struct.calcsize(archive.archiveRecordFormat)
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    records = database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0), raw=True)
+    assert records == [(int(time.timestamp()), values["testKey"], values["otherKey"]) for time, values in data.items()]
+    assert len(database.query(datetime(2024, 5, 10, 15, 10), datetime(2024, 5, 10, 15, 20))) == 200
+    database.close()
+
+    database = strider.DatabaseManager.convert("data/test", "test_tmp", strider.datatypes.ARCHIVE_LAYOUT.row)
+    assert database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0), raw=True) == records
+    database.close()
+    database = strider.DatabaseManager.convert("data/test", "test_tmp", strider.datatypes.ARCHIVE_LAYOUT.block)
+    assert database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0), raw=True) == records
+
+def testBlockColumns(databaseBlock):
+    databaseBlock.addKey("shortKey", 2)
+    databaseBlock.addKey("boolKey", 1)
+    databaseBlock.addKey("floatKey", 5)
+    # runs of descending evenly spaced values, jumps in every delta-of-delta bucket, repeated and changing floats
+    values = [(1000 - 7 * i if i < 300 else (-1) ** i * (30000 - i), i % 3 == 0, -1.5 if i < 200 else i / 4) for i in range(600)]
+    data = {datetime(2024, 5, 10, 15, 0, 0) + timedelta(seconds=i * (1 if i < 400 else 1000)): dict(zip(("shortKey", "boolKey", "floatKey"), value)) for i, value in enumerate(values)}
+    databaseBlock.bulkAdd(data)
+    databaseBlock.close()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    records = database.query(datetime(2024, 5, 10), datetime(2024, 5, 20), raw=True)
+    assert records == [(int(time.timestamp()), *value) for time, value in zip(data, values)]
+    database.close()
+
+def testBlockOpenBlock(databaseBlock):
+    databaseBlock.addKey("testKey", 5)
+    times = [datetime(2024, 5, 10, 15, second // 60, second % 60) for second in range(0, 3000, 3)]
+    for i, time in enumerate(times[:255]):
+        databaseBlock.add(time, {"testKey": float(i)})
+    archive = databaseBlock._getArchiveForDate(times[0])
+    dataPath = databaseBlock.fileUtil.getArchiveFilePath(archive.archive, True)
+    openPath = databaseBlock.fileUtil.getOpenBlockFilePath(archive.archive)
+    # the open block is appended to its own file, nothing is encoded before it is full
+    assert os.path.getsize(dataPath) == 0
+    with open(openPath, "rb") as openFile:
+        openBlock = openFile.read()
+
+    databaseBlock.add(times[255], {"testKey": 255.0})
+    dataSize = os.path.getsize(dataPath)
+    assert dataSize > 0 and len(archive.openRecords) == 0
+    expected = [(int(time.timestamp()), float(i)) for i, time in enumerate(times[:256])]
+
+    # interrupted after the block was written, before the open block file was emptied, or while the block was written
+    for torn in (False, True):
+        shutil.rmtree(os.path.join("data/test", "test_crash"), ignore_errors=True)
+        shutil.copytree(os.path.join("data/test", "test_tmp"), os.path.join("data/test", "test_crash"))
+        crashed = strider.io.StriderFileUtil("data/test", "test_crash")
+        with open(crashed.getOpenBlockFilePath(archive.archive), "wb") as openFile:
+            openFile.write(openBlock)
+        if torn:
+            os.truncate(crashed.getArchiveFilePath(archive.archive, True), dataSize // 2)
+        database = strider.DatabaseManager.load("data/test", "test_crash")
+        assert database.query(times[0], times[-1], raw=True) == expected[:255 if torn else 256]
+        database.add(times[256], {"testKey": 256.0})
+        assert database.query(times[0], times[-1], raw=True)[-2:] == [expected[254 if torn else 255], (int(times[256].timestamp()), 256.0)]
+        database.close()
+    shutil.rmtree(os.path.join("data/test", "test_crash"))
+
+    # readers see the open block, a new key reads back with its default value
+    for i, time in enumerate(times[256:300], 256):
+        databaseBlock.add(time, {"testKey": float(i)})
+    reader = strider.DatabaseManager.load("data/test", "test_tmp")
+    assert len(reader.query(times[0], times[-1])) == 300
+    reader.close()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(strider.strider, "datetime", util.fixedDatetime(times[0]))
+        databaseBlock.addKey("count", 3)
+    assert os.path.getsize(dataPath) == dataSize
+    databaseBlock.add(times[300], {"testKey": 300.0, "count": 1})
+    databaseBlock.close()
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    records = database.query(times[0], times[-1], raw=True)
+    assert records[-2:] == [(int(times[299].timestamp()), 299.0, 0), (int(times[300].timestamp()), 300.0, 1)]
+    assert len(records) == 301
+    database.close()
+
+@pytest.mark.parametrize("executor", list(strider.datatypes.QUERY_EXECUTORS))
+def testParallelQuery(databaseDay, executor):
+    databaseDay.addKey("testKey", 5)
+    databaseDay.bulkAdd({datetime(2024, 5, day, hour, 0, 0): {"testKey": float(day * 24 + hour)} for day in range(1, 15) for hour in range(0, 24, 6)})
+    expected = databaseDay.query(datetime(2024, 5, 1), datetime(2024, 5, 15))
+    expectedKey = databaseDay.query(datetime(2024, 5, 1), datetime(2024, 5, 15), "testKey")
+    databaseDay.close()
+
+    with strider.DatabaseManager.load("data/test", "test_tmp", queryWorkers=4, queryExecutor=executor) as database:
+        assert database.query(datetime(2024, 5, 1), datetime(2024, 5, 15)) == expected
+        assert database.query(datetime(2024, 5, 1), datetime(2024, 5, 15), "testKey") == expectedKey
+        database.add(datetime(2024, 5, 14, 23, 0, 0), {"testKey": 1.0})
+        assert database.query(datetime(2024, 5, 1), datetime(2024, 5, 15), raw=True)[-1][1] == 1.0
+
+def testParallelQueryNumpy(databaseDay):
+    pytest.importorskip("numpy")
+    databaseDay.addKey("testKey", 5)
+    databaseDay.bulkAdd({datetime(2024, 5, day, hour, 0, 0): {"testKey": float(day * 24 + hour)} for day in range(1, 15) for hour in range(0, 24, 6)})
+    databaseDay.close()
+
+    with strider.DatabaseManager.load("data/test", "test_tmp", queryWorkers=4) as database:
+        records = database.query(datetime(2024, 5, 1), datetime(2024, 5, 15), format="numpy")
+        assert list(records["testKey"]) == [float(day * 24 + hour) for day in range(1, 15) for hour in range(0, 24, 6)]
+
+def testBulkAddArrays(databaseDay):
+    numpy = pytest.importorskip("numpy")
+    databaseDay.addKey("testKey", 5)
+    databaseDay.addKey("otherKey", 3)
+    timestamps = numpy.arange(int(datetime(2024, 5, 10).timestamp()), int(datetime(2024, 5, 13).timestamp()), 60)
+    databaseDay.bulkAddArrays(timestamps, {"testKey": numpy.arange(len(timestamps)) / 2})
+    databaseDay.bulkAddArrays([int(datetime(2024, 5, 13).timestamp())], {"otherKey": [7]})
+
+    records = databaseDay.query(datetime(2024, 5, 10), datetime(2024, 5, 14), raw=True)
+    assert len(records) == len(timestamps) + 1
+    assert records[1440] == (int(datetime(2024, 5, 11).timestamp()), 720.0, 0)
+    assert records[-1] == (int(datetime(2024, 5, 13).timestamp()), 0.0, 7)
+    assert len(databaseDay.query(datetime(2024, 5, 11), datetime(2024, 5, 12))) == 1440
+
+    with pytest.raises(strider.SequenceViolation):
+        databaseDay.bulkAddArrays([int(datetime(2024, 5, 12).timestamp())], {"otherKey": [1]})
+    with pytest.raises(strider.SequenceViolation):
+        databaseDay.bulkAddArrays([int(datetime(2024, 5, 15).timestamp()), int(datetime(2024, 5, 14).timestamp())], {})
+    with pytest.raises(ValueError):
+        databaseDay.bulkAddArrays([int(datetime(2024, 5, 15).timestamp())], {"missingKey": [1]})
+    with pytest.raises(ValueError):
+        databaseDay.bulkAddArrays([], {})
+    assert len(databaseDay.query(datetime(2024, 5, 10), datetime(2024, 5, 16))) == len(timestamps) + 1
+
+def testBulkAddArraysWithoutNumpy(database: strider.DatabaseSession, monkeypatch):
+    monkeypatch.setattr(strider.strider, "numpy", None)
+    monkeypatch.setattr(strider.io, "numpy", None)
+    database.addKey("testKey", 5)
+    with pytest.raises(ImportError, match="NumPy is required"):
+        database.bulkAddArrays([int(datetime(2024, 5, 10).timestamp())], {"testKey": [1.0]})
+
+def testBulkAddArraysRollups():
+    numpy = pytest.importorskip("numpy")
+    database = strider.DatabaseManager.new("data/test", "test_tmp", rollups=(3600,))
+    database.addKey("testKey", 5)
+    timestamps = numpy.arange(int(datetime(2024, 5, 10, 15).timestamp()), int(datetime(2024, 5, 10, 18).timestamp()) + 1, 60)
+    database.bulkAddArrays(timestamps, {"testKey": numpy.full(len(timestamps), 2.0)})
+    assert [record.testKey for record in database.query(datetime(2024, 5, 10, 15), datetime(2024, 5, 10, 19), resolution=3600)] == [2.0, 2.0, 2.0]
+    database.close()
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+def testWalReplay():
+    database = strider.DatabaseManager.new("data/test", "test_tmp", bufferSize=100, wal=True)
+    database.addKey("testKey", 5)
+    for second in range(10):
+        database.add(datetime(2024, 5, 10, 15, 30, second), {"testKey": float(second)})
+    # crash, the buffered records never reach the archive and the lock goes with the process
+    database.wal.close()
+    database.writeLock.release()
+    with open(database.fileUtil.getWalFilePath(), "ab") as walFile:
+        walFile.write(b"\x01\x02\x03")
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp", wal=True)
+    assert [record.testKey for record in database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))] == [float(second) for second in range(10)]
+    assert os.path.getsize(database.fileUtil.getWalFilePath()) == 0
+    database.add(datetime(2024, 5, 10, 15, 30, 10), {"testKey": 10.0})
+    database.close()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 11
+    assert not os.path.exists(database.fileUtil.getWalFilePath())
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+def testWalReplayWritten(newDatabaseLayout):
+    database = newDatabaseLayout(wal=True, walSync=strider.datatypes.WAL_SYNC.never)
+    database.addKey("testKey", 5)
+    database.add(datetime(2024, 5, 10, 15, 30, 0), {"testKey": 1.0})
+    database.add(datetime(2024, 5, 10, 15, 30, 1), {"testKey": 2.0})
+    database.add(datetime(2024, 5, 10, 15, 30, 1), {"testKey": 3.0})
+    database.add(datetime(2024, 5, 10, 15, 30, 2), {"testKey": 4.0})
+    database.flush()
+    archive = database._getArchiveForDate(datetime(2024, 5, 10, 15, 30, 0))
+    database.wal.close()
+    database.writeLock.release()
+
+    # the last record reached the disk torn
+    dataPath = database.fileUtil.getArchiveFilePath(archive.archive, True)
+    with open(dataPath, "rb") as dataFile:
+        data = dataFile.read()
+    with open(dataPath, "wb") as dataFile:
+        dataFile.write(data[:-2])
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    records = database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0), raw=True)
+    assert [record[1] for record in records] == [1.0, 2.0, 3.0, 4.0]
+    database.close()
+
+def testWriterLock(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+    database.add(datetime(2024, 5, 10, 15, 30, 0), {"testKey": 1.0})
+    reader = strider.DatabaseManager.load("data/test", "test_tmp")
+    assert len(reader.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 1
+    with pytest.raises(strider.DatabaseLocked):
+        reader.add(datetime(2024, 5, 10, 15, 30, 1), {"testKey": 2.0})
+    with pytest.raises(strider.DatabaseLocked):
+        reader.addKey("otherKey", 5)
+
+    database.close()
+    reader.add(datetime(2024, 5, 10, 15, 30, 1), {"testKey": 2.0})
+    assert len(reader.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 2
+    reader.close()
+
+def testReaderRefresh(newDatabaseLayout):
+    writer = newDatabaseLayout(bufferSize=100)
+    writer.addKey("testKey", 5)
+    for second in range(10):
+        writer.add(datetime(2024, 5, 10, 15, 30, second), {"testKey": float(second)})
+    writer.flush()
+
+    reader = strider.DatabaseManager.load("data/test", "test_tmp")
+    assert len(reader.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 10
+
+    for minute in range(31, 60):
+        writer.add(datetime(2024, 5, 10, 15, minute), {"testKey": float(minute)})
+    writer.add(datetime(2024, 5, 20, 15, 30), {"testKey": 1.0})
+    # buffered records are only seen once flushed
+    assert len(reader.query(datetime(2024, 5, 20, 0, 0), datetime(2024, 5, 21, 0, 0))) == 0
+    writer.flush()
+    assert len(reader.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 39
+    assert len(reader.query(datetime(2024, 5, 20, 0, 0), datetime(2024, 5, 21, 0, 0))) == 1
+
+    # rewritten archives are loaded again
+    writer.setIndexInteval(60, True)
+    assert len(reader.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 39
+
+    writer.addKey("otherKey", 5)
+    writer.add(datetime(2024, 6, 1, 15, 30), {"testKey": 2.0, "otherKey": 3.0})
+    writer.flush()
+    records = reader.query(datetime(2024, 6, 1, 0, 0), datetime(2024, 6, 2, 0, 0))
+    assert [(record.testKey, record.otherKey) for record in records] == [(2.0, 3.0)]
+    assert [key.name for key in reader.databaseHandler.getKeys()] == ["testKey", "otherKey"]
+
+    writer.close()
+    reader.close()
+
+def testQueryCache():
+    database = strider.DatabaseManager.new("data/test", "test_tmp", queryCacheSize=100)
+    database.addKey("testKey", 5)
+    for second in range(10):
+        database.add(datetime(2024, 5, 10, 15, 30, second), {"testKey": float(second)})
+    database.add(datetime.now(), {"testKey": 1.0})
+    database.close()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp", queryCacheSize=100)
+    end = datetime.fromtimestamp(datetime.now().timestamp() + 60)
+    records = database.query(datetime(2024, 5, 10, 0, 0), end)
+    assert len(records) == 11
+    # only the ended archive is cached
+    assert len(database.queryCache) == 1
+    records.clear()
+    assert len(database.query(datetime(2024, 5, 10, 0, 0), end)) == 11
+    assert database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0), "testKey") == {int(datetime(2024, 5, 10, 15, 30, second).timestamp()): float(second) for second in range(10)}
+    assert len(database.queryCache) == 2
+
+    # writes to an archive drop its results
+    database.add(datetime(2024, 5, 10, 15, 30, 10), {"testKey": 10.0})
+    assert len(database.queryCache) == 0
+    assert len(database.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 11
+    database.close()
+
+    # changes by another session drop the results of a reader
+    reader = strider.DatabaseManager.load("data/test", "test_tmp", queryCacheSize=100)
+    assert len(reader.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 11
+    writer = strider.DatabaseManager.load("data/test", "test_tmp")
+    writer.add(datetime(2024, 5, 10, 15, 30, 11), {"testKey": 11.0})
+    writer.flush()
+    assert len(reader.query(datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0))) == 12
+    writer.close()
+    reader.close()
+    shutil.rmtree(os.path.join("data/test", "test_tmp"))
+
+def testQueryCacheSize(database: strider.DatabaseSession):
+    database.addKey("testKey", 5)
+    for day in range(1, 29):
+        database.add(datetime(2024, 2, day, 15, 30), {"testKey": float(day)})
+    database.queryCache.maxSize = 2
+    for week in range(4):
+        database.query(datetime(2024, 2, 1 + week * 7), datetime(2024, 2, 7 + week * 7))
+    assert database.queryCache.size <= 2
+
+def testAggregateSummaries(newDatabaseLayout):
+    database = newDatabaseLayout()
+    database.addKey("testKey", 5)
+    database.addKey("otherKey", 3)
+    database.setIndexInteval(600)
+    records = {datetime(2024, 5, 10, minute // 60, minute % 60): {"testKey": minute / 2, "otherKey": minute % 7} for minute in range(0, 1440, 2)}
+    database.bulkAdd(records)
+    funcs = ["avg", "min", "max", "sum", "last", "count"]
+    expected = [(minute * 60 + int(datetime(2024, 5, 10).timestamp()), ) for minute in range(0, 1440, 720)]
+    for bucket in range(2):
+        values = [data for time, data in records.items() if bucket * 12 <= time.hour < bucket * 12 + 12]
+        for key in ("testKey", "otherKey"):
+            keyValues = [data[key] for data in values]
+            expected[bucket] += (sum(keyValues) / len(keyValues), min(keyValues), max(keyValues), sum(keyValues), keyValues[-1], len(keyValues))
+
+    archive = database._getArchiveForDate(datetime(2024, 5, 10))
+    chunks = list(archive.iterSummarized(int(datetime(2024, 5, 10, 1).timestamp()), int(datetime(2024, 5, 11).timestamp()), 43200))
+    assert any(isinstance(chunk[0], strider.aggregate.Accumulator) for chunk in chunks)
+    assert [tuple(bucket) for bucket in database.aggregate(datetime(2024, 5, 10), datetime(2024, 5, 11), 43200, funcs)] == expected
+    database.close()
+
+    # summaries are saved with the index
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    archive = database._getArchiveForDate(datetime(2024, 5, 10))
+    assert len(archive.summaries) == archive.archive.indexCount - 1
+    assert [tuple(bucket) for bucket in database.aggregate(datetime(2024, 5, 10), datetime(2024, 5, 11), 43200, funcs)] == expected
+    partial = database.aggregate(datetime(2024, 5, 10, 5, 1), datetime(2024, 5, 10, 7, 3), 3600, ["count", "last"], ["otherKey"])
+    assert [tuple(bucket[1:]) for bucket in partial] == [(29, 358 % 7), (30, 418 % 7), (2, 422 % 7)]
+    database.close()
+
+def testQueryWhere(newDatabaseLayout):
+    database = newDatabaseLayout()
+    database.addKey("errorRate", 5)
+    database.addKey("status", 3)
+    database.setIndexInteval(600)
+    records = {datetime(2024, 5, 10, minute // 60, minute % 60): {"errorRate": 0.1 if 300 <= minute < 360 else 0.01, "status": minute % 5} for minute in range(0, 1440)}
+    database.bulkAdd(records)
+    start, end = datetime(2024, 5, 10), datetime(2024, 5, 11)
+    expected = [(int(time.timestamp()), data["errorRate"], data["status"]) for time, data in records.items() if data["errorRate"] > 0.05]
+
+    assert [tuple(record) for record in database.query(start, end, where=("errorRate", ">", 0.05))] == [(timestamp, pytest.approx(errorRate), status) for timestamp, errorRate, status in expected]
+    assert len(database.query(start, end, raw=True, where=[("errorRate", ">", 0.05), ("status", "==", 2)])) == 12
+    assert list(database.query(start, end, "status", where=("errorRate", ">", 0.05))) == [record[0] for record in expected]
+    assert database.query(start, end, where=("status", ">", 4)) == []
+    # keys an archive does not have compare as 0
+    database.addKey("otherKey", 3)
+    assert len(database.query(start, end, where=("otherKey", "==", 0))) == 1440
+    assert database.query(start, end, where=("otherKey", ">", 0)) == []
+    with pytest.raises(ValueError):
+        database.query(start, end, where=("missingKey", ">", 0))
+    with pytest.raises(ValueError):
+        database.query(start, end, where=("errorRate", "=>", 0))
+
+    if strider.io.numpy is not None:
+        array = database.query(start, end, format="numpy", where=("errorRate", ">=", 0.05))
+        assert array["timestamp"].tolist() == [record[0] for record in expected]
+
+        # index entries whose summary rules the comparison out are not read
+        archive = database._getArchiveForDate(start)
+        readArray = archive._readArray
+        ranges = []
+        archive._readArray = lambda start, end, dtype: ranges.append(end - start) or readArray(start, end, dtype)
+        assert len(archive.readArray(int(start.timestamp()), int(end.timestamp()), (("errorRate", ">", 0.05),))) == 60
+        # only the index entries holding the matching records are read, an hour or a 256 record block
+        assert len(ranges) == 1 and ranges[0] <= 256 * 60
+    database.close()
+
+def testStructCodec():
+    from io import BytesIO
+    from array import array
+    from strider.io import StriderFileIO
+    from strider.datatypes import ArchiveKey, ARCHIVE_KEY_TYPES
+
+    keys = [ArchiveKey("température", 0, ARCHIVE_KEY_TYPES.f), ArchiveKey("", 1, ARCHIVE_KEY_TYPES.i)]
+    data = BytesIO()
+    for key in keys:
+        StriderFileIO(data).writeStruct(key)
+    data.seek(0)
+    assert StriderFileIO(data).readStructSequence(ArchiveKey, 2) == keys
+
+    timestamps, offsets = array("I", range(0, 6000, 60)), array("I", range(0, 10000, 100))
+    data = BytesIO()
+    StriderFileIO(data).writeIndexArrays(timestamps, offsets)
+    data.seek(0)
+    assert StriderFileIO(data).readIndexArrays(len(timestamps)) == (timestamps, offsets)
+
+def testAddKeySchemas(newDatabaseLayout):
+    database = newDatabaseLayout()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(strider.strider, "datetime", util.fixedDatetime(datetime(2024, 5, 10, 16, 0)))
+        database.addKey("testKey", 5)
+        database.setIndexInteval(60)
+        database.bulkAdd({datetime(2024, 5, 10, 15, second // 60, second % 60): {"testKey": float(second)} for second in range(0, 600, 10)})
+        database.flush()
+
+        archive = database._getActiveArchive()
+        dataPath = database.fileUtil.getArchiveFilePath(archive.archive, True)
+        dataStat = strider.io.StriderFileUtil.statFile(dataPath)
+        database.addKey("flag", 1)
+        database.addKey("count", 3)
+        # records already written are left as they are
+        assert strider.io.StriderFileUtil.statFile(dataPath) == dataStat
+        database.bulkAdd({datetime(2024, 5, 10, 15, second // 60, second % 60): {"testKey": float(second), "flag": True, "count": second} for second in range(600, 1200, 10)})
+
+    start, end = datetime(2024, 5, 10, 15, 0), datetime(2024, 5, 10, 16, 0)
+    expected = [(int(datetime(2024, 5, 10, 15, second // 60, second % 60).timestamp()), float(second), second >= 600, second if second >= 600 else 0) for second in range(0, 1200, 10)]
+    assert database.query(start, end, raw=True) == expected
+    assert database.query(datetime(2024, 5, 10, 15, 9), datetime(2024, 5, 10, 15, 11), "count") == {record[0]: record[3] for record in expected[54:66]}
+    assert [record for chunk in database.iterQuery(start, end, chunkSize=7, raw=True) for record in chunk] == expected
+    assert database.query(start, end, raw=True, where=[("count", "<", 700)]) == expected[:70]
+    assert [tuple(bucket[1:]) for bucket in database.aggregate(start, end, 3600, ["sum", "count"], ["count"])] == [(sum(range(600, 1200, 10)), 120)]
+    if strider.io.numpy is not None:
+        assert database.query(start, end, format="numpy").tolist() == expected
+
+    database.setIndexInteval(1, True)
+    assert database.query(start, end, raw=True) == expected
+    database.close()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    assert database.query(start, end, raw=True) == expected
+    database.add(datetime(2024, 5, 10, 15, 30), {"testKey": 1.0, "flag": False, "count": 1})
+    assert database.query(datetime(2024, 5, 10, 15, 30), end, raw=True)[-1] == (int(datetime(2024, 5, 10, 15, 30).timestamp()), 1.0, False, 1)
+    database.close()
+
+def testReindexArchives(newDatabaseLayout):
+    database = newDatabaseLayout()
+    database.addKey("testKey", 5)
+    database.bulkAdd({datetime(2024, 5, day, hour, minute): {"testKey": float(minute)} for day in range(1, 29, 3) for hour in range(0, 24, 4) for minute in range(0, 60, 5)})
+    start, end = datetime(2024, 5, 1), datetime(2024, 6, 1)
+    expected = database.query(start, end, raw=True)
+    database.close()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    assert database.query(start, end, raw=True) == expected
+    calls = []
+    database.setIndexInteval(3600, True, workers=2, progress=lambda done, total: calls.append((done, total)))
+    archiveCount = len(database.databaseHandler.database.archives)
+    assert archiveCount > 1 and calls == [(done, archiveCount) for done in range(1, archiveCount + 1)]
+    assert database.query(start, end, raw=True) == expected
+
+    for databaseArchive in database.databaseHandler.database.archives:
+        archive = database.databaseHandler.loadArchive(databaseArchive.minRange)
+        assert archive.archive.indexInterval == 3600
+        indices = (archive.indexTimestamps, archive.indexOffsets)
+        # streamed in chunks smaller than an archive
+        archive.setIndexInteval(3600, chunkSize=7)
+        assert (archive.indexTimestamps, archive.indexOffsets) == indices
+        if database.databaseHandler.database.archiveLayout != strider.datatypes.ARCHIVE_LAYOUT.block:
+            indexed, last = [], archive.archive.minRange
+            for record in archive.readRecords(0, 2**32 - 1, raw=True):
+                if record[0] - last >= 3600:
+                    indexed.append(record[0])
+                    last = record[0]
+            assert archive.indexTimestamps.tolist() == indexed
+    database.close()
+
+def testMetrics(newDatabaseLayout):
+    events = []
+    database = newDatabaseLayout(metricsCallback=lambda *event: events.append(event))
+    database.addKey("testKey", 5)
+    database.bulkAdd({datetime(2024, 5, 1, hour, minute): {"testKey": float(minute)} for hour in range(24) for minute in range(60)})
+    start, end = datetime(2024, 5, 1, 6), datetime(2024, 5, 1, 7)
+    assert len(database.query(start, end)) == 60
+    assert len(database.query(start, end, where=("testKey", "<", 10))) == 10
+
+    metrics = database.getMetrics()
+    counters = metrics["counters"]
+    assert counters["archivesOpened"] == 1
+    assert counters["recordsWritten"] == 24 * 60
+    assert counters["recordsReturned"] == 70
+    assert counters["bytesWritten"] > 0 and counters["bytesRead"] > 0
+    assert 120 <= counters["recordsScanned"] < 24 * 60
+    assert counters["indexEntriesVisited"] > 0
+    latency = metrics["latency"]["query"]
+    assert latency["count"] == 2 and latency["buckets"][-1] == (float("inf"), 2) and latency["max"] <= latency["sum"]
+    assert metrics["latency"]["bulkAdd"]["count"] == 1
+    assert ("latency", "query") in [event[:2] for event in events]
+    assert sum(value for kind, name, value in events if name == "recordsReturned") == 70
+    database.close()
+
+    database = strider.DatabaseManager.load("data/test", "test_tmp")
+    assert database.metrics is None and database.getMetrics() == {}
+    assert all(archive.metrics is None for archive in database.loadedArchives.values())
+    database.close()
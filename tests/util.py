@@ -0,0 +1,10 @@
+from datetime import datetime
+
+
+def fixedDatetime(now: datetime) -> type[datetime]:
+    """datetime class whose `now()` always returns `now`, to make a past archive the active one"""
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+    return FixedDatetime